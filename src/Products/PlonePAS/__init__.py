@@ -12,6 +12,8 @@ from Products.PlonePAS.plugins import property
 from Products.PlonePAS.plugins import role
 from Products.PlonePAS.plugins import ufactory
 from Products.PlonePAS.plugins import user
+from Products.PlonePAS.rolemanager import patch_catalogaware
+from Products.PlonePAS.rolemanager import patch_rolemanager
 from Products.PlonePAS.tools.groupdata import GroupDataTool
 from Products.PlonePAS.tools.groups import GroupsTool
 from Products.PlonePAS.tools.memberdata import MemberDataTool
@@ -21,6 +23,8 @@ from Products.PluggableAuthService import registerMultiPlugin
 ####################################
 # monkey patch pas, the evil happens
 patch_pas()
+patch_catalogaware()
+patch_rolemanager()
 
 #################################
 # new groups tool
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+from App.config import getConfiguration
+
 PROJECTNAME = 'PlonePAS'
 GLOBALS = globals()
 
@@ -18,6 +20,15 @@ except ImportError:
     PIL_SCALING_ALGO = None
     HAS_PIL = False
 
+# concurrent.futures is in the standard library as of Python 3, the
+# futures package provides it for Python 2
+HAS_FUTURES = True
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+    HAS_FUTURES = False
+
 PIL_QUALITY = 88
 MEMBER_IMAGE_SCALE = (75, 100)
 IMAGE_SCALE_PARAMS = {
@@ -26,3 +37,46 @@ IMAGE_SCALE_PARAMS = {
     'algorithm': PIL_SCALING_ALGO,
     'default_format': 'PNG'
 }
+
+# Opt-in cache of authentication results, configured in zope.conf:
+#
+#   <product-config plonepas>
+#       authentication-cache-size 1000
+#       authentication-cache-ttl 60
+#   </product-config>
+#
+# The size is the number of logins kept, the ttl in seconds how long a
+# login is trusted without checking its password again. The cache is
+# disabled with a size of 0, the default.
+_product_config = (getattr(getConfiguration(), 'product_config', None) or
+                   {}).get('plonepas', {})
+AUTHENTICATION_CACHE_SIZE = int(
+    _product_config.get('authentication-cache-size', 0))
+AUTHENTICATION_CACHE_TTL = int(
+    _product_config.get('authentication-cache-ttl', 60))
+
+# Per process memory of the authentication plugin that accepted a login,
+# tried first on its next authentication. Only kept while the order of
+# the plugins stays the same. Disabled with a size of 0.
+LOGIN_PLUGIN_HINT_CACHE_SIZE = int(
+    _product_config.get('login-plugin-hint-cache-size', 10000))
+LOGIN_PLUGIN_HINT_CACHE_TTL = int(
+    _product_config.get('login-plugin-hint-cache-ttl', 3600))
+
+# Opt-in cache of principal ids no plugin knows, e.g. those left in local
+# roles and groups after the principal was removed. Looking them up
+# again asks every enumeration plugin. Adding a user or group through
+# PlonePAS in this process invalidates it, elsewhere (other ZEO clients,
+# LDAP) the ttl in seconds bounds how long a new principal may be taken
+# for unknown. Disabled with a size of 0, the default.
+PRINCIPAL_MISS_CACHE_SIZE = int(
+    _product_config.get('principal-miss-cache-size', 0))
+PRINCIPAL_MISS_CACHE_TTL = int(
+    _product_config.get('principal-miss-cache-ttl', 60))
+
+# Number of merged local roles maps LocalRolesManager keeps per request,
+# one for every container and set of principals looked at, so checking
+# many siblings doesn't walk the same containers again. When full, the
+# least recently used map is dropped. Disabled with a size of 0.
+LOCAL_ROLES_CACHE_SIZE = int(
+    _product_config.get('local-roles-cache-size', 10000))
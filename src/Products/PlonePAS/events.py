@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
+from Products.PlonePAS.interfaces.events import ILocalRolesModifiedEvent
 from Products.PlonePAS.interfaces.events import IUserInitialLoginInEvent
 from Products.PluggableAuthService.events import PASEvent
 from Products.PluggableAuthService.interfaces.events import IUserLoggedInEvent
 from Products.PluggableAuthService.interfaces.events import IUserLoggedOutEvent
+from zope.component.interfaces import ObjectEvent
 from zope.interface import implementer
 
 
@@ -28,3 +30,11 @@ class UserLoggedOutEvent(PASEvent):
 
     PAS Event
     """
+
+
+@implementer(ILocalRolesModifiedEvent)
+class LocalRolesModifiedEvent(ObjectEvent):
+    """The local roles of an object have been changed
+
+    Plone only event!
+    """
@@ -1,7 +1,19 @@
 # -*- coding: utf-8 -*-
 from Products.PluggableAuthService.interfaces.events import IUserLoggedInEvent
+from zope.component.interfaces import IObjectEvent
 
 
 class IUserInitialLoginInEvent(IUserLoggedInEvent):
     """A user logs in for the first time in the portal.
     """
+
+
+class ILocalRolesModifiedEvent(IObjectEvent):
+    """The local roles of an object, or whether it acquires local roles,
+    have been changed.
+
+    Notified by the RoleManager API and by reindexObjectSecurity. Code
+    writing __ac_local_roles__ or __ac_local_roles_block__ directly must
+    call either, or notify the event itself, to keep the local roles
+    request cache and index of LocalRolesManager up to date.
+    """
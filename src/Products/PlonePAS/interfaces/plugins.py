@@ -125,3 +125,20 @@ class ISchemaMutablePropertiesPlugin(Interface):
         """
         Add a new property to a property provider.
         """
+
+
+class IIndexedPlugin(Interface):
+    """
+    Plugin keeping persistent indexes of its records, so queries do
+    not need to load every record.
+
+    Plugins created before an index was introduced hold None in its
+    place and fall back to scanning their records until rebuildIndexes
+    is called; the upgrade steps of the PlonePAS profile do so for every
+    plugin in acl_users providing this interface.
+    """
+
+    def rebuildIndexes():
+        """
+        Build all indexes of the plugin from its records.
+        """
@@ -44,6 +44,14 @@ def getPropertiesForUser(self, user, request=None):
     return properties
 
 
+def getPropertiesForUsers(self, users, request=None):
+    """Bulk version of getPropertiesForUser
+
+    Returns a list of property mappings in the order of users.
+    """
+    return [self.getPropertiesForUser(user, request) for user in users]
+
+
 def getGroupsForPrincipal(self, user, request=None, attr=None):
     """ Fulfill GroupsPlugin requirements, but don't return any groups for
     groups """
@@ -63,6 +71,12 @@ def patch_ldapmp():
         'getPropertiesForUser',
         getPropertiesForUser
     )
+    wrap_method(
+        LDAPPluginBase,
+        'getPropertiesForUsers',
+        getPropertiesForUsers,
+        add=True
+    )
 
     from Products.LDAPMultiPlugins.LDAPMultiPlugin import LDAPMultiPlugin
     wrap_method(
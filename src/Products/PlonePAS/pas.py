@@ -7,20 +7,30 @@ from AccessControl.Permissions import change_permissions
 from AccessControl.Permissions import manage_properties
 from AccessControl.Permissions import manage_users as ManageUsers
 from AccessControl.requestmethod import postonly
+from Acquisition import aq_base
 from OFS.Folder import Folder
 from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.utils import registerToolInterface
+from Products.PlonePAS.config import AUTHENTICATION_CACHE_SIZE
+from Products.PlonePAS.config import AUTHENTICATION_CACHE_TTL
+from Products.PlonePAS.config import LOGIN_PLUGIN_HINT_CACHE_SIZE
+from Products.PlonePAS.config import LOGIN_PLUGIN_HINT_CACHE_TTL
+from Products.PlonePAS.config import PRINCIPAL_MISS_CACHE_SIZE
+from Products.PlonePAS.config import PRINCIPAL_MISS_CACHE_TTL
 from Products.PlonePAS.interfaces.group import IGroupIntrospection
 from Products.PlonePAS.interfaces.group import IGroupManagement
 from Products.PlonePAS.interfaces.plugins import ILocalRolesPlugin
 from Products.PlonePAS.interfaces.plugins import IUserIntrospection
 from Products.PlonePAS.interfaces.plugins import IUserManagement
 from Products.PlonePAS.patch import ORIG_NAME
+from Products.PlonePAS.plugins.local_role import unindexPrincipal
 from Products.PlonePAS.patch import wrap_method
+from Products.PlonePAS.utils import LRUCache
 from Products.PluggableAuthService.PluggableAuthService import \
     PluggableAuthService
 from Products.PluggableAuthService.PluggableAuthService import \
     _SWALLOWABLE_PLUGIN_EXCEPTIONS
+from Products.PluggableAuthService.events import PrincipalCreated
 from Products.PluggableAuthService.events import PrincipalDeleted
 from Products.PluggableAuthService.interfaces.authservice import \
     IPluggableAuthService
@@ -28,12 +38,24 @@ from Products.PluggableAuthService.interfaces.plugins import \
     IAuthenticationPlugin
 from Products.PluggableAuthService.interfaces.plugins import \
     IGroupEnumerationPlugin
+from Products.PluggableAuthService.interfaces.plugins import \
+    IPropertiesPlugin
 from Products.PluggableAuthService.interfaces.plugins import \
     IRoleAssignerPlugin
+from Products.PluggableAuthService.interfaces.plugins import \
+    IRolesPlugin
+from Products.PluggableAuthService.interfaces.plugins import \
+    IUserAdderPlugin
 from Products.PluggableAuthService.interfaces.plugins import \
     IUserEnumerationPlugin
+from Products.PluggableAuthService.utils import createKeywords
+from Products.PluggableAuthService.utils import createViewName
 from zope.event import notify
+import hashlib
+import hmac
 import logging
+import os
+import transaction
 
 logger = logging.getLogger('PlonePAS')
 
@@ -96,12 +118,82 @@ def _userSetGroups(pas, user_id, groupnames):
 def _doAddUser(self, login, password, roles, domains, groups=None, **kw):
     """Masking of PAS._doAddUser to add groups param."""
     _old_doAddUser = getattr(self, getattr(_doAddUser, ORIG_NAME))
+    self._invalidateUnknownPrincipals([login])
     retval = _old_doAddUser(login, password, roles, domains)
     if groups is not None:
         _userSetGroups(self, login, groups)
     return retval
 
 
+def _doAddUsers(self, records, chunk_size=500, progress=None):
+    """Add several users at once.
+
+    records is a sequence of mappings with the keys 'login' and
+    'password', and optionally 'roles' and 'groups'. The users are
+    added by one call to the first user adder if it supports addUsers,
+    else one by one. Roles, groups and the creation event are then
+    handled in chunks of chunk_size users, each followed by a savepoint
+    and a call of progress(done, total), if given.
+
+    Logins are transformed like in _doAddUser. Returns the added users,
+    leaving out those the user adder cannot return.
+    """
+    plugins = self._getOb('plugins')
+    useradders = plugins.listPlugins(IUserAdderPlugin)
+    roleassigners = plugins.listPlugins(IRoleAssignerPlugin)
+    if not (useradders and roleassigners):
+        raise NotImplementedError(
+            "There are no plugins that can create users and assign roles "
+            "to them."
+        )
+    useradder = useradders[0][1]
+    records = list(records)
+    if getattr(aq_base(useradder), 'addUsers', None) is None:
+        users = []
+        for record in records:
+            self._doAddUser(
+                record['login'], record['password'],
+                record.get('roles', ()), (), record.get('groups'))
+            user = self.getUser(self.applyTransform(record['login']))
+            if user is not None:
+                users.append(user)
+        if progress is not None:
+            progress(len(records), len(records))
+        return users
+
+    logins = [self.applyTransform(record['login']) for record in records]
+    useradder.addUsers([(login, login, record['password'])
+                        for login, record in zip(logins, records)])
+
+    users = []
+    total = len(records)
+    for start in range(0, total, chunk_size):
+        for login, record in zip(logins[start:start + chunk_size],
+                                 records[start:start + chunk_size]):
+            user = self.getUser(login)
+            if user is None:
+                logger.warning('_doAddUsers: user %s was added but can '
+                               'not be found' % login)
+                continue
+            for roleassigner_id, roleassigner in roleassigners:
+                for role in record.get('roles', ()):
+                    try:
+                        roleassigner.doAssignRoleToPrincipal(
+                            user.getId(), role)
+                    except _SWALLOWABLE_PLUGIN_EXCEPTIONS:
+                        logger.debug(
+                            'RoleAssigner %s error' % roleassigner_id,
+                            exc_info=True)
+            if record.get('groups') is not None:
+                _userSetGroups(self, user.getId(), record['groups'])
+            notify(PrincipalCreated(user))
+            users.append(user)
+        transaction.savepoint(optimistic=True)
+        if progress is not None:
+            progress(min(start + chunk_size, total), total)
+    return users
+
+
 def _doDelUsers(self, names, REQUEST=None):
     """
     Delete users given by a list of user ids.
@@ -123,13 +215,18 @@ def _doDelUser(self, id):
             "There is no plugin that can delete users."
         )
 
+    invalidateAuthenticationCache([id])
+    deleted = False
     for userdeleter_id, userdeleter in userdeleters:
         try:
             userdeleter.doDeleteUser(id)
         except _SWALLOWABLE_PLUGIN_EXCEPTIONS:
             pass
         else:
+            deleted = True
             notify(PrincipalDeleted(id))
+    if deleted:
+        unindexPrincipal(self, id)
 
 
 def _doChangeUser(self, principal_id, password, roles, domains=(), groups=None,
@@ -168,6 +265,7 @@ def userFolderAddUser(self, login, password, roles, domains,
 
 
 def _doAddGroup(self, id, roles, groups=None, **kw):
+    self._invalidateUnknownPrincipals([id])
     gtool = getToolByName(self, 'portal_groups')
     return gtool.addGroup(id, roles, groups, **kw)
 
@@ -269,21 +367,76 @@ def _getLocalRolesForDisplay(self, object):
     result = []
     # we don't have a PAS-side way to get this
     local_roles = object.get_local_roles()
+    principals = self._resolvePrincipals(
+        [one_user[0] for one_user in local_roles])
     for one_user in local_roles:
         username = userid = one_user[0]
         roles = one_user[1]
         userType = 'user'
-        if self.getGroup(userid):
-            userType = 'group'
-        else:
-            user = self.getUserById(userid) or self.getUser(username)
-            if user:
-                username = user.getUserName()
-                userid = user.getId()
+        principal = principals.get(userid)
+        if principal is not None:
+            userType = principal[0]
+            if userType == 'user':
+                userid, username = principal[1:]
         result.append((username, roles, userType, userid))
     return tuple(result)
 
 
+def _resolvePrincipals(self, principal_ids):
+    """Tell groups and users among principal_ids.
+
+    Returns a dict mapping each principal id found to a tuple of its
+    type ('group' or 'user'), its id and its login name. A principal id
+    may also be the login of a user. Groups win over users, as with
+    getGroup, getUserById and getUser.
+
+    Each enumeration plugin is asked once for all ids, ids not found
+    that way are looked up one by one, for plugins which don't support
+    searching for several ids at once. Ids still not found are remembered
+    as unknown principals.
+    """
+    plugins = self._getOb('plugins')
+    result = {}
+    remaining = set([principal_id for principal_id in principal_ids
+                     if not self._isUnknownPrincipal(principal_id)])
+
+    searches = (
+        (IGroupEnumerationPlugin, 'enumerateGroups', 'id', 'group'),
+        (IUserEnumerationPlugin, 'enumerateUsers', 'id', 'user'),
+        (IUserEnumerationPlugin, 'enumerateUsers', 'login', 'user'),
+    )
+    for interface, method, key, principal_type in searches:
+        for plugin_id, plugin in plugins.listPlugins(interface):
+            if not remaining:
+                break
+            try:
+                infos = getattr(plugin, method)(
+                    exact_match=True, **{key: tuple(sorted(remaining))})
+            except _SWALLOWABLE_PLUGIN_EXCEPTIONS:
+                logger.debug(
+                    'PluggableAuthService: %s %s error', method, plugin_id,
+                    exc_info=True)
+                continue
+            for info in infos:
+                principal_id = info.get(key)
+                if principal_id not in remaining:
+                    continue
+                remaining.discard(principal_id)
+                result[principal_id] = (
+                    principal_type, info['id'], info.get('login', info['id']))
+
+    for principal_id in remaining:
+        if self.getGroup(principal_id):
+            result[principal_id] = ('group', principal_id, principal_id)
+            continue
+        user = self.getUserById(principal_id) or self.getUser(principal_id)
+        if user:
+            result[principal_id] = ('user', user.getId(), user.getUserName())
+        else:
+            self._setUnknownPrincipal(principal_id)
+    return result
+
+
 def getUsers(self):
     """
     Return a list of all users from plugins that implement the user
@@ -339,11 +492,31 @@ def userSetPassword(self, userid, password):
         else:
             modified = True
 
+    invalidateAuthenticationCache([userid])
     if not modified:
         raise RuntimeError("No user management plugins were able "
                            "to successfully modify the user")
 
 
+def _updateLoginName(self, user_id, login_name):
+    """Masking of PAS._updateLoginName to forget the authentications of
+    the user by its old login name.
+    """
+    _old_updateLoginName = getattr(self, getattr(_updateLoginName, ORIG_NAME))
+    invalidateAuthenticationCache([user_id])
+    return _old_updateLoginName(user_id, login_name)
+
+
+def updateAllLoginNames(self, quit_on_first_error=True):
+    """Masking of PAS.updateAllLoginNames to forget all authentications,
+    as the login names of any user may change.
+    """
+    _old_updateAllLoginNames = getattr(
+        self, getattr(updateAllLoginNames, ORIG_NAME))
+    invalidateAuthenticationCache()
+    return _old_updateAllLoginNames(quit_on_first_error=quit_on_first_error)
+
+
 def credentialsChanged(self, user, name, new_password):
     """Notifies the authentication mechanism that this user has changed
     passwords.  This can be used to update the authentication cookie.
@@ -373,6 +546,8 @@ def _delOb(self, id):
 
     if getattr(plugins, 'removePluginById', None) is not None:
         plugins.removePluginById(id)
+        # the plugin may be in a snapshot of _listPlugins
+        aq_base(plugins)._v_plugin_snapshots = {}
 
     Folder._delOb(self, id)
 
@@ -402,7 +577,11 @@ def _getAllLocalRoles(self, context):
 
     roles = {}
     for lrid, lrmanager in lrmanagers:
-        newroles = lrmanager.getAllLocalRolesInContext(context)
+        # the merged local roles of the containers are shared by all
+        # objects in a reindex of their security
+        getAllLocalRoles = getattr(lrmanager, '_getAllLocalRolesInChain',
+                                   lrmanager.getAllLocalRolesInContext)
+        newroles = getAllLocalRoles(context)
         for k, v in newroles.items():
             if k not in roles:
                 roles[k] = set()
@@ -423,16 +602,36 @@ def authenticate(self, name, password, request):
 
     plugins = self.plugins
 
+    cache = _authentication_cache
+    key = None
+    if cache is not None and isinstance(name, basestring) and \
+            isinstance(password, basestring):
+        key = _authenticationCacheKey(self, name, password)
+        cached = cache.get(key)
+        if cached is not None:
+            user_id, name = cached
+            return self._findUser(plugins, user_id, name, request)
+
     try:
         authenticators = plugins.listPlugins(IAuthenticationPlugin)
     except _SWALLOWABLE_PLUGIN_EXCEPTIONS:
         logger.info('PluggableAuthService: Plugin listing error', exc_info=1)
         authenticators = ()
 
+    # try the plugin which authenticated the login before first
+    login = name
+    authenticator_ids = tuple([authenticator_id for authenticator_id, auth
+                               in authenticators])
+    hint = self._getLoginPluginHint(login, authenticator_ids)
+    if hint is not None:
+        authenticators = sorted(authenticators,
+                                key=lambda item: item[0] != hint)
+
     credentials = {'login': name,
                    'password': password}
 
     user_id = None
+    failed = False
 
     for authenticator_id, auth in authenticators:
         try:
@@ -446,14 +645,165 @@ def authenticate(self, name, password, request):
                 authenticator_id,
                 exc_info=1
             )
+            failed = True
             continue
 
     if not user_id:
         return
 
+    if authenticator_id != hint and not failed:
+        # all plugins before it declined the credentials
+        self._setLoginPluginHint(login, authenticator_id, authenticator_ids)
+    if key is not None:
+        cache.set(key, (user_id, name))
     return self._findUser(plugins, user_id, name, request)
 
 
+# The cache of principal ids unknown to the plugins, see config.py. It
+# maps the path of the user folder and the principal id to True.
+_principal_misses = None
+if PRINCIPAL_MISS_CACHE_SIZE > 0:
+    _principal_misses = LRUCache(PRINCIPAL_MISS_CACHE_SIZE,
+                                 PRINCIPAL_MISS_CACHE_TTL)
+
+
+def _isUnknownPrincipal(self, principal_id):
+    """True if principal_id was recently found to be neither a user nor
+    a group.
+    """
+    if _principal_misses is None:
+        return False
+    return _principal_misses.get((self.getPhysicalPath(), principal_id),
+                                 False)
+
+
+def _setUnknownPrincipal(self, principal_id):
+    if _principal_misses is not None:
+        _principal_misses.set((self.getPhysicalPath(), principal_id), True)
+
+
+def _invalidateAfterCommit(invalidate, *args):
+    """Call invalidate(*args) now and again when the current transaction
+    has been committed.
+
+    Concurrent requests may cache the stale state again until the
+    changes are committed.
+    """
+    invalidate(*args)
+
+    def hook(status, *args):
+        if status:
+            invalidate(*args)
+    transaction.get().addAfterCommitHook(hook, args)
+
+
+def _forgetUnknownPrincipals(path, principal_ids):
+    if principal_ids is None:
+        _principal_misses.clear()
+        return
+    for principal_id in principal_ids:
+        _principal_misses.invalidate((path, principal_id))
+
+
+def _invalidateUnknownPrincipals(self, principal_ids=None):
+    """Forget that principal_ids, or all principals, are unknown.
+    """
+    if _principal_misses is None:
+        return
+    if principal_ids is not None:
+        principal_ids = tuple(principal_ids)
+    _invalidateAfterCommit(_forgetUnknownPrincipals,
+                           self.getPhysicalPath(), principal_ids)
+
+
+# The authentication plugins which accepted logins, see config.py. It
+# maps the path of the user folder and a login to the ids of the
+# authentication plugins in their order and the id of the plugin.
+_login_plugin_hints = None
+if LOGIN_PLUGIN_HINT_CACHE_SIZE > 0:
+    _login_plugin_hints = LRUCache(LOGIN_PLUGIN_HINT_CACHE_SIZE,
+                                   LOGIN_PLUGIN_HINT_CACHE_TTL)
+
+
+def _getLoginPluginHint(self, login, authenticator_ids):
+    """Return the id of the authentication plugin which accepted login
+    last, or None.
+
+    The hint only holds while the authentication plugins are in the
+    order it was found in, authenticator_ids.
+    """
+    if _login_plugin_hints is None or not isinstance(login, basestring):
+        return None
+    hint = _login_plugin_hints.get((self.getPhysicalPath(), login))
+    if hint is None or hint[0] != authenticator_ids:
+        return None
+    return hint[1]
+
+
+def _setLoginPluginHint(self, login, plugin_id, authenticator_ids):
+    """Remember plugin_id as the plugin authenticating login, after the
+    plugins before it in authenticator_ids declined it.
+
+    authenticate tries that plugin first and falls back to all plugins
+    in their order if it fails. The hints are kept in memory, so
+    authentication does not write to the database.
+    """
+    if _login_plugin_hints is None or not isinstance(login, basestring):
+        return
+    _login_plugin_hints.set((self.getPhysicalPath(), login),
+                            (authenticator_ids, plugin_id))
+
+
+def _delLoginPluginHint(self, login):
+    if _login_plugin_hints is not None:
+        _login_plugin_hints.invalidate((self.getPhysicalPath(), login))
+
+
+# The cache of authentication results, see config.py. It maps a keyed
+# hash of the user folder, login and password to the user id and login
+# name authenticated by them. Only hashes are kept, so the passwords
+# are not held in memory.
+_authentication_cache = None
+if AUTHENTICATION_CACHE_SIZE > 0:
+    _authentication_cache = LRUCache(AUTHENTICATION_CACHE_SIZE,
+                                     AUTHENTICATION_CACHE_TTL)
+_authentication_secret = os.urandom(32)
+
+
+def _authenticationCacheKey(pas, name, password):
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    message = '\0'.join(['/'.join(pas.getPhysicalPath()), name, password])
+    return hmac.new(_authentication_secret, message, hashlib.sha256).digest()
+
+
+def _forgetAuthentications(user_ids):
+    cache = _authentication_cache
+    if cache is None:
+        return
+    if user_ids is None:
+        cache.clear()
+    else:
+        cache.invalidateValues(lambda value: value[0] in user_ids)
+
+
+def invalidateAuthenticationCache(user_ids=None):
+    """Forget the cached authentications of user_ids, or of all users.
+
+    This scans the whole cache, so changes of many users invalidate
+    them in one call. They are forgotten right away, so the changing
+    transaction can no longer authenticate with the old credentials,
+    and again once it is committed.
+    """
+    if _authentication_cache is None:
+        return
+    if user_ids is not None:
+        user_ids = frozenset(user_ids)
+    _invalidateAfterCommit(_forgetAuthentications, user_ids)
+
+
 def getUserIds(self):
     """method was used at GRUF and is here for bbb. Not good for many users!
     DEPRECATED
@@ -504,13 +854,208 @@ def getUserNames(self):
     return results
 
 
+def _addPropertysheets(self, principals, plugins=None, request=None):
+    """Add the property sheets of all properties plugins to principals.
+
+    Plugins providing getPropertiesForUsers are asked once for all
+    principals, the others once per principal.
+    """
+    if plugins is None:
+        plugins = self._getOb('plugins')
+    principals = list(principals)
+    if not principals:
+        return
+    propfinders = plugins.listPlugins(IPropertiesPlugin)
+    for propfinder_id, propfinder in propfinders:
+        if getattr(aq_base(propfinder), 'getPropertiesForUsers', None):
+            sheets = propfinder.getPropertiesForUsers(principals, request)
+        else:
+            sheets = [propfinder.getPropertiesForUser(principal, request)
+                      for principal in principals]
+        for principal, data in zip(principals, sheets):
+            if data:
+                principal.addPropertysheet(propfinder_id, data)
+
+
+def _findUser(self, plugins, user_id, name=None, request=None):
+    """ user_id -> decorated_user
+
+    Same as upstream, but users supporting it get their property sheets
+    only when they are first accessed, see PloneUser._deferPropertysheets.
+    """
+    if user_id == self._emergency_user.getUserName():
+        return self._emergency_user
+
+    # See if the user can be retrieved from the cache
+    view_name = createViewName('_findUser', user_id)
+    name = self.applyTransform(name)
+    keywords = createKeywords(user_id=user_id, name=name)
+    user = self.ZCacheable_get(view_name=view_name,
+                               keywords=keywords,
+                               default=None)
+
+    if user is None:
+        user = self._createUser(plugins, user_id, name)
+        propfinders = plugins.listPlugins(IPropertiesPlugin)
+        if getattr(user, '_deferPropertysheets', None) is not None:
+            user._deferPropertysheets(
+                [propfinder_id for propfinder_id, propfinder in propfinders],
+                self)
+            # wrapped, so its property sheets can be loaded if a groups or
+            # roles plugin asks for properties
+            principal = user.__of__(self)
+        else:
+            for propfinder_id, propfinder in propfinders:
+                data = propfinder.getPropertiesForUser(user, request)
+                if data:
+                    user.addPropertysheet(propfinder_id, data)
+            principal = user
+
+        groups = self._getGroupsForPrincipal(principal, request,
+                                             plugins=plugins)
+        principal._addGroups(groups)
+
+        rolemakers = plugins.listPlugins(IRolesPlugin)
+
+        for rolemaker_id, rolemaker in rolemakers:
+            try:
+                roles = rolemaker.getRolesForPrincipal(principal, request)
+            except _SWALLOWABLE_PLUGIN_EXCEPTIONS:
+                logger.debug('IRolesPlugin %s error' % rolemaker_id,
+                             exc_info=True)
+            else:
+                if roles:
+                    principal._addRoles(roles)
+
+        principal._addRoles(['Authenticated'])
+
+        # Cache the user if caching is enabled
+        base_user = aq_base(user)
+        if getattr(base_user, '_p_jar', None) is None:
+            self.ZCacheable_set(base_user,
+                                view_name=view_name,
+                                keywords=keywords)
+
+    return user.__of__(self)
+
+
+def _findUsers(self, plugins, user_infos, request=None):
+    """Bulk version of _findUser: [(user_id, login), ...] -> [user, ...]
+
+    Users found in the ZCacheable cache are reused; the property sheets
+    of all others are filled in one pass over the properties plugins.
+    """
+    emergency_user = self._emergency_user
+    users = []
+    created = []
+    for user_id, name in user_infos:
+        if user_id == emergency_user.getUserName():
+            users.append(emergency_user)
+            continue
+        if name is not None:
+            name = self.applyTransform(name)
+        view_name = createViewName('_findUser', user_id)
+        keywords = createKeywords(user_id=user_id, name=name)
+        user = self.ZCacheable_get(view_name=view_name,
+                                   keywords=keywords,
+                                   default=None)
+        if user is None:
+            user = self._createUser(plugins, user_id, name)
+            created.append((user, view_name, keywords))
+        users.append(user)
+
+    self._addPropertysheets(
+        [entry[0] for entry in created], plugins, request)
+
+    rolemakers = plugins.listPlugins(IRolesPlugin)
+    for user, view_name, keywords in created:
+        groups = self._getGroupsForPrincipal(user, request,
+                                             plugins=plugins)
+        user._addGroups(groups)
+        for rolemaker_id, rolemaker in rolemakers:
+            try:
+                roles = rolemaker.getRolesForPrincipal(user, request)
+            except _SWALLOWABLE_PLUGIN_EXCEPTIONS:
+                logger.debug('IRolesPlugin %s error' % rolemaker_id,
+                             exc_info=True)
+            else:
+                if roles:
+                    user._addRoles(roles)
+        user._addRoles(['Authenticated'])
+
+        # Cache the user if caching is enabled
+        base_user = aq_base(user)
+        if getattr(base_user, '_p_jar', None) is None:
+            self.ZCacheable_set(base_user,
+                                view_name=view_name,
+                                keywords=keywords)
+
+    return [found is emergency_user and found or found.__of__(self)
+            for found in users]
+
+
+def _getUsersByIds(self, user_ids, request=None):
+    """Bulk version of getUserById.
+
+    Returns a list in the order of user_ids, with None for ids no user
+    enumeration plugin knows about.
+    """
+    plugins = self._getOb('plugins')
+    infos = []
+    for user_id in user_ids:
+        info = self._verifyUser(plugins, user_id=user_id)
+        if info is not None:
+            infos.append((info['id'], info['login']))
+    found = dict(zip([user_id for user_id, login in infos],
+                     self._findUsers(plugins, infos, request)))
+    return [found.get(user_id) for user_id in user_ids]
+
+
+def _listPlugins(self, plugin_type):
+    """Same as plugins.listPlugins(plugin_type), from a snapshot.
+
+    The unwrapped plugins are kept in a volatile attribute of the plugin
+    registry, next to the tuple of active plugin ids they were resolved
+    from and the modification time of PAS. Activating, deactivating or
+    reordering plugins stores a new tuple in the registry, and adding or
+    replacing plugins changes PAS, which invalidates the snapshot.
+    Deleting a plugin drops the snapshots, see _delOb.
+    """
+    registry = self._getOb('plugins')
+    key = (registry._getPlugins(plugin_type), aq_base(self)._p_mtime)
+    snapshots = getattr(aq_base(registry), '_v_plugin_snapshots', None)
+    if snapshots is None:
+        snapshots = registry._v_plugin_snapshots = {}
+
+    snapshot = snapshots.get(plugin_type)
+    if snapshot is None or snapshot[0] != key:
+        plugins = tuple([(plugin_id, aq_base(plugin)) for plugin_id, plugin
+                         in registry.listPlugins(plugin_type)])
+        snapshot = snapshots[plugin_type] = (key, plugins)
+
+    return [(plugin_id, plugin.__of__(self))
+            for plugin_id, plugin in snapshot[1]]
+
+
 def patch_pas():
     # sort alphabetically by patched/added method name
+    wrap_method(
+        PluggableAuthService,
+        '_addPropertysheets',
+        _addPropertysheets,
+        add=True
+    )
     wrap_method(
         PluggableAuthService,
         '_delOb',
         _delOb
     )
+    wrap_method(
+        PluggableAuthService,
+        '_delLoginPluginHint',
+        _delLoginPluginHint,
+        add=True
+    )
     wrap_method(
         PluggableAuthService,
         '_getAllLocalRoles',
@@ -528,6 +1073,12 @@ def patch_pas():
         '_doAddUser',
         _doAddUser
     )
+    wrap_method(
+        PluggableAuthService,
+        '_doAddUsers',
+        _doAddUsers,
+        add=True
+    )
     wrap_method(
         PluggableAuthService,
         '_doChangeGroup',
@@ -559,18 +1110,82 @@ def patch_pas():
         add=True,
         roles=PermissionRole(ManageUsers, ('Manager',))
     )
+    wrap_method(
+        PluggableAuthService,
+        '_findUser',
+        _findUser
+    )
+    wrap_method(
+        PluggableAuthService,
+        '_findUsers',
+        _findUsers,
+        add=True
+    )
     wrap_method(
         PluggableAuthService,
         '_getLocalRolesForDisplay',
         _getLocalRolesForDisplay,
         add=True
     )
+    wrap_method(
+        PluggableAuthService,
+        '_getLoginPluginHint',
+        _getLoginPluginHint,
+        add=True
+    )
+    wrap_method(
+        PluggableAuthService,
+        '_getUsersByIds',
+        _getUsersByIds,
+        add=True
+    )
+    wrap_method(
+        PluggableAuthService,
+        '_invalidateUnknownPrincipals',
+        _invalidateUnknownPrincipals,
+        add=True
+    )
+    wrap_method(
+        PluggableAuthService,
+        '_isUnknownPrincipal',
+        _isUnknownPrincipal,
+        add=True
+    )
+    wrap_method(
+        PluggableAuthService,
+        '_listPlugins',
+        _listPlugins,
+        add=True
+    )
+    wrap_method(
+        PluggableAuthService,
+        '_resolvePrincipals',
+        _resolvePrincipals,
+        add=True
+    )
+    wrap_method(
+        PluggableAuthService,
+        '_setLoginPluginHint',
+        _setLoginPluginHint,
+        add=True
+    )
+    wrap_method(
+        PluggableAuthService,
+        '_setUnknownPrincipal',
+        _setUnknownPrincipal,
+        add=True
+    )
     wrap_method(
         PluggableAuthService,
         '_updateGroup',
         _updateGroup,
         add=True
     )
+    wrap_method(
+        PluggableAuthService,
+        '_updateLoginName',
+        _updateLoginName
+    )
     wrap_method(
         PluggableAuthService,
         'addRole',
@@ -688,6 +1303,11 @@ def patch_pas():
         add=True,
         roles=PermissionRole(ManageUsers, ('Manager',))
     )
+    wrap_method(
+        PluggableAuthService,
+        'updateAllLoginNames',
+        updateAllLoginNames
+    )
     wrap_method(
         PluggableAuthService,
         'userFolderAddUser',
@@ -91,6 +91,12 @@ class AutoGroup(BasePlugin):
         self.group = group
         self.description = description
 
+    def _updateProperty(self, id, value):
+        BasePlugin._updateProperty(self, id, value)
+        # imported here, as the role module imports this one
+        from Products.PlonePAS.plugins.role import invalidateRolesCache
+        invalidateRolesCache(self)
+
     # IGroupEnumerationPlugin implementation
     def enumerateGroups(self, id=None, exact_match=False, sort_by=None,
                         max_results=None, **kw):
@@ -98,13 +104,17 @@ class AutoGroup(BasePlugin):
             return []
 
         if id:
-            id = id.lower()
+            if isinstance(id, basestring):
+                id = [id]
             mygroup = self.group.lower()
 
-            if exact_match and id != mygroup:
-                return []
-
-            if not exact_match and id not in mygroup:
+            for one_id in id:
+                one_id = one_id.lower()
+                if exact_match and one_id == mygroup:
+                    break
+                if not exact_match and one_id in mygroup:
+                    break
+            else:
                 return []
 
         return [{'id': self.group,
@@ -144,5 +154,8 @@ class AutoGroup(BasePlugin):
         else:
             return {}
 
+    def getPropertiesForUsers(self, users, request=None):
+        return [self.getPropertiesForUser(user, request) for user in users]
+
 
 InitializeClass(AutoGroup)
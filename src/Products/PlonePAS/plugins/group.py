@@ -5,6 +5,7 @@ management (ie. rw) capabilities.
 
 """
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
 from App.class_init import InitializeClass
 from App.special_dtml import DTMLFile
 from BTrees.OOBTree import OOBTree
@@ -13,13 +14,18 @@ from Products.PlonePAS.interfaces.capabilities import IDeleteCapability
 from Products.PlonePAS.interfaces.capabilities import IGroupCapability
 from Products.PlonePAS.interfaces.group import IGroupIntrospection
 from Products.PlonePAS.interfaces.group import IGroupManagement
+from Products.PlonePAS.interfaces.plugins import IIndexedPlugin
+from Products.PlonePAS.plugins.role import invalidateRolesCache
 from Products.PluggableAuthService.PluggableAuthService \
     import _SWALLOWABLE_PLUGIN_EXCEPTIONS
 from Products.PluggableAuthService.interfaces.plugins \
     import IGroupEnumerationPlugin
+from Products.PluggableAuthService.interfaces.plugins import IGroupsPlugin
 from Products.PluggableAuthService.interfaces.plugins \
     import IPropertiesPlugin
 from Products.PluggableAuthService.interfaces.plugins import IRolesPlugin
+from Products.PluggableAuthService.plugins.RecursiveGroupsPlugin import \
+    IRecursiveGroupsPlugin
 from Products.PluggableAuthService.plugins.ZODBGroupManager \
     import ZODBGroupManager
 from ufactory import PloneUser
@@ -47,17 +53,24 @@ def manage_addGroupManager(self, id, title='', RESPONSE=None):
     IGroupManagement,
     IGroupIntrospection,
     IGroupCapability,
-    IDeleteCapability
+    IDeleteCapability,
+    IIndexedPlugin
 )
 class GroupManager(ZODBGroupManager):
 
     meta_type = "Group Manager"
     security = ClassSecurityInfo()
 
+    # transitive closure of the memberships: group->all descendant
+    # principals, and principal->all ancestor groups to update the former
+    _principal_ancestors = None
+    _group_descendants = None
+
     def __init__(self, *args, **kw):
         ZODBGroupManager.__init__(self, *args, **kw)
         # reverse index of groups->principal
         self._group_principal_map = OOBTree()
+        self.rebuildIndexes()
 
     #################################
     # overrides to ease group principal lookups for introspection api
@@ -65,16 +78,27 @@ class GroupManager(ZODBGroupManager):
     def addGroup(self, group_id, *args, **kw):
         ZODBGroupManager.addGroup(self, group_id, *args, **kw)
         self._group_principal_map[group_id] = OOSet()
+        pas = self._getPAS()
+        if getattr(aq_base(pas), '_invalidateUnknownPrincipals',
+                   None) is not None:
+            pas._invalidateUnknownPrincipals([group_id])
         return True
 
     def removeGroup(self, group_id):
+        # a removed group is no longer a member of other groups
+        for parent_id in self._principal_groups.get(group_id, ()):
+            self.removePrincipalFromGroup(group_id, parent_id)
         ZODBGroupManager.removeGroup(self, group_id)
         del self._group_principal_map[group_id]
         return True
 
     def addPrincipalToGroup(self, principal_id, group_id):
-        ZODBGroupManager.addPrincipalToGroup(self, principal_id, group_id)
+        added = ZODBGroupManager.addPrincipalToGroup(self, principal_id,
+                                                     group_id)
         self._group_principal_map[group_id].insert(principal_id)
+        if added:
+            self._indexMembership(principal_id, group_id)
+            invalidateRolesCache(self)
         return True
 
     def removePrincipalFromGroup(self, principal_id, group_id):
@@ -82,8 +106,104 @@ class GroupManager(ZODBGroupManager):
                                                             group_id)
         if already:
             self._group_principal_map[group_id].remove(principal_id)
+            self._unindexMembership(principal_id, group_id)
+            invalidateRolesCache(self)
         return True
 
+    #################################
+    # transitive closure of the memberships
+
+    @security.private
+    def rebuildIndexes(self):
+        """Compute the transitive closure of all memberships from scratch.
+        """
+        self._principal_ancestors = OOBTree()
+        self._group_descendants = OOBTree()
+        self._reindexClosure(self._principal_groups.keys(),
+                             self._group_principal_map.keys())
+
+    def _walkClosure(self, principal_id, edges):
+        """Return all principals reachable from principal_id in edges,
+        a mapping of principal -> principals. Cycles are allowed.
+        """
+        found = set()
+        todo = [principal_id]
+        while todo:
+            for next_id in edges.get(todo.pop(), ()):
+                if next_id not in found:
+                    found.add(next_id)
+                    todo.append(next_id)
+        found.discard(principal_id)
+        return found
+
+    def _reindexClosure(self, principal_ids, group_ids):
+        """Recompute the ancestors of principal_ids and the descendants of
+        group_ids from the direct memberships.
+        """
+        for index, ids, edges in (
+                (self._principal_ancestors, principal_ids,
+                 self._principal_groups),
+                (self._group_descendants, group_ids,
+                 self._group_principal_map)):
+            for principal_id in ids:
+                related = self._walkClosure(principal_id, edges)
+                if related:
+                    index[principal_id] = OOSet(related)
+                elif principal_id in index:
+                    del index[principal_id]
+
+    def _indexMembership(self, principal_id, group_id):
+        ancestors = self._principal_ancestors
+        descendants = self._group_descendants
+        if ancestors is None:
+            return
+
+        if principal_id == group_id or \
+                principal_id in ancestors.get(group_id, ()):
+            # the new membership closes a cycle, everything below
+            # principal_id gains ancestors, everything above group_id gains
+            # descendants.
+            self._reindexClosure(
+                self._walkClosure(principal_id, self._group_principal_map)
+                | set([principal_id]),
+                self._walkClosure(group_id, self._principal_groups)
+                | set([group_id]))
+            return
+
+        groups = [group_id] + list(ancestors.get(group_id, ()))
+        members = [principal_id] + list(descendants.get(principal_id, ()))
+        for member_id in members:
+            if member_id not in ancestors:
+                ancestors[member_id] = OOSet()
+            ancestors[member_id].update(groups)
+        for member_group_id in groups:
+            if member_group_id not in descendants:
+                descendants[member_group_id] = OOSet()
+            descendants[member_group_id].update(members)
+
+    def _unindexMembership(self, principal_id, group_id):
+        ancestors = self._principal_ancestors
+        descendants = self._group_descendants
+        if ancestors is None:
+            return
+
+        # the closure still contains the removed membership, so it gives
+        # all principals that may be affected.
+        self._reindexClosure(
+            [principal_id] + list(descendants.get(principal_id, ())),
+            [group_id] + list(ancestors.get(group_id, ())))
+
+    @security.private
+    def getTransitiveGroupMembers(self, group_id):
+        """Return the ids of all principals in group_id, directly or through
+        other groups of this plugin.
+        """
+        descendants = self._group_descendants
+        if descendants is None:
+            return tuple(self._walkClosure(group_id,
+                                           self._group_principal_map))
+        return tuple(descendants.get(group_id, ()))
+
     #################################
     # overrides for api matching/massage
 
@@ -251,15 +371,26 @@ class PloneGroup(PloneUser):
     def getMemberIds(self, transitive=1):
         """Return member ids of this group, including or not
         transitive groups.
+
+        Members of nested groups are only included while the recursive
+        groups plugin is active, as PAS only counts them then.
         """
         # acquired from the groups_source
         plugins = self._getPAS().plugins
+        if transitive:
+            transitive = [plugin for plugin_id, plugin
+                          in plugins.listPlugins(IGroupsPlugin)
+                          if IRecursiveGroupsPlugin.providedBy(plugin)]
         introspectors = plugins.listPlugins(IGroupIntrospection)
         members = []
         for iid, introspector in introspectors:
+            if transitive and getattr(aq_base(introspector),
+                                      'getTransitiveGroupMembers', None):
+                getGroupMembers = introspector.getTransitiveGroupMembers
+            else:
+                getGroupMembers = introspector.getGroupMembers
             try:
-                members.extend(
-                    list(introspector.getGroupMembers(self.getId())))
+                members.extend(list(getGroupMembers(self.getId())))
             except _SWALLOWABLE_PLUGIN_EXCEPTIONS:
                 logger.info(
                     'PluggableAuthService: getGroupMembers %s error',
@@ -7,15 +7,153 @@ roles from their containment structure.
 
 """
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
+from Acquisition import aq_get
 from Acquisition import aq_inner
 from Acquisition import aq_parent
 from App.class_init import InitializeClass
 from App.special_dtml import DTMLFile
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOSet
+from Products.CMFCore.interfaces import IContentish
+from Products.PlonePAS.config import LOCAL_ROLES_CACHE_SIZE
 from Products.PlonePAS.interfaces.plugins import ILocalRolesPlugin
+from Products.PlonePAS.utils import LRUCache
+from Products.PlonePAS.utils import getPrincipalIds
 from Products.PluggableAuthService.plugins.LocalRolePlugin \
     import LocalRolePlugin
+from zope.annotation.interfaces import IAnnotations
 from zope.interface import implementer
 
+# request annotation holding the local roles computed during the request
+CACHE_KEY = 'Products.PlonePAS.plugins.local_role'
+
+
+def _getRequestCache(context):
+    request = aq_get(context, 'REQUEST', None)
+    annotations = IAnnotations(request, None)
+    if annotations is None or not LOCAL_ROLES_CACHE_SIZE:
+        return None
+    cache = annotations.get(CACHE_KEY)
+    if cache is None:
+        cache = annotations[CACHE_KEY] = LRUCache(LOCAL_ROLES_CACHE_SIZE)
+    return cache
+
+
+def invalidateLocalRolesCache(event):
+    """Forget the local roles computed during the current request, as
+    the local roles of event.object changed, or it was added, moved or
+    removed and the local roles known for its path may be wrong.
+    """
+    request = aq_get(event.object, 'REQUEST', None)
+    annotations = IAnnotations(request, None)
+    if annotations is not None:
+        annotations.pop(CACHE_KEY, None)
+
+
+def _containmentChain(object):
+    """Yield object and its containers, up to the root or to the first
+    object blocking the acquisition of local roles.
+    """
+    object = aq_inner(object)
+    while 1:
+        yield object
+
+        inner = aq_inner(object)
+        parent = aq_parent(inner)
+
+        if getattr(object, '__ac_local_roles_block__', None):
+            break
+
+        if parent is not None:
+            object = parent
+            continue
+
+        new = getattr(object, 'im_self', None)
+
+        if new is not None:
+            object = aq_inner(new)
+            continue
+
+        break
+
+
+def _getLocalRoles(object):
+    """Return the local roles stored on object itself, not acquired."""
+    if getattr(aq_base(object), '__ac_local_roles__', None) is None:
+        return {}
+    local_roles = getattr(object, '__ac_local_roles__', None)
+    if local_roles and callable(local_roles):
+        local_roles = local_roles()
+    return local_roles or {}
+
+
+def _walk(object):
+    """Yield object and all content it contains, leaving out tools, skins
+    and other objects which are no content.
+    """
+    yield object
+    contentValues = getattr(aq_base(object), 'contentValues', None)
+    if contentValues is None:
+        return
+    for child in object.contentValues():
+        if not IContentish.providedBy(child):
+            continue
+        for sub in _walk(child):
+            yield sub
+
+
+def _indexingPlugins(context):
+    """Return the local roles plugins in the user folder of context that
+    keep a local roles index.
+    """
+    acl_users = aq_get(context, 'acl_users', None)
+    listPlugins = getattr(acl_users, '_listPlugins', None)
+    if listPlugins is None:
+        return []
+    return [plugin for plugin_id, plugin in listPlugins(ILocalRolesPlugin)
+            if getattr(plugin, '_principal_index', None) is not None]
+
+
+def indexLocalRoles(event):
+    """Update the local roles index for event.object, if it is content or
+    the site.
+    """
+    object = event.object
+    for plugin in _indexingPlugins(object):
+        if IContentish.providedBy(object) or \
+                aq_base(object) is aq_base(plugin._getSite()):
+            plugin._indexObject(object)
+
+
+def unindexPrincipal(context, principal_id):
+    """Drop the deleted principal_id from the local roles indexes of the
+    user folder of context.
+    """
+    for plugin in _indexingPlugins(context):
+        plugin._unindexPrincipalPaths(principal_id)
+
+
+def reindexMovedLocalRoles(object, event):
+    """Move the entries of object and its contents in the local roles
+    index along with object, or drop them when it is removed.
+    """
+    if event.object is not object:
+        # dispatched again for every object contained in event.object
+        return
+
+    if event.oldParent is not None:
+        path = '/'.join(event.oldParent.getPhysicalPath() + (event.oldName,))
+        for plugin in _indexingPlugins(event.oldParent):
+            plugin._unindexPath(path, subtree=True)
+
+    if event.newParent is not None:
+        plugins = _indexingPlugins(object)
+        if plugins:
+            for sub in _walk(object):
+                for plugin in plugins:
+                    plugin._indexObject(sub)
+
 
 def manage_addLocalRolesManager(dispatcher, id, title=None, RESPONSE=None):
     """
@@ -40,149 +178,245 @@ class LocalRolesManager(LocalRolePlugin):
     meta_type = "Local Roles Manager"
     security = ClassSecurityInfo()
 
+    # principal id -> path -> local roles, see rebuildLocalRolesIndex
+    _principal_index = None
+    # path -> principal ids with local roles on the object at that path
+    _path_index = None
+
     def __init__(self, id, title=None):
         self._id = self.id = id
         self.title = title
 
-    # security.declarePrivate( 'getRolesInContext' )
-    def getRolesInContext(self, user, object):
-        user_id = user.getId()
-        group_ids = user.getGroups()
-
-        principal_ids = list(group_ids)
-        principal_ids.insert(0, user_id)
+    def _getLocalRolesInChain(self, object, principal_ids):
+        """Return the local roles principal_ids have on object, merged over
+        its containment chain.
+
+        The result for every container on the way is remembered for the
+        rest of the request, keyed by its physical path and the principals.
+        Siblings and children looked up later stop walking at the first
+        container that is already known.
+        """
+        cache = _getRequestCache(self)
+        principals = frozenset(principal_ids)
+        chain = []
+        merged = frozenset()
+
+        for object in _containmentChain(object):
+            key = None
+            if cache is not None:
+                getPhysicalPath = getattr(object, 'getPhysicalPath', None)
+                if getPhysicalPath is not None:
+                    key = (getPhysicalPath(), principals)
+                    cached = cache.get(key)
+                    if cached is not None:
+                        merged = cached
+                        break
 
-        local = {}
-        object = aq_inner(object)
-
-        while 1:
             local_roles = getattr(object, '__ac_local_roles__', None)
 
             if local_roles and callable(local_roles):
                 local_roles = local_roles()
 
+            roles = set()
             if local_roles:
-                dict = local_roles
-
-                for principal_id in principal_ids:
-                    for role in dict.get(principal_id, []):
-                        local[role] = 1
+                for principal_id in principals:
+                    roles.update(local_roles.get(principal_id, []))
+            chain.append((key, roles))
 
-            inner = aq_inner(object)
-            parent = aq_parent(inner)
+        for key, roles in reversed(chain):
+            merged = merged.union(roles)
+            if key is not None:
+                cache.set(key, merged)
 
-            if getattr(object, '__ac_local_roles_block__', None):
-                break
+        return merged
 
-            if parent is not None:
-                object = parent
-                continue
-
-            new = getattr(object, 'im_self', None)
-
-            if new is not None:
-                object = aq_inner(new)
-                continue
-
-            break
-
-        return local.keys()
+    # security.declarePrivate( 'getRolesInContext' )
+    def getRolesInContext(self, user, object):
+        return list(
+            self._getLocalRolesInChain(object, getPrincipalIds(user)))
 
     # security.declarePrivate('checkLocalRolesAllowed')
     def checkLocalRolesAllowed(self, user, object, object_roles):
-        # Still have not found a match, so check local roles. We do
-        # this manually rather than call getRolesInContext so that
-        # we can incur only the overhead required to find a match.
-        inner_obj = aq_inner(object)
-        user_id = user.getId()
-        group_ids = user.getGroups()
-
-        principal_ids = list(group_ids)
-        principal_ids.insert(0, user_id)
-
-        while 1:
-
-            local_roles = getattr(inner_obj, '__ac_local_roles__', None)
-
-            if local_roles and callable(local_roles):
-                local_roles = local_roles()
-
-            if local_roles:
-                dict = local_roles
-
-                for principal_id in principal_ids:
-                    local_roles = dict.get(principal_id, [])
-
-                    # local_roles is empty most of the time, where as
-                    # object_roles is usually not.
-                    if not local_roles:
-                        continue
-
-                    for role in object_roles:
-                        if role in local_roles:
-                            if user._check_context(object):
-                                return 1
-                            return 0
-
-            inner = aq_inner(inner_obj)
-            parent = aq_parent(inner)
-
-            if getattr(inner_obj, '__ac_local_roles_block__', None):
-                break
-
-            if parent is not None:
-                inner_obj = parent
-                continue
-
-            new = getattr(inner_obj, 'im_self', None)
-
-            if new is not None:
-                inner_obj = aq_inner(new)
-                continue
-
-            break
+        # Still have not found a match, so check local roles. The local
+        # roles of the containers are shared by all checks of the request.
+        local_roles = self._getLocalRolesInChain(object,
+                                                 getPrincipalIds(user))
+        if not local_roles:
+            return None
+
+        for role in object_roles:
+            if role in local_roles:
+                if user._check_context(object):
+                    return 1
+                return 0
 
         return None
 
-    def getAllLocalRolesInContext(self, context):
-        roles = {}
-        object = aq_inner(context)
-
-        while True:
+    def _getSite(self):
+        return aq_parent(aq_parent(aq_inner(self)))
+
+    @security.private
+    def rebuildLocalRolesIndex(self):
+        """Index the local roles of the site and all its content.
+
+        From then on the index is kept up to date by event subscribers, and
+        getLocalRolesForPrincipal no longer walks the site. Return the
+        number of indexed objects.
+        """
+        self._principal_index = OOBTree()
+        self._path_index = OOBTree()
+        for object in _walk(self._getSite()):
+            self._indexObject(object)
+        return len(self._path_index)
+
+    @security.private
+    def removeLocalRolesIndex(self):
+        """Stop maintaining the local roles index."""
+        self._principal_index = None
+        self._path_index = None
+
+    @security.private
+    def hasLocalRolesIndex(self):
+        return self._principal_index is not None
+
+    def _indexObject(self, object):
+        path = '/'.join(object.getPhysicalPath())
+        local_roles = {}
+        for principal_id, roles in _getLocalRoles(object).items():
+            if roles:
+                local_roles[principal_id] = tuple(roles)
+
+        for principal_id in list(self._path_index.get(path, ())):
+            if principal_id not in local_roles:
+                self._unindexPrincipal(principal_id, path)
+
+        if not local_roles:
+            if path in self._path_index:
+                del self._path_index[path]
+            return
+
+        principals = self._path_index.get(path)
+        if principals is None:
+            principals = self._path_index[path] = OOSet()
+        for principal_id, roles in local_roles.items():
+            paths = self._principal_index.get(principal_id)
+            if paths is None:
+                paths = self._principal_index[principal_id] = OOBTree()
+            if paths.get(path) != roles:
+                paths[path] = roles
+            principals.insert(principal_id)
+
+    def _unindexPrincipal(self, principal_id, path):
+        paths = self._principal_index.get(principal_id)
+        if paths is None:
+            return
+        if path in paths:
+            del paths[path]
+        if not paths:
+            del self._principal_index[principal_id]
+        principals = self._path_index.get(path)
+        if principals is not None:
+            principals.remove(principal_id)
+
+    def _unindexPrincipalPaths(self, principal_id):
+        paths = self._principal_index.get(principal_id)
+        if paths is None:
+            return
+        for path in list(paths.keys()):
+            self._unindexPrincipal(principal_id, path)
+            principals = self._path_index.get(path)
+            if principals is not None and not principals:
+                del self._path_index[path]
+
+    def _unindexPath(self, path, subtree=False):
+        paths = [path]
+        if subtree:
+            # '0' directly follows '/'
+            paths.extend(self._path_index.keys(
+                min=path + '/', max=path + '0', excludemax=True))
+        for path in paths:
+            for principal_id in list(self._path_index.get(path, ())):
+                self._unindexPrincipal(principal_id, path)
+            if path in self._path_index:
+                del self._path_index[path]
+
+    @security.private
+    def getLocalRolesForPrincipal(self, principal_id, path=None):
+        """Return a mapping of the paths of all objects on which
+        principal_id has local roles to these roles.
+
+        Only objects at path or below are included if path is given.
+        Without the local roles index this walks all these objects.
+        """
+        if path is None:
+            path = '/'.join(self._getSite().getPhysicalPath())
+
+        if self._principal_index is None:
+            result = {}
+            root = self._getSite().unrestrictedTraverse(path)
+            for object in _walk(root):
+                roles = _getLocalRoles(object).get(principal_id)
+                if roles:
+                    result['/'.join(object.getPhysicalPath())] = tuple(roles)
+            return result
+
+        paths = self._principal_index.get(principal_id)
+        if paths is None:
+            return {}
+        result = dict(paths.items(min=path + '/', max=path + '0',
+                                  excludemax=True))
+        if path in paths:
+            result[path] = paths[path]
+        return result
+
+    def _getAllLocalRolesInChain(self, context):
+        """Return the local roles of all principals on context, merged over
+        its containment chain, as a mapping of principal ids to frozensets.
+
+        Like _getLocalRolesInChain the merged map of every container is
+        remembered for the rest of the request, so reindexing the security
+        of many objects in one folder only looks at the local roles of each
+        object itself. Objects without local roles share the map of their
+        container. The result must not be changed.
+        """
+        cache = _getRequestCache(self)
+        chain = []
+        merged = {}
+
+        for object in _containmentChain(context):
+            key = None
+            if cache is not None:
+                getPhysicalPath = getattr(object, 'getPhysicalPath', None)
+                if getPhysicalPath is not None:
+                    key = (getPhysicalPath(), None)
+                    cached = cache.get(key)
+                    if cached is not None:
+                        merged = cached
+                        break
 
             local_roles = getattr(object, '__ac_local_roles__', None)
 
             if local_roles and callable(local_roles):
                 local_roles = local_roles()
 
-            if local_roles:
-
-                dict = local_roles
+            chain.append((key, local_roles))
 
-                for principal, localroles in dict.items():
-                    if principal not in roles:
-                        roles[principal] = set()
-
-                    roles[principal].update(localroles)
-
-            inner = aq_inner(object)
-            parent = aq_parent(inner)
-
-            if getattr(object, '__ac_local_roles_block__', None):
-                break
-
-            if parent is not None:
-                object = parent
-                continue
-
-            new = getattr(object, 'im_self', None)
-
-            if new is not None:
-                object = aq_inner(new)
-                continue
+        for key, local_roles in reversed(chain):
+            if local_roles:
+                merged = merged.copy()
+                for principal, localroles in local_roles.items():
+                    merged[principal] = merged.get(
+                        principal, frozenset()).union(localroles)
+            if key is not None:
+                cache.set(key, merged)
 
-            break
+        return merged
 
+    def getAllLocalRolesInContext(self, context):
+        roles = {}
+        for principal, localroles in \
+                self._getAllLocalRolesInChain(context).items():
+            roles[principal] = set(localroles)
         return roles
 
 InitializeClass(LocalRolesManager)
@@ -3,23 +3,35 @@
 Mutable Property Provider
 """
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
 from App.class_init import InitializeClass
 from App.special_dtml import DTMLFile
+from DateTime import DateTime
+from DateTime.interfaces import DateTimeError
+from BTrees.LOBTree import LOBTree
+from BTrees.OLBTree import OLBTree
 from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOSet
+from BTrees.OOBTree import OOTreeSet
+from BTrees.OOBTree import intersection
+from BTrees.OOBTree import union
 from Products.CMFCore.utils import getToolByName
+from Products.PlonePAS.interfaces.plugins import IIndexedPlugin
 from Products.PlonePAS.interfaces.plugins import IMutablePropertiesPlugin
 from Products.PlonePAS.sheet import MutablePropertySheet
-from Products.PlonePAS.sheet import validateValue
+from Products.PlonePAS.sheet import PropertySchema
 from Products.PlonePAS.utils import safe_unicode
 from Products.PluggableAuthService.UserPropertySheet import _guessSchema
 from Products.PluggableAuthService.interfaces.plugins import IPropertiesPlugin
 from Products.PluggableAuthService.interfaces.plugins \
     import IUserEnumerationPlugin
 from Products.PluggableAuthService.plugins.BasePlugin import BasePlugin
+from ZODB.POSException import ConflictError
 from ZODB.PersistentMapping import PersistentMapping
 from zope.i18nmessageid import MessageFactory
 from zope.interface import implementer
 import copy
+import math
 
 _ = MessageFactory('plone')
 
@@ -43,10 +55,65 @@ def isStringType(data):
     return isinstance(data, str) or isinstance(data, unicode)
 
 
+# length of the substrings kept in the substring index
+NGRAM_SIZE = 3
+
+
+def _ngrams(value, size=NGRAM_SIZE):
+    return set(value[i:i + size] for i in range(len(value) - size + 1))
+
+
+def _normalize(value):
+    return safe_unicode(value.lower())
+
+
+# length in seconds of the ranges the date indexes group values in.
+# Logins store the current time, so indexing every second would make all
+# concurrent logins insert keys at the end of the same index bucket and
+# conflict. Within a range only the postings of one key change, and a
+# member logging in again within the same range doesn't touch the index
+# at all. Changing it requires rebuilding the indexes.
+DATE_INDEX_RESOLUTION = 3600
+
+# what a member without a (string) date is considered to have, see
+# MembershipTool.searchForMembers
+DEFAULT_DATE = '2000/01/01'
+
+
+def _toDateTime(value):
+    if isStringType(value):
+        return DateTime(value or DEFAULT_DATE)
+    return value
+
+
+def _dateKey(value):
+    """Return the start in epoch seconds of the DATE_INDEX_RESOLUTION range
+    a date property value lies in, or None if it is no date.
+    """
+    try:
+        value = _toDateTime(value)
+    except DateTimeError:
+        return None
+    if not isinstance(value, DateTime):
+        return None
+    seconds = int(math.floor(value.timeTime()))
+    return seconds - seconds % DATE_INDEX_RESOLUTION
+
+
+def _dateInRange(value, min=None, max=None):
+    value = _toDateTime(value)
+    if min is not None and value < min:
+        return False
+    if max is not None and value >= max:
+        return False
+    return True
+
+
 @implementer(
     IPropertiesPlugin,
     IUserEnumerationPlugin,
-    IMutablePropertiesPlugin
+    IMutablePropertiesPlugin,
+    IIndexedPlugin
 )
 class ZODBMutablePropertyProvider(BasePlugin):
     """Storage for mutable properties in the ZODB for users/groups.
@@ -58,6 +125,31 @@ class ZODBMutablePropertyProvider(BasePlugin):
 
     security = ClassSecurityInfo()
 
+    # Properties for which secondary indexes are kept, so enumerateUsers
+    # does not need to load every record to search on them.
+    indexed_properties = ('fullname', 'email')
+
+    # normalized value -> user ids, per property
+    _value_index = None
+    # substring of NGRAM_SIZE characters -> user ids, per property
+    _ngram_index = None
+    # user ids having a value which is not a string, per property
+    _unindexed = None
+
+    # Date properties for which sorted indexes are kept, so members can
+    # be searched by date range.
+    date_properties = ('login_time', 'last_login_time')
+
+    # start of a DATE_INDEX_RESOLUTION range -> user ids, per property
+    _date_index = None
+    # user id -> start of the range, per property
+    _date_keys = None
+    # user ids having a value which is not a date, per property
+    _date_unindexed = None
+
+    # datatool id -> (property map version, schema, default values)
+    _v_datatool_properties = None
+
     def __init__(self, id, title='', schema=None, **kw):
         """Create in-ZODB mutable property provider.
 
@@ -91,57 +183,75 @@ class ZODBMutablePropertyProvider(BasePlugin):
                 defaultvalues[name] = value
         self._schema = tuple(schema)
         self._defaultvalues = defaultvalues
+        self.rebuildIndexes()
 
     def _getSchema(self, isgroup=None):
-        # this could probably stand to be cached
-        datatool = isgroup and "portal_groupdata" or "portal_memberdata"
-
         schema = self._schema
         if not schema:
             # if no schema is provided, use portal_memberdata properties
-            schema = ()
-            mdtool = getToolByName(self, datatool, None)
-            # Don't fail badly if tool is not available.
-            if mdtool is not None:
-                mdschema = mdtool.propertyMap()
-                schema = [(elt['id'], elt['type']) for elt in mdschema]
+            schema = self._getDataToolProperties(isgroup)[0]
         return schema
 
     def _getDefaultValues(self, isgroup=None):
         """Returns a dictionary mapping of property names to default values.
         Defaults to portal_*data tool if necessary.
-        """
-        datatool = isgroup and "portal_groupdata" or "portal_memberdata"
 
+        The mapping and its values are shared, callers must not modify
+        them and must copy mutable values they hand out.
+        """
         defaultvalues = self._defaultvalues
         if not self._schema:
             # if no schema is provided, use portal_*data properties
-            defaultvalues = {}
-            mdtool = getToolByName(self, datatool, None)
-            # Don't fail badly if tool is not available.
-            if mdtool is not None:
-                # we rely on propertyMap and propertyItems mapping
-                mdvalues = mdtool.propertyItems()
-                for name, value in mdvalues:
-                    # For selection types the default value is the name of a
-                    # method which returns the possible values. There is no way
-                    # to set a default value for those types.
-                    ptype = mdtool.getPropertyType(name)
-                    if ptype == "selection":
-                        defaultvalues[name] = ""
-                    elif ptype == "multiple selection":
-                        defaultvalues[name] = []
-                    else:
-                        defaultvalues[name] = value
-
-            # ALERT! if someone gives their *_data tool a title, and want a
-            #        title as a property of the user/group (and groups do by
-            #        default) we don't want them all to have this title, since
-            #        a title is used in the UI if it exists
-            if defaultvalues.get("title"):
-                defaultvalues["title"] = ""
+            defaultvalues = self._getDataToolProperties(isgroup)[1]
         return defaultvalues
 
+    def _getDataToolProperties(self, isgroup=None):
+        """Returns the schema and the default values defined by the
+        portal_*data tool.
+
+        They are cached until the properties of the tool change.
+        """
+        datatool = isgroup and "portal_groupdata" or "portal_memberdata"
+        mdtool = getToolByName(self, datatool, None)
+        # Don't fail badly if tool is not available.
+        if mdtool is None:
+            return (), {}
+
+        version = getattr(aq_base(mdtool), '_property_map_version', None)
+        cache = self._v_datatool_properties
+        if cache is None:
+            cache = self._v_datatool_properties = {}
+        cached = cache.get(datatool)
+        if version is not None and cached is not None \
+                and cached[0] == version:
+            return cached[1:]
+
+        # we rely on propertyMap and propertyItems mapping
+        schema = [(elt['id'], elt['type']) for elt in mdtool.propertyMap()]
+        defaultvalues = {}
+        for name, value in mdtool.propertyItems():
+            # For selection types the default value is the name of a
+            # method which returns the possible values. There is no way
+            # to set a default value for those types.
+            ptype = mdtool.getPropertyType(name)
+            if ptype == "selection":
+                defaultvalues[name] = ""
+            elif ptype == "multiple selection":
+                defaultvalues[name] = []
+            else:
+                defaultvalues[name] = value
+
+        # ALERT! if someone gives their *_data tool a title, and want a
+        #        title as a property of the user/group (and groups do by
+        #        default) we don't want them all to have this title, since
+        #        a title is used in the UI if it exists
+        if defaultvalues.get("title"):
+            defaultvalues["title"] = ""
+
+        if version is not None:
+            cache[datatool] = (version, schema, defaultvalues)
+        return schema, defaultvalues
+
     @security.private
     def getPropertiesForUser(self, user, request=None):
         """Get property values for a user or group.
@@ -152,20 +262,38 @@ class ZODBMutablePropertyProvider(BasePlugin):
         NOTE: Must always return something, or else the property sheet
         won't get created and this will screw up portal_memberdata.
         """
-        isGroup = getattr(user, 'isGroup', lambda: None)()
-
-        data = self._storage.get(user.getId())
-        defaults = self._getDefaultValues(isGroup)
+        return self.getPropertiesForUsers([user], request)[0]
 
-        # provide default values where missing
-        if not data:
-            data = {}
-        for key, val in defaults.items():
-            if key not in data:
-                data[key] = val
+    @security.private
+    def getPropertiesForUsers(self, users, request=None):
+        """Get property values for several users or groups at once.
 
-        return MutablePropertySheet(self.id,
-                                    schema=self._getSchema(isGroup), **data)
+        Returns a list of MutablePropertySheets, in the order of users.
+        The schema and default values are looked up once per kind of
+        principal instead of once per principal.
+        """
+        schemas = {}
+        storage = self._storage
+        sheets = []
+        for user in users:
+            isGroup = getattr(user, 'isGroup', lambda: None)()
+            if isGroup not in schemas:
+                defaults = self._getDefaultValues(isGroup)
+                mutable = [name for name, value in defaults.items()
+                           if isinstance(value, (list, dict))]
+                schemas[isGroup] = (self._getSchema(isGroup), defaults,
+                                    mutable)
+            schema, defaults, mutable = schemas[isGroup]
+
+            # provide default values where missing, without touching the
+            # stored record or sharing mutable defaults between sheets
+            data = dict(defaults)
+            for name in mutable:
+                data[name] = copy.copy(data[name])
+            data.update(storage.get(user.getId()) or {})
+
+            sheets.append(MutablePropertySheet(self.id, schema=schema, **data))
+        return sheets
 
     @security.private
     def setPropertiesForUser(self, user, propertysheet):
@@ -176,19 +304,15 @@ class ZODBMutablePropertyProvider(BasePlugin):
 
         properties = dict(propertysheet.propertyItems())
 
-        for name, property_type in self._getSchema(isGroup) or ():
-            if (
-                name in properties and not
-                validateValue(property_type, properties[name])
-            ):
-                raise ValueError(
-                    'Invalid value: %s does not conform to %s' %
-                    (name, property_type)
-                )
-
-        allowed_prop_keys = [pn for pn, pt in self._getSchema(isGroup) or ()]
-        if allowed_prop_keys:
-            prop_names = set(properties.keys()) - set(allowed_prop_keys)
+        schema = self._getSchema(isGroup) or ()
+        invalid = PropertySchema.validateProperties(schema, properties)
+        if invalid is not None:
+            raise ValueError(
+                'Invalid value: %s does not conform to %s' % invalid)
+
+        if schema:
+            prop_names = set(properties.keys()) - \
+                set(PropertySchema.compileSchema(schema))
             if prop_names:
                 raise ValueError('Unknown Properties: %r' % prop_names)
 
@@ -196,11 +320,24 @@ class ZODBMutablePropertyProvider(BasePlugin):
         userprops = self._storage.get(userid)
         properties.update({'isGroup': isGroup})
         if userprops is not None:
+            properties = dict(
+                (name, value) for name, value in properties.items()
+                if not _same(userprops.get(name, _marker), value))
+            if not properties:
+                # nothing changed, don't write the record
+                return
+            old = dict(userprops)
+            if not isinstance(userprops, PersistentProperties):
+                # migrate records stored as plain dicts
+                userprops = PersistentProperties(userprops)
+                self._storage[userid] = userprops
+            # the record is persistent by itself, the bucket holding it
+            # is left alone
             userprops.update(properties)
-            # notify persistence machinery of change
-            self._storage[userid] = self._storage[userid]
+            self._indexRecord(userid, userprops, old)
         else:
-            self._storage.insert(user.getId(), properties)
+            self._storage.insert(userid, PersistentProperties(properties))
+            self._indexRecord(userid, properties)
 
     @security.private
     def deleteUser(self, user_id):
@@ -208,9 +345,264 @@ class ZODBMutablePropertyProvider(BasePlugin):
         """
         # Do nothing if an unknown user_id is given
         try:
+            data = self._storage[user_id]
             del self._storage[user_id]
         except KeyError:
             pass
+        else:
+            self._indexRecord(user_id, {}, data)
+
+    @security.private
+    def migrateRecords(self):
+        """Convert records stored as plain dicts to PersistentProperties.
+
+        Records are also converted one by one as they are changed.
+        Returns the number of converted records.
+        """
+        count = 0
+        for user_id, data in self._storage.items():
+            if not isinstance(data, PersistentProperties):
+                self._storage[user_id] = PersistentProperties(data)
+                count += 1
+        return count
+
+    #################################
+    # secondary indexes
+
+    @security.private
+    def rebuildIndexes(self):
+        """(Re)build the secondary indexes from the stored records.
+        """
+        self._value_index = OOBTree()
+        self._ngram_index = OOBTree()
+        self._unindexed = OOBTree()
+        self._date_index = OOBTree()
+        self._date_keys = OOBTree()
+        self._date_unindexed = OOBTree()
+        for user_id, data in self._storage.items():
+            self._indexRecord(user_id, data)
+
+    def _indexRecord(self, user_id, data, old=None):
+        """Update the indexes for a record changing from old to data.
+        """
+        if old is None:
+            old = {}
+        if self._value_index is not None:
+            for name in self.indexed_properties:
+                old_value = None
+                if not old.get('isGroup', False):
+                    old_value = old.get(name)
+                value = None
+                if not data.get('isGroup', False):
+                    value = data.get(name)
+                if old_value == value and type(old_value) is type(value):
+                    continue
+                self._unindexValue(name, user_id, old_value)
+                self._indexValue(name, user_id, value)
+        if self._date_index is not None:
+            for name in self.date_properties:
+                old_value = None
+                if not old.get('isGroup', False):
+                    old_value = old.get(name)
+                value = None
+                if not data.get('isGroup', False):
+                    value = data.get(name)
+                if old_value == value and type(old_value) is type(value):
+                    continue
+                if old_value is not None and value is not None:
+                    key = _dateKey(value)
+                    if key is not None and key == _dateKey(old_value):
+                        continue
+                self._unindexDate(name, user_id)
+                self._indexDate(name, user_id, value)
+
+    def _indexValue(self, name, user_id, value):
+        if value is None:
+            return
+        if not isStringType(value):
+            unindexed = self._unindexed.get(name)
+            if unindexed is None:
+                unindexed = self._unindexed[name] = OOSet()
+            unindexed.insert(user_id)
+            return
+        value = _normalize(value)
+        values = self._value_index.get(name)
+        if values is None:
+            values = self._value_index[name] = OOBTree()
+        ngrams = self._ngram_index.get(name)
+        if ngrams is None:
+            ngrams = self._ngram_index[name] = OOBTree()
+        for tree, key in [(values, value)] + \
+                [(ngrams, ngram) for ngram in _ngrams(value)]:
+            postings = tree.get(key)
+            if postings is None:
+                postings = tree[key] = OOSet()
+            postings.insert(user_id)
+
+    def _unindexValue(self, name, user_id, value):
+        if value is None:
+            return
+        if not isStringType(value):
+            unindexed = self._unindexed.get(name)
+            if unindexed is not None and user_id in unindexed:
+                unindexed.remove(user_id)
+            return
+        value = _normalize(value)
+        values = self._value_index.get(name, {})
+        ngrams = self._ngram_index.get(name, {})
+        for tree, key in [(values, value)] + \
+                [(ngrams, ngram) for ngram in _ngrams(value)]:
+            postings = tree.get(key)
+            if postings is None or user_id not in postings:
+                continue
+            postings.remove(user_id)
+            if not postings:
+                del tree[key]
+
+    def _indexDate(self, name, user_id, value):
+        if value is None:
+            return
+        key = _dateKey(value)
+        if key is None:
+            unindexed = self._date_unindexed.get(name)
+            if unindexed is None:
+                unindexed = self._date_unindexed[name] = OOSet()
+            unindexed.insert(user_id)
+            return
+
+        dates = self._date_index.get(name)
+        if dates is None:
+            dates = self._date_index[name] = LOBTree()
+        keys = self._date_keys.get(name)
+        if keys is None:
+            keys = self._date_keys[name] = OLBTree()
+        postings = dates.get(key)
+        if postings is None:
+            postings = dates[key] = OOTreeSet()
+        postings.insert(user_id)
+        keys[user_id] = key
+
+    def _unindexDate(self, name, user_id):
+        unindexed = self._date_unindexed.get(name)
+        if unindexed is not None and user_id in unindexed:
+            unindexed.remove(user_id)
+        keys = self._date_keys.get(name, {})
+        key = keys.get(user_id)
+        if key is None:
+            return
+        del keys[user_id]
+        dates = self._date_index[name]
+        postings = dates.get(key)
+        if postings is not None and user_id in postings:
+            postings.remove(user_id)
+            if not postings:
+                del dates[key]
+
+    @security.private
+    def filterUserIdsByDate(self, name, user_ids, min=None, max=None):
+        """Return those of user_ids whose date property name lies in
+        [min, max), or None if there is no index for name.
+
+        min and max are DateTime instances or None for an open end.
+        Users without a value count as having the default value of the
+        property, string values are read as dates with the same
+        '2000/01/01' fallback as MembershipTool.searchForMembers.
+        Matching dates are found with a range scan of the index; only
+        values within the same DATE_INDEX_RESOLUTION range as min or max
+        are compared with the stored record.
+        """
+        if self._date_index is None or name not in self.date_properties:
+            return None
+        storage = self._storage
+        keys = self._date_keys.get(name, {})
+        unindexed = self._date_unindexed.get(name, ())
+
+        low = high = None
+        if min is not None:
+            low = _dateKey(min)
+        if max is not None:
+            high = _dateKey(max)
+        matched = set()
+        dates = self._date_index.get(name)
+        if dates is not None:
+            for key, postings in dates.items(low, high):
+                if key == low or key == high:
+                    matched.update(
+                        user_id for user_id in postings
+                        if _dateInRange(storage[user_id][name], min, max))
+                else:
+                    matched.update(postings)
+
+        default_matches = None
+        result = []
+        for user_id in user_ids:
+            if user_id in matched:
+                result.append(user_id)
+            elif user_id in keys:
+                continue
+            elif user_id in unindexed:
+                try:
+                    if _dateInRange(storage[user_id][name], min, max):
+                        result.append(user_id)
+                except (DateTimeError, TypeError):
+                    continue
+            else:
+                if default_matches is None:
+                    default = self._getDefaultValues().get(name, '')
+                    default_matches = _dateInRange(default, min, max)
+                if default_matches:
+                    result.append(user_id)
+        return result
+
+    def _queryIndex(self, name, value, exact_match=False):
+        """Return the ids of the users whose property may match value.
+
+        The result is a superset; records still have to be checked with
+        testMemberData.
+        """
+        value = _normalize(value)
+        values = self._value_index.get(name, {})
+        # non-string values can't be indexed, always consider them
+        ids = OOSet(self._unindexed.get(name, ()))
+
+        if exact_match:
+            return union(ids, values.get(value))
+
+        if len(value) >= NGRAM_SIZE:
+            ngrams = self._ngram_index.get(name, {})
+            matches = None
+            for ngram in _ngrams(value):
+                postings = ngrams.get(ngram)
+                if postings is None:
+                    return ids
+                matches = intersection(matches, postings)
+                if not matches:
+                    return ids
+            return union(ids, matches)
+
+        # too short for the substring index, look at all distinct values
+        found = set(ids)
+        for key, postings in values.items():
+            if value in key:
+                found.update(postings)
+        return OOSet(found)
+
+    def _findCandidates(self, criteria, exact_match=False):
+        """Return the ids of the users which may match the criteria, or
+        None if the indexes can't narrow down the search.
+        """
+        if self._value_index is None:
+            return None
+        candidates = None
+        for name, value in criteria.items():
+            if name not in self.indexed_properties or \
+                    not isStringType(value):
+                continue
+            candidates = intersection(
+                candidates, self._queryIndex(name, value, exact_match))
+            if not candidates:
+                return OOSet()
+        return candidates
 
     @security.private
     def testMemberData(self, memberdata, criteria, exact_match=False):
@@ -256,8 +648,17 @@ class ZODBMutablePropertyProvider(BasePlugin):
 
         criteria = copy.copy(kw)
 
-        users = [(user, data) for (user, data) in self._storage.items()
-                 if self.testMemberData(data, criteria, exact_match)
+        candidates = self._findCandidates(criteria, exact_match)
+        if candidates is None:
+            records = self._storage.items()
+        else:
+            storage = self._storage
+            records = [(user_id, storage.get(user_id))
+                       for user_id in candidates]
+
+        users = [(user, data) for (user, data) in records
+                 if data is not None
+                 and self.testMemberData(data, criteria, exact_match)
                  and not data.get('isGroup', False)]
 
         user_info = [{'id': self.prefix + user_id,
@@ -290,4 +691,47 @@ InitializeClass(ZODBMutablePropertyProvider)
 
 
 class PersistentProperties(PersistentMapping):
-    pass
+    """The stored properties of a user or group.
+
+    As a persistent object of its own, changing a record does not write
+    the storage bucket holding it, and concurrent changes to different
+    properties of the same record are merged.
+    """
+
+    def _p_resolveConflict(self, old, saved, new):
+        # persistent.mapping stores the items as '_container', older
+        # versions as 'data'
+        key = '_container' if '_container' in new else 'data'
+        old_data = old.get(key, {})
+        saved_data = saved.get(key, {})
+        new_data = new.get(key, {})
+
+        merged = dict(saved_data)
+        for name in set(old_data) | set(new_data):
+            old_value = old_data.get(name, _marker)
+            new_value = new_data.get(name, _marker)
+            if _same(old_value, new_value):
+                # not changed by this transaction
+                continue
+            saved_value = saved_data.get(name, _marker)
+            if not (_same(saved_value, old_value) or
+                    _same(saved_value, new_value)):
+                # changed differently by both transactions
+                raise ConflictError
+            if new_value is _marker:
+                merged.pop(name, None)
+            else:
+                merged[name] = new_value
+
+        resolved = dict(new)
+        resolved[key] = merged
+        return resolved
+
+
+_marker = object()
+
+
+def _same(value, other):
+    if value is _marker or other is _marker:
+        return value is other
+    return type(value) is type(other) and value == other
@@ -7,18 +7,58 @@ to the principal.
 """
 from AccessControl import ClassSecurityInfo
 from AccessControl.requestmethod import postonly
+from Acquisition import aq_base
 from Acquisition import aq_get
 from Acquisition import aq_inner
 from Acquisition import aq_parent
 from App.class_init import InitializeClass
 from App.special_dtml import DTMLFile
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOSet
 from Products.PlonePAS.interfaces.capabilities import IAssignRoleCapability
+from Products.PlonePAS.interfaces.plugins import IIndexedPlugin
+from Products.PlonePAS.plugins.autogroup import AutoGroup
+from Products.PlonePAS.utils import getGroupMemberIds
 from Products.PlonePAS.utils import getGroupsForPrincipal
+from Products.PluggableAuthService.interfaces.plugins import IGroupsPlugin
 from Products.PluggableAuthService.permissions import ManageUsers
+from Products.PluggableAuthService.plugins.RecursiveGroupsPlugin import \
+    IRecursiveGroupsPlugin
 from Products.PluggableAuthService.plugins.ZODBRoleManager \
     import ZODBRoleManager
+from zope.annotation.interfaces import IAnnotations
 from zope.interface import implementer
 
+# request annotation holding the roles computed during the request
+CACHE_KEY = 'Products.PlonePAS.plugins.role'
+
+
+def invalidateRolesCache(context):
+    """Forget the roles of the principals computed during the current
+    request, as role assignments or group memberships changed.
+    """
+    request = aq_get(context, 'REQUEST', None)
+    annotations = IAnnotations(request, None)
+    if annotations is not None:
+        annotations.pop(CACHE_KEY, None)
+
+
+def _groupsInvalidateRolesCache(plugins):
+    """Tell whether all active groups plugins clear the roles cache when
+    the groups of a principal change, so roles computed from the groups
+    they return may be cached.
+
+    That is true for the PlonePAS group managers and automatic groups,
+    and the recursive groups plugin which only follows them.
+    """
+    # imported here, as the group module imports this one
+    from Products.PlonePAS.plugins.group import GroupManager
+    for plugin_id, plugin in plugins.listPlugins(IGroupsPlugin):
+        if not (IRecursiveGroupsPlugin.providedBy(plugin) or
+                isinstance(aq_base(plugin), (GroupManager, AutoGroup))):
+            return False
+    return True
+
 
 def manage_addGroupAwareRoleManager(self, id, title='', RESPONSE=None):
     """
@@ -34,12 +74,43 @@ manage_addGroupAwareRoleManagerForm = DTMLFile(
     '../zmi/GroupAwareRoleManagerForm', globals())
 
 
-@implementer(IAssignRoleCapability)
+@implementer(IAssignRoleCapability, IIndexedPlugin)
 class GroupAwareRoleManager(ZODBRoleManager):
 
     meta_type = "Group Aware Role Manager"
     security = ClassSecurityInfo()
 
+    # reverse index of role->principals
+    _role_principals = None
+
+    def __init__(self, id, title=None):
+        ZODBRoleManager.__init__(self, id, title)
+        self.rebuildIndexes()
+
+    @security.private
+    def rebuildIndexes(self):
+        """Rebuild the index of the principals assigned each role."""
+        self._role_principals = OOBTree()
+        for principal_id, roles in self._principal_roles.items():
+            self._reindexPrincipal(principal_id, ())
+
+    def _reindexPrincipal(self, principal_id, old_roles):
+        index = self._role_principals
+        if index is None:
+            return
+        new_roles = self._principal_roles.get(principal_id, ())
+        for role_id in set(old_roles).difference(new_roles):
+            principals = index.get(role_id)
+            if principals is not None and principal_id in principals:
+                principals.remove(principal_id)
+                if not principals:
+                    del index[role_id]
+        for role_id in set(new_roles).difference(old_roles):
+            principals = index.get(role_id)
+            if principals is None:
+                principals = index[role_id] = OOSet()
+            principals.insert(principal_id)
+
     def updateRolesList(self):
         role_holder = aq_parent(aq_inner(self._getPAS()))
         for role in getattr(role_holder, '__ac_roles__', ()):
@@ -60,10 +131,22 @@ class GroupAwareRoleManager(ZODBRoleManager):
         if item is self:
             self.updateRolesList()
 
+    @security.protected(ManageUsers)
+    def removeRole(self, role_id, REQUEST=None):
+        ZODBRoleManager.removeRole(self, role_id)
+        if self._role_principals is not None and \
+                role_id in self._role_principals:
+            del self._role_principals[role_id]
+        invalidateRolesCache(self)
+
+    removeRole = postonly(removeRole)
+
     @security.protected(ManageUsers)
     def assignRoleToPrincipal(self, role_id, principal_id, REQUEST=None):
+        invalidateRolesCache(self)
+        old_roles = self._principal_roles.get(principal_id, ())
         try:
-            return ZODBRoleManager.assignRoleToPrincipal(
+            result = ZODBRoleManager.assignRoleToPrincipal(
                 self,
                 role_id,
                 principal_id
@@ -71,11 +154,13 @@ class GroupAwareRoleManager(ZODBRoleManager):
         except KeyError:
             # Lazily update our roles list and try again
             self.updateRolesList()
-            return ZODBRoleManager.assignRoleToPrincipal(
+            result = ZODBRoleManager.assignRoleToPrincipal(
                 self,
                 role_id,
                 principal_id
             )
+        self._reindexPrincipal(principal_id, old_roles)
+        return result
 
     @security.protected(ManageUsers)
     def assignRolesToPrincipal(self, roles, principal_id, REQUEST=None):
@@ -99,37 +184,128 @@ class GroupAwareRoleManager(ZODBRoleManager):
                         # set it
                         self._roles[role_id]
 
+        old_roles = self._principal_roles.get(principal_id, ())
         self._principal_roles[principal_id] = tuple(roles)
+        self._reindexPrincipal(principal_id, old_roles)
+        invalidateRolesCache(self)
 
     assignRolesToPrincipal = postonly(assignRolesToPrincipal)
 
+    @security.protected(ManageUsers)
+    def removeRoleFromPrincipal(self, role_id, principal_id, REQUEST=None):
+        invalidateRolesCache(self)
+        old_roles = self._principal_roles.get(principal_id, ())
+        result = ZODBRoleManager.removeRoleFromPrincipal(self, role_id,
+                                                         principal_id)
+        self._reindexPrincipal(principal_id, old_roles)
+        return result
+
+    removeRoleFromPrincipal = postonly(removeRoleFromPrincipal)
+
     @security.private
     def getRolesForPrincipal(self, principal, request=None):
         """ See IRolesPlugin.
+
+        The roles are remembered for the rest of the request, keyed by
+        the ids of the principal and its groups for users built by PAS,
+        which already know their groups. Otherwise the groups plugins
+        are asked, and their answer is only relied on if they clear the
+        cache when it changes.
         """
         roles = set([])
-        principal_ids = set([])
-        # Some services need to determine the roles obtained from groups
-        # while excluding the directly assigned roles.  In this case
-        # '__ignore_direct_roles__' = True should be pushed in the request.
         request = aq_get(self, 'REQUEST', None)
-        if request is None \
-           or not request.get('__ignore_direct_roles__', False):
-            principal_ids.add(principal.getId())
-
-        # Some services may need the real roles of an user but **not**
-        # the ones he got through his groups. In this case, the
-        # '__ignore_group_roles__'= True should be previously pushed
-        # in the request.
-        plugins = self._getPAS()['plugins']
-        if request is None \
-           or not request.get('__ignore_group_roles__', False):
-            principal_ids.update(
-                getGroupsForPrincipal(principal, plugins, request)
-            )
+        ignore_direct_roles = ignore_group_roles = False
+        if request is not None:
+            ignore_direct_roles = request.get('__ignore_direct_roles__', False)
+            ignore_group_roles = request.get('__ignore_group_roles__', False)
+
+        principal_ids = None
+        if not (ignore_direct_roles or ignore_group_roles):
+            principal_ids = getattr(aq_base(principal), '_principal_ids',
+                                    None)
+
+        cache = key = None
+        annotations = IAnnotations(request, None)
+        if annotations is not None:
+            if principal_ids is not None:
+                key = (self.getPhysicalPath(), principal_ids)
+            elif _groupsInvalidateRolesCache(self._getPAS()['plugins']):
+                key = (self.getPhysicalPath(), principal.getId(),
+                       bool(ignore_direct_roles), bool(ignore_group_roles))
+        if key is not None:
+            cache = annotations.setdefault(CACHE_KEY, {})
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+        if principal_ids is None:
+            principal_ids = set([])
+            # Some services need to determine the roles obtained from groups
+            # while excluding the directly assigned roles.  In this case
+            # '__ignore_direct_roles__' = True should be pushed in the
+            # request.
+            if not ignore_direct_roles:
+                principal_ids.add(principal.getId())
+
+            # Some services may need the real roles of an user but **not**
+            # the ones he got through his groups. In this case, the
+            # '__ignore_group_roles__'= True should be previously pushed
+            # in the request.
+            if not ignore_group_roles:
+                plugins = self._getPAS()['plugins']
+                principal_ids.update(
+                    getGroupsForPrincipal(principal, plugins, request)
+                )
         for pid in principal_ids:
             roles.update(self._principal_roles.get(pid, ()))
-        return tuple(roles)
+        roles = tuple(roles)
+        if cache is not None:
+            cache[key] = roles
+        return roles
+
+    @security.private
+    def getPrincipalIdsWithRoles(self, role_ids):
+        """Return the ids of the principals directly assigned any of
+        role_ids.
+        """
+        if self._role_principals is None:
+            role_ids = set(role_ids)
+            return [principal_id
+                    for principal_id, roles in self._principal_roles.items()
+                    if role_ids.intersection(roles)]
+
+        principal_ids = set()
+        for role_id in role_ids:
+            principal_ids.update(self._role_principals.get(role_id, ()))
+        return list(principal_ids)
+
+    @security.private
+    def getEffectiveUserIdsWithRoles(self, role_ids):
+        """Return the ids of the principals assigned any of role_ids,
+        directly or through the groups they are members of, or None if
+        the group plugins can not tell without being asked about every
+        principal.
+
+        The ids of the groups holding the roles are included. Groups are
+        expanded as described in utils.getGroupMemberIds; nested groups
+        only with the recursive groups plugin, as PAS does.
+        """
+        principal_ids = set(self.getPrincipalIdsWithRoles(role_ids))
+        plugins = self._getPAS()['plugins']
+        member_ids = getGroupMemberIds(plugins, principal_ids)
+        if member_ids is None:
+            return None
+        return principal_ids | member_ids
+
+    @security.protected(ManageUsers)
+    def listAssignedPrincipals(self, role_id):
+        """Return a list of (principal id, title) to whom a role is
+        assigned.
+        """
+        if self._role_principals is not None and \
+                role_id not in self._role_principals:
+            return []
+        return ZODBRoleManager.listAssignedPrincipals(self, role_id)
 
     # implement IAssignRoleCapability
 
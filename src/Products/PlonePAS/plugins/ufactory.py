@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 from AccessControl import ClassSecurityInfo
 from AccessControl.PermissionRole import _what_not_even_god_should_do
+from Acquisition import aq_get
+from Acquisition import aq_parent
 from App.class_init import InitializeClass
 from App.special_dtml import DTMLFile
 from Products.PlonePAS.interfaces.plugins import ILocalRolesPlugin
 from Products.PlonePAS.interfaces.propertysheets import IMutablePropertySheet
 from Products.PluggableAuthService.PropertiedUser import PropertiedUser
 from Products.PluggableAuthService.UserPropertySheet import UserPropertySheet
+from Products.PluggableAuthService.interfaces.authservice import \
+    IPluggableAuthService
 from Products.PluggableAuthService.interfaces.plugins import IPropertiesPlugin
 from Products.PluggableAuthService.interfaces.plugins import IUserFactoryPlugin
 from Products.PluggableAuthService.interfaces.propertysheets \
@@ -14,12 +18,18 @@ from Products.PluggableAuthService.interfaces.propertysheets \
 from Products.PluggableAuthService.plugins.BasePlugin import BasePlugin
 from collections import OrderedDict
 from zope.interface import implementer
+import thread
+import threading
 
 manage_addPloneUserFactoryForm = DTMLFile('../zmi/PloneUserFactoryForm',
                                           globals())
 
 _marker = object()
 
+# ids of the users whose deferred property sheets are being loaded by
+# the current thread
+_loading = threading.local()
+
 
 def manage_addPloneUserFactory(self, id, title='', RESPONSE=None):
     """
@@ -59,16 +69,40 @@ class PloneUser(PropertiedUser):
     # GRUF API
     _isGroup = False
 
+    # frozenset of the user id and all group ids, set by _addGroups
+    _principal_ids = None
+
+    # ids of the properties plugins whose sheets were not fetched yet, and
+    # whether there are any. Users may be shared between threads through
+    # the ZCacheable cache, so both are only replaced, never changed.
+    _deferred_propertysheet_ids = ()
+    _has_deferred_propertysheets = False
+
     def __init__(self, id, login=None):
         super(PloneUser, self).__init__(id, login)
         self._propertysheets = OrderedDict()
 
+    def __getstate__(self):
+        # like persistent objects, never pickle volatile attributes
+        state = self.__dict__.copy()
+        for key in state.keys():
+            if key.startswith('_v_'):
+                del state[key]
+        return state
+
     def _getPAS(self):
-        # XXX This is not very optimal *at all*
+        # users found by PAS are wrapped in it, avoid acquiring acl_users
+        parent = aq_parent(self)
+        if IPluggableAuthService.providedBy(parent):
+            return parent
+        # the PAS that deferred the property sheets, for the thread that
+        # looked up the user
+        thread_id, pas = getattr(self, '_v_pas', (None, None))
+        if pas is not None and thread_id == thread.get_ident():
+            return pas
         return self.acl_users
 
     def _getPlugins(self):
-        # XXX This is not very optimal *at all*
         return self._getPAS().plugins
 
     @security.public
@@ -98,6 +132,21 @@ class PloneUser(PropertiedUser):
     security.declarePublic('getGroupIds')
     getGroupIds = getGroupNames
 
+    def _addGroups(self, groups=()):
+        super(PloneUser, self)._addGroups(groups)
+        # computed once here, role and local role checks reuse it
+        self._principal_ids = frozenset(
+            [self.getId()] + list(self.getGroups()))
+
+    @security.private
+    def getPrincipalIds(self):
+        """Return the ids of this user and all its groups as frozenset.
+        """
+        if self._principal_ids is None:
+            self._principal_ids = frozenset(
+                [self.getId()] + list(self.getGroups()))
+        return self._principal_ids
+
     #################################
     # acquisition aware
 
@@ -105,17 +154,21 @@ class PloneUser(PropertiedUser):
     def getPropertysheet(self, id):
         """ -> propertysheet (wrapped if supported)
         """
+        self._loadPropertysheets()
         sheet = self._propertysheets[id]
         try:
             return sheet.__of__(self)
         except AttributeError:
             return sheet
 
+    __getitem__ = getPropertysheet
+
     @security.private
     def addPropertysheet(self, id, data):
         """ -> add a prop sheet, given data which is either
         a property sheet or a raw mapping.
         """
+        self._loadPropertysheets()
         if IPropertySheet.providedBy(data):
             sheet = data
         else:
@@ -126,18 +179,84 @@ class PloneUser(PropertiedUser):
 
         self._propertysheets[id] = sheet
 
+    @security.private
+    def listPropertysheets(self):
+        """ -> [ propertysheet_id ]
+        """
+        self._loadPropertysheets()
+        return self._propertysheets.keys()
+
     def _getPropertyPlugins(self):
-        return self._getPAS().plugins.listPlugins(IPropertiesPlugin)
+        return self._getPAS()._listPlugins(IPropertiesPlugin)
 
     @security.private
     def getOrderedPropertySheets(self):
+        self._loadPropertysheets()
         return self._propertysheets.values()
 
+    @security.private
+    def _deferPropertysheets(self, plugin_ids, pas):
+        """Reserve the sheets of the given properties plugins, in order.
+
+        The plugins are only asked for them when a property sheet is
+        accessed for the first time. The user keeps a volatile reference
+        to pas, so the sheets can be loaded even if it is no longer
+        wrapped in it.
+        """
+        deferred = tuple([plugin_id for plugin_id in plugin_ids
+                          if plugin_id not in self._propertysheets])
+        if deferred:
+            self._v_pas = (thread.get_ident(), pas)
+            self._deferred_propertysheet_ids = deferred
+            self._has_deferred_propertysheets = True
+
+    def _loadPropertysheets(self):
+        """Fetch the sheets reserved by _deferPropertysheets.
+
+        The loaded sheets replace the sheets of the user in one go, and
+        only then the user stops deferring them. Concurrent readers see
+        either all sheets or load them as well, and a failing plugin
+        leaves them deferred.
+        """
+        if not self._has_deferred_propertysheets:
+            return
+
+        # plugins may look up properties of the user meanwhile, let them
+        # see the sheets that are already there.
+        loading = getattr(_loading, 'ids', None)
+        if loading is None:
+            loading = _loading.ids = set()
+        if id(self) in loading:
+            return
+        loading.add(id(self))
+        try:
+            pas = self._getPAS()
+            request = aq_get(pas, 'REQUEST', None)
+            propfinders = dict(pas._listPlugins(IPropertiesPlugin))
+            loaded = OrderedDict(self._propertysheets.items())
+            for sheet_id in self._deferred_propertysheet_ids:
+                propfinder = propfinders.get(sheet_id)
+                if propfinder is None or sheet_id in loaded:
+                    continue
+                sheet = propfinder.getPropertiesForUser(self, request)
+                if not sheet:
+                    continue
+                if not IPropertySheet.providedBy(sheet):
+                    sheet = UserPropertySheet(sheet_id, **sheet)
+                loaded[sheet_id] = sheet
+        finally:
+            loading.discard(id(self))
+
+        self._propertysheets = loaded
+        self._deferred_propertysheet_ids = ()
+        self._has_deferred_propertysheets = False
+        self.__dict__.pop('_v_pas', None)
+
     #################################
     # local roles plugin type delegation
 
     def _getLocalRolesPlugins(self):
-        return self._getPAS().plugins.listPlugins(ILocalRolesPlugin)
+        return self._getPAS()._listPlugins(ILocalRolesPlugin)
 
     def getRolesInContext(self, object):
         lrmanagers = self._getLocalRolesPlugins()
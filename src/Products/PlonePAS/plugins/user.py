@@ -5,20 +5,88 @@ ZODB based user manager with introspection and management interfaces.
 from AccessControl import AuthEncoding
 from AccessControl import ClassSecurityInfo
 from AccessControl.Permissions import manage_users as ManageUsers
+from Acquisition import aq_base
 from App.class_init import InitializeClass
 from App.special_dtml import DTMLFile
+from Products.PlonePAS.config import HAS_FUTURES
+from Products.PlonePAS.config import ProcessPoolExecutor
 from Products.PlonePAS.interfaces.capabilities import IDeleteCapability
 from Products.PlonePAS.interfaces.capabilities import IPasswordSetCapability
 from Products.PlonePAS.interfaces.plugins import IUserIntrospection
 from Products.PlonePAS.interfaces.plugins import IUserManagement
+from Products.PlonePAS.pas import invalidateAuthenticationCache
 from Products.PluggableAuthService.plugins.ZODBUserManager \
     import ZODBUserManager as BasePlugin
 from Products.PluggableAuthService.utils import createViewName
 from zope.interface import implementer
+import atexit
+import threading
 
 manage_addUserManagerForm = DTMLFile('../zmi/UserManagerForm', globals())
 
 
+def _encrypt(password):
+    # Passwords already encrypted are left alone. This supports clean
+    # migration from default user source.
+    if AuthEncoding.is_encrypted(password):
+        return password
+    return AuthEncoding.pw_encrypt(password)
+
+
+# Fewer passwords than this are encrypted in the calling thread, where
+# handing them to the pool would cost more than it saves.
+POOL_THRESHOLD = 20
+
+# The pool of processes encrypting passwords, created on first use and
+# shut down on exit, and the number of its processes.
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _getPool(workers):
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None and _pool_workers != workers:
+            _pool.shutdown()
+            _pool = None
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_workers = workers
+        return _pool
+
+
+def shutdownPool():
+    """Shut down the processes encrypting passwords, if any.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+atexit.register(shutdownPool)
+
+
+def encryptPasswords(passwords, workers=0, keep_encrypted=True):
+    """Return passwords encrypted, in the same order.
+
+    Encrypting is slow on purpose. With workers > 1, concurrent.futures
+    available and at least POOL_THRESHOLD passwords, the passwords are
+    encrypted by a pool of that many processes, else one after the
+    other. The pool is forked from the Zope process when first needed
+    and kept until shutdownPool is called or the process exits. Unless
+    keep_encrypted is false, passwords already encrypted are returned
+    as they are.
+    """
+    encrypt = _encrypt if keep_encrypted else AuthEncoding.pw_encrypt
+    passwords = list(passwords)
+    if workers > 1 and HAS_FUTURES and len(passwords) >= POOL_THRESHOLD:
+        return list(_getPool(workers).map(encrypt, passwords))
+    return [encrypt(password) for password in passwords]
+
+
 def manage_addUserManager(dispatcher, id, title=None, REQUEST=None):
     """ Add a UserManager to a Pluggable Auth Service. """
 
@@ -46,6 +114,19 @@ class UserManager(BasePlugin):
     meta_type = 'User Manager'
     security = ClassSecurityInfo()
 
+    # processes encrypting the passwords of bulk operations, 0 or 1 to
+    # encrypt them in the calling thread. Opt-in: the processes are forked
+    # from the Zope process, see encryptPasswords.
+    password_hashing_workers = 0
+
+    _properties = BasePlugin._properties + (
+        {'id': 'password_hashing_workers',
+         'label': 'Processes hashing passwords of bulk operations',
+         'type': 'int',
+         'mode': 'w',
+         },
+    )
+
     @security.protected(ManageUsers)
     def addUser(self, user_id, login_name, password):
         """Original ZODBUserManager.addUser, modified to check if
@@ -60,22 +141,89 @@ class UserManager(BasePlugin):
         if self._login_to_userid.get(login_name) is not None:
             raise KeyError('Duplicate login name: %s' % login_name)
 
-        if not AuthEncoding.is_encrypted(password):
-            password = AuthEncoding.pw_encrypt(password)
+        password = self._encryptPasswords([password])[0]
         self._user_passwords[user_id] = password
         self._login_to_userid[login_name] = user_id
         self._userid_to_login[user_id] = login_name
+        self._invalidateUnknownPrincipals([user_id])
 
         # enumerateUsers return value has changed
         view_name = createViewName('enumerateUsers')
         self.ZCacheable_invalidate(view_name=view_name)
 
+    @security.protected(ManageUsers)
+    def addUsers(self, records):
+        """Add several users at once.
+
+        records is a sequence of (user_id, login_name, password). All
+        records are checked before any user is added, so either all or
+        none of them are. The users are inserted in key order and the
+        caches are invalidated once.
+        """
+        records = list(records)
+        user_ids = set()
+        login_names = set()
+        for user_id, login_name, password in records:
+            if user_id in user_ids or \
+                    self._user_passwords.get(user_id) is not None:
+                raise KeyError('Duplicate user ID: %s' % user_id)
+            if login_name in login_names or \
+                    self._login_to_userid.get(login_name) is not None:
+                raise KeyError('Duplicate login name: %s' % login_name)
+            user_ids.add(user_id)
+            login_names.add(login_name)
+
+        passwords = self._encryptPasswords(
+            [password for user_id, login_name, password in records])
+        records = sorted([(user_id, login_name, password)
+                          for (user_id, login_name, ignored), password
+                          in zip(records, passwords)])
+        for user_id, login_name, password in records:
+            self._user_passwords[user_id] = password
+            self._userid_to_login[user_id] = login_name
+        for login_name, user_id in sorted([
+                (login_name, user_id)
+                for user_id, login_name, password in records]):
+            self._login_to_userid[login_name] = user_id
+        self._invalidateUnknownPrincipals(
+            [user_id for user_id, login_name, password in records])
+
+        if records:
+            # enumerateUsers return value has changed
+            view_name = createViewName('enumerateUsers')
+            self.ZCacheable_invalidate(view_name=view_name)
+
+    def _invalidateUnknownPrincipals(self, user_ids):
+        """Tell PAS that user_ids are no longer unknown.
+        """
+        pas = self._getPAS()
+        if getattr(aq_base(pas), '_invalidateUnknownPrincipals',
+                   None) is None:
+            return
+        if len(user_ids) > 1:
+            # cheaper than forgetting them one by one
+            user_ids = None
+        pas._invalidateUnknownPrincipals(user_ids)
+
+    def _encryptPasswords(self, passwords, keep_encrypted=True):
+        """Return passwords encrypted, in the same order.
+
+        See encryptPasswords.
+        """
+        return encryptPasswords(passwords, self.password_hashing_workers,
+                                keep_encrypted)
+
     # User Management interface
 
     @security.private
     def doDeleteUser(self, userid):
         """Given a user id, delete that user
         """
+        login_name = self._userid_to_login.get(userid)
+        pas = self._getPAS()
+        if login_name is not None and \
+                getattr(aq_base(pas), '_delLoginPluginHint', None) is not None:
+            pas._delLoginPluginHint(login_name)
         return self.removeUser(userid)
 
     @security.private
@@ -86,6 +234,25 @@ class UserManager(BasePlugin):
             raise RuntimeError("User does not exist: %s" % principal_id)
         self._user_passwords[principal_id] = AuthEncoding.pw_encrypt(password)
 
+    @security.private
+    def doChangeUsers(self, records):
+        """Change the passwords of several users at once.
+
+        records is a sequence of (principal_id, password). The passwords
+        are encrypted together, by password_hashing_workers processes.
+        """
+        records = list(records)
+        for principal_id, password in records:
+            if self._user_passwords.get(principal_id) is None:
+                raise RuntimeError("User does not exist: %s" % principal_id)
+        passwords = self._encryptPasswords(
+            [password for principal_id, password in records],
+            keep_encrypted=False)
+        for (principal_id, ignored), password in zip(records, passwords):
+            self._user_passwords[principal_id] = password
+        invalidateAuthenticationCache(
+            [principal_id for principal_id, password in records])
+
     # implement interfaces IDeleteCapability, IPasswordSetCapability
 
     @security.public
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Notify an event whenever the local roles of an object are changed
+through the RoleManager API.
+
+The ZMI variants in OFS.role delegate to these, so patching the base class
+covers both.
+
+Blocking the acquisition of local roles has no API, code sets
+__ac_local_roles_block__ and then calls reindexObjectSecurity, as the
+sharing view does. So reindexObjectSecurity notifies the event as well,
+both the CMF one and Archetypes' own, if Archetypes is installed.
+"""
+from AccessControl.rolemanager import RoleManager
+from Products.CMFCore.CMFCatalogAware import CatalogAware
+from Products.PlonePAS.events import LocalRolesModifiedEvent
+from Products.PlonePAS.patch import call
+from Products.PlonePAS.patch import wrap_method
+from zope.event import notify
+
+try:
+    from Products.Archetypes.CatalogMultiplex import CatalogMultiplex
+except ImportError:
+    CatalogMultiplex = None
+
+
+def manage_addLocalRoles(self, userid, roles):
+    """Set local roles for a user."""
+    result = call(self, 'manage_addLocalRoles', userid, roles)
+    notify(LocalRolesModifiedEvent(self))
+    return result
+
+
+def manage_setLocalRoles(self, userid, roles):
+    """Set local roles for a user."""
+    result = call(self, 'manage_setLocalRoles', userid, roles)
+    notify(LocalRolesModifiedEvent(self))
+    return result
+
+
+def manage_delLocalRoles(self, userids):
+    """Remove all local roles for a user."""
+    result = call(self, 'manage_delLocalRoles', userids)
+    notify(LocalRolesModifiedEvent(self))
+    return result
+
+
+def reindexObjectSecurity(self, skip_self=False):
+    """Reindex security-related indexes on the object and its contents,
+    after its local roles or their blocking changed.
+    """
+    notify(LocalRolesModifiedEvent(self))
+    return call(self, 'reindexObjectSecurity', skip_self=skip_self)
+
+
+def patch_catalogaware():
+    wrap_method(
+        CatalogAware,
+        'reindexObjectSecurity',
+        reindexObjectSecurity
+    )
+    # Archetypes content reindexes its security without the CMF method
+    if CatalogMultiplex is not None:
+        wrap_method(
+            CatalogMultiplex,
+            'reindexObjectSecurity',
+            reindexObjectSecurity
+        )
+
+
+def patch_rolemanager():
+    # sort alphabetically by patched/added method name
+    wrap_method(
+        RoleManager,
+        'manage_addLocalRoles',
+        manage_addLocalRoles
+    )
+    wrap_method(
+        RoleManager,
+        'manage_delLocalRoles',
+        manage_delLocalRoles
+    )
+    wrap_method(
+        RoleManager,
+        'manage_setLocalRoles',
+        manage_setLocalRoles
+    )
@@ -3,6 +3,7 @@ from Acquisition import aq_parent
 from Products.CMFCore.utils import getToolByName
 from Products.PlonePAS import config
 from Products.PlonePAS.interfaces import group as igroup
+from Products.PlonePAS.interfaces.plugins import IIndexedPlugin
 from Products.PlonePAS.interfaces.plugins import ILocalRolesPlugin
 from Products.PlonePAS.interfaces.plugins import IUserIntrospection
 from Products.PlonePAS.interfaces.plugins import IUserManagement
@@ -494,3 +495,15 @@ def setupPlonePAS(context):
         addRolesToPlugIn(site)
         setupGroups(site)
         setLoginFormInCookieAuth(site)
+
+
+def rebuildPluginIndexes(context):
+    """
+    Upgrade step building the indexes of the plugins created before
+    those indexes were introduced.
+    """
+    uf = getToolByName(context, 'acl_users')
+    for plugin in uf.objectValues():
+        if IIndexedPlugin.providedBy(plugin):
+            logger.info('Rebuilding indexes of %s', plugin.getId())
+            plugin.rebuildIndexes()
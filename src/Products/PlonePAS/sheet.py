@@ -22,6 +22,10 @@ class PropertySchemaTypeMap(object):
     def __init__(self):
         self.tmap = {}
         self.tmap_order = []
+        # (type name, inspector) in the order of tmap_order
+        self._ptypes = ()
+        # schema -> {property name: (type name, inspector)}
+        self._compiled = {}
 
     def addType(self, type_name, identifier, order=None):
         self.tmap[type_name] = identifier
@@ -29,10 +33,12 @@ class PropertySchemaTypeMap(object):
             self.tmap_order.insert(order, type_name)
         else:
             self.tmap_order.append(type_name)
+        self._ptypes = tuple([(ptype, self.tmap[ptype])
+                              for ptype in self.tmap_order])
+        self._compiled = {}
 
     def getTypeFor(self, value):
-        ptypes = [(ptype, self.tmap[ptype]) for ptype in self.tmap_order]
-        for ptype, inspector in ptypes:
+        for ptype, inspector in self._ptypes:
             if inspector(value):
                 return ptype
         raise TypeError('Invalid property type: %s' % type(value))
@@ -41,6 +47,44 @@ class PropertySchemaTypeMap(object):
         inspector = self.tmap[property_type]
         return inspector(value)
 
+    def compileSchema(self, schema):
+        """Return a mapping of the property names of schema, a sequence
+        of (name, type) pairs, to their type and its inspector.
+
+        The result is computed once per schema.
+        """
+        schema = tuple([tuple(item) for item in schema])
+        compiled = self._compiled.get(schema)
+        if compiled is None:
+            compiled = {}
+            for name, ptype in schema:
+                compiled[name] = (ptype, self.tmap.get(ptype))
+            if len(self._compiled) >= 100:
+                # schemas changed a lot, forget the old ones
+                self._compiled.clear()
+            self._compiled[schema] = compiled
+        return compiled
+
+    def validateProperties(self, schema, mapping):
+        """Validate the values of mapping in one pass.
+
+        Returns the name and type of the first property with an invalid
+        value, or None if all are valid. Properties not in schema are not
+        checked.
+        """
+        compiled = self.compileSchema(schema)
+        for name, value in mapping.items():
+            validator = compiled.get(name)
+            if validator is None:
+                continue
+            ptype, inspector = validator
+            if inspector is None:
+                # unknown type, like validate
+                raise KeyError(ptype)
+            if not inspector(value):
+                return name, ptype
+        return None
+
 PropertySchema = PropertySchemaTypeMap()
 PropertySchema.addType(
     'string',
@@ -89,14 +133,20 @@ validateValue = PropertySchema.validate
 class MutablePropertySheet(UserPropertySheet):
 
     def validateProperty(self, id, value):
-        if id not in self._properties:
-            raise PropertyValueError('No such property found on this schema')
+        self.validateProperties({id: value})
+
+    def validateProperties(self, mapping):
+        for id in mapping:
+            if id not in self._properties:
+                raise PropertyValueError(
+                    'No such property found on this schema')
 
-        proptype = self.getPropertyType(id)
-        if not validateValue(proptype, value):
+        invalid = PropertySchema.validateProperties(self._schema, mapping)
+        if invalid is not None:
+            id, proptype = invalid
             raise PropertyValueError(
                 "Invalid value (%s) for property '%s' of type %s" %
-                (value, id, proptype)
+                (mapping[id], id, proptype)
             )
 
     def setProperty(self, user, id, value):
@@ -110,14 +160,10 @@ class MutablePropertySheet(UserPropertySheet):
         provider.setPropertiesForUser(user, self)
 
     def setProperties(self, user, mapping):
-        prop_keys = self._properties.keys()
-        prop_update = mapping.copy()
-
-        for key, value in tuple(prop_update.items()):
-            if key not in prop_keys:
-                prop_update.pop(key)
-                continue
-            self.validateProperty(key, value)
+        prop_keys = self._properties
+        prop_update = dict([(key, value) for key, value in mapping.items()
+                            if key in prop_keys])
+        self.validateProperties(prop_update)
 
         self._properties.update(prop_update)
 
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+from Acquisition import aq_base
+from Acquisition import aq_parent
+from Products.PlonePAS import pas
+from Products.PlonePAS.plugins.role import GroupAwareRoleManager
 from Products.PlonePAS.tests import base
+from Products.PlonePAS.utils import LRUCache
 from Products.PluggableAuthService.PluggableAuthService import \
     _SWALLOWABLE_PLUGIN_EXCEPTIONS
 from Products.PluggableAuthService.interfaces.authservice import \
     IPluggableAuthService
 from Products.PluggableAuthService.interfaces.events import \
     IPrincipalDeletedEvent
+from Products.PluggableAuthService.interfaces.plugins import \
+    IAuthenticationPlugin
 from Products.PluggableAuthService.interfaces.plugins import IRolesPlugin
 from zope.component import adapter
 from zope.component import getGlobalSiteManager
@@ -17,6 +24,11 @@ class BasicOpsTestCase(base.TestCase):
         self.loginAsPortalOwner()
         self.acl_users = self.portal.acl_users
 
+    def enablePrincipalMissCache(self):
+        original = pas._principal_misses
+        pas._principal_misses = LRUCache(100, 60)
+        self.addCleanup(setattr, pas, '_principal_misses', original)
+
     def compareRoles(self, target, user, roles):
         """
         compareRoles(self, target, user, roles) => do not raise if
@@ -53,6 +65,226 @@ class BasicOpsTestCase(base.TestCase):
         self.createUser()
         self.assertTrue(self.acl_users.getUser("created_user"))
 
+    def test_add_users(self):
+        self.portal.portal_groups.addGroup('students')
+        progress = []
+        users = self.acl_users._doAddUsers(
+            [{'login': 'student%d' % i, 'password': 'secret',
+              'roles': ['Member'], 'groups': ['students']}
+             for i in range(5)],
+            chunk_size=2,
+            progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual([user.getId() for user in users],
+                         ['student%d' % i for i in range(5)])
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        self.compareRoles(None, 'student3', ['Member'])
+        self.assertTrue(
+            'students' in self.acl_users.getUser('student3').getGroups())
+        self.assertTrue(self.acl_users.authenticate(
+            'student3', 'secret', self.portal.REQUEST))
+
+    def test_add_users_login_transform(self):
+        self.acl_users.manage_changeProperties(login_transform='lower')
+        users = self.acl_users._doAddUsers(
+            [{'login': 'Student', 'password': 'secret'}])
+        self.assertEqual([user.getUserName() for user in users], ['student'])
+        self.assertTrue(self.acl_users.authenticate(
+            'student', 'secret', self.portal.REQUEST))
+
+    def test_add_users_checks_all_first(self):
+        self.createUser()
+        source_users = self.acl_users.source_users
+        self.assertRaises(
+            KeyError, source_users.addUsers,
+            [('new_user', 'new_user', 'secret'),
+             ('created_user', 'created_user', 'secret')])
+        self.assertRaises(
+            KeyError, source_users.addUsers,
+            [('new_user', 'new_user', 'secret'),
+             ('new_user', 'other_login', 'secret')])
+        self.assertEqual(self.acl_users.getUser('new_user'), None)
+
+    def test_change_users(self):
+        self.createUser('user1')
+        self.createUser('user2')
+        source_users = self.acl_users.source_users
+        source_users.doChangeUsers([('user1', 'new1'), ('user2', 'new2')])
+        request = self.portal.REQUEST
+        self.assertTrue(self.acl_users.authenticate('user1', 'new1', request))
+        self.assertTrue(self.acl_users.authenticate('user2', 'new2', request))
+        self.assertRaises(RuntimeError, source_users.doChangeUsers,
+                          [('user1', 'secret'), ('unknown', 'secret')])
+        self.assertTrue(self.acl_users.authenticate('user1', 'new1', request))
+
+    def test_encrypt_passwords(self):
+        from AccessControl import AuthEncoding
+        from Products.PlonePAS.config import HAS_FUTURES
+        from Products.PlonePAS.plugins import user
+        from Products.PlonePAS.plugins.user import encryptPasswords
+        self.addCleanup(setattr, user, 'POOL_THRESHOLD', user.POOL_THRESHOLD)
+        self.addCleanup(user.shutdownPool)
+        user.POOL_THRESHOLD = 2
+        passwords = ['secret%d' % i for i in range(4)]
+        passwords.append(AuthEncoding.pw_encrypt('secret'))
+        workers = HAS_FUTURES and 2 or 0
+        encrypted = encryptPasswords(passwords, workers)
+        self.assertEqual(len(encrypted), 5)
+        for password, hashed in zip(passwords[:4], encrypted):
+            self.assertTrue(AuthEncoding.pw_validate(hashed, password))
+        self.assertEqual(encrypted[4], passwords[4])
+        pool = user._pool
+        self.assertEqual(pool is not None, HAS_FUTURES)
+        encrypted = encryptPasswords(passwords, workers,
+                                     keep_encrypted=False)
+        self.assertNotEqual(encrypted[4], passwords[4])
+        # the pool is reused
+        self.assertTrue(user._pool is pool)
+
+    def test_lru_cache(self):
+        now = [0]
+        cache = LRUCache(2, 10, timer=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # b is the least recently used
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        cache.invalidateValues(lambda value: value == 1)
+        self.assertEqual(cache.get('a'), None)
+        now[0] = 11
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_authentication_cache(self):
+        self.createUser()
+        request = self.portal.REQUEST
+        original = pas._authentication_cache
+        pas._authentication_cache = cache = LRUCache(10, 60)
+        try:
+            user = self.acl_users.authenticate(
+                'created_user', 'secret', request)
+            self.assertEqual(user.getId(), 'created_user')
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(self.acl_users.authenticate(
+                'created_user', 'wrong', request), None)
+            self.assertEqual(len(cache), 1)
+            user = self.acl_users.authenticate(
+                'created_user', 'secret', request)
+            self.assertEqual(user.getId(), 'created_user')
+
+            self.acl_users.userSetPassword('created_user', 'changed')
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(self.acl_users.authenticate(
+                'created_user', 'secret', request), None)
+            self.assertTrue(self.acl_users.authenticate(
+                'created_user', 'changed', request))
+
+            self.acl_users.updateLoginName('created_user', 'renamed')
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(self.acl_users.authenticate(
+                'created_user', 'changed', request), None)
+            self.assertTrue(self.acl_users.authenticate(
+                'renamed', 'changed', request))
+
+            self.acl_users._doDelUser('created_user')
+            self.assertEqual(self.acl_users.authenticate(
+                'renamed', 'changed', request), None)
+        finally:
+            pas._authentication_cache = original
+
+    def test_authentication_cache_bulk_change(self):
+        self.createUser('user1')
+        self.createUser('user2')
+        self.createUser('user3')
+        request = self.portal.REQUEST
+        original = pas._authentication_cache
+        pas._authentication_cache = cache = LRUCache(10, 60)
+        self.addCleanup(setattr, pas, '_authentication_cache', original)
+        for user_id in ('user1', 'user2', 'user3'):
+            self.assertTrue(self.acl_users.authenticate(
+                user_id, 'secret', request))
+        self.assertEqual(len(cache), 3)
+
+        self.acl_users.source_users.doChangeUsers(
+            [('user1', 'new1'), ('user2', 'new2')])
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(self.acl_users.authenticate(
+            'user1', 'secret', request), None)
+        self.assertTrue(self.acl_users.authenticate(
+            'user3', 'secret', request))
+
+    def test_login_plugin_hints(self):
+        request = self.portal.REQUEST
+        self.createUser()
+        authenticator_ids = tuple([
+            authenticator_id for authenticator_id, authenticator
+            in self.acl_users.plugins.listPlugins(IAuthenticationPlugin)])
+        self.assertEqual(
+            self.acl_users._getLoginPluginHint('created_user',
+                                               authenticator_ids),
+            None)
+        self.assertTrue(self.acl_users.authenticate(
+            'created_user', 'secret', request))
+        self.assertEqual(
+            self.acl_users._getLoginPluginHint('created_user',
+                                               authenticator_ids),
+            'source_users')
+
+        # the hint only holds for the same order of plugins
+        self.assertEqual(
+            self.acl_users._getLoginPluginHint('created_user',
+                                               authenticator_ids[::-1]),
+            None)
+
+        # a wrong hint is corrected by the next login
+        self.acl_users._setLoginPluginHint('created_user', 'session',
+                                           authenticator_ids)
+        self.assertTrue(self.acl_users.authenticate(
+            'created_user', 'secret', request))
+        self.assertEqual(
+            self.acl_users._getLoginPluginHint('created_user',
+                                               authenticator_ids),
+            'source_users')
+        self.assertEqual(self.acl_users.authenticate(
+            'created_user', 'wrong', request), None)
+
+        # hints are not stored in the database
+        self.assertFalse('_login_plugin_hints' in
+                         aq_base(self.acl_users).__dict__)
+
+        self.acl_users._doDelUser('created_user')
+        self.assertEqual(
+            self.acl_users._getLoginPluginHint('created_user',
+                                               authenticator_ids),
+            None)
+
+    def test_local_roles_for_display_unknown_principals(self):
+        self.enablePrincipalMissCache()
+        self.portal.manage_setLocalRoles('ghost', ['Reader'])
+        self.assertTrue(('ghost', ('Reader',), 'user', 'ghost') in
+                        self.acl_users._getLocalRolesForDisplay(self.portal))
+        self.assertTrue(self.acl_users._isUnknownPrincipal('ghost'))
+        self.assertTrue(('ghost', ('Reader',), 'user', 'ghost') in
+                        self.acl_users._getLocalRolesForDisplay(self.portal))
+
+        self.portal.portal_groups.addGroup('ghost')
+        self.assertFalse(self.acl_users._isUnknownPrincipal('ghost'))
+        self.assertTrue(('ghost', ('Reader',), 'group', 'ghost') in
+                        self.acl_users._getLocalRolesForDisplay(self.portal))
+
+    def test_resolvePrincipals(self):
+        self.createUser()
+        self.portal.portal_groups.addGroup('created_group')
+        self.enablePrincipalMissCache()
+        principals = self.acl_users._resolvePrincipals(
+            ['created_user', 'created_group', 'ghost'])
+        self.assertEqual(principals, {
+            'created_user': ('user', 'created_user', 'created_user'),
+            'created_group': ('group', 'created_group', 'created_group'),
+        })
+        self.assertTrue(self.acl_users._isUnknownPrincipal('ghost'))
+
     def test_edit(self):
         # this will fail unless the PAS role plugin is told it manages
         # the new role.
@@ -117,6 +349,133 @@ class BasicOpsTestCase(base.TestCase):
         self.assertTrue("created_user1" in usernames,
                         "'created_user1' not in %s" % usernames)
 
+    def test_getUsersByIds(self):
+        self.createUser("created_user1")
+        self.createUser("created_user2")
+        self.acl_users.getUserById('created_user1').setProperties(
+            fullname='User One')
+        users = self.acl_users._getUsersByIds(
+            ['created_user2', 'no_such_user', 'created_user1'])
+        self.assertEqual(len(users), 3)
+        self.assertEqual(users[0].getId(), 'created_user2')
+        self.assertTrue(users[1] is None)
+        self.assertEqual(users[2].getProperty('fullname'), 'User One')
+        self.assertEqual(
+            users[2].getRoles(),
+            self.acl_users.getUserById('created_user1').getRoles())
+
+    def test_getUsersByIds_broken_roles_plugin(self):
+        self.createUser("created_user1", roles=['Reviewer'])
+        plugin = self.acl_users.portal_role_manager
+
+        def getRolesForPrincipal(principal, request=None):
+            raise KeyError(principal)
+        plugin.getRolesForPrincipal = getRolesForPrincipal
+        try:
+            user = self.acl_users._getUsersByIds(['created_user1'])[0]
+        finally:
+            del plugin.getRolesForPrincipal
+        self.assertTrue('Authenticated' in user.getRoles())
+        self.assertFalse('Reviewer' in user.getRoles())
+
+    def test_principal_ids(self):
+        self.portal.portal_groups.addGroup('group1', roles=['Reviewer'])
+        self.createUser(groups=['group1'])
+        user = self.acl_users.getUserById('created_user')
+        principal_ids = user.getPrincipalIds()
+        self.assertTrue(isinstance(principal_ids, frozenset))
+        self.assertEqual(principal_ids,
+                         frozenset(['created_user'] + list(user.getGroups())))
+        self.assertTrue('group1' in principal_ids)
+        self.assertTrue(user.getPrincipalIds() is principal_ids)
+        self.assertTrue('Reviewer' in user.getRoles())
+
+    def test_listPlugins(self):
+        plugins = self.acl_users.plugins
+        listed = self.acl_users._listPlugins(IRolesPlugin)
+        expected = plugins.listPlugins(IRolesPlugin)
+        self.assertEqual([plugin_id for plugin_id, plugin in listed],
+                         [plugin_id for plugin_id, plugin in expected])
+        for (plugin_id, plugin), (expected_id, expected_plugin) \
+                in zip(listed, expected):
+            self.assertTrue(aq_base(plugin) is aq_base(expected_plugin))
+            self.assertTrue(
+                aq_base(aq_parent(plugin)) is aq_base(self.acl_users))
+
+        plugin_id = listed[0][0]
+        plugins.deactivatePlugin(IRolesPlugin, plugin_id)
+        self.assertFalse(plugin_id in dict(
+            self.acl_users._listPlugins(IRolesPlugin)))
+        plugins.activatePlugin(IRolesPlugin, plugin_id)
+        self.assertTrue(plugin_id in dict(
+            self.acl_users._listPlugins(IRolesPlugin)))
+
+        # a plugin replaced under the same id is not served from the
+        # snapshot
+        plugin_id = 'portal_role_manager'
+        self.acl_users._delObject(plugin_id)
+        self.acl_users._setObject(plugin_id, GroupAwareRoleManager(plugin_id))
+        plugins.activatePlugin(IRolesPlugin, plugin_id)
+        self.assertTrue(
+            aq_base(dict(self.acl_users._listPlugins(IRolesPlugin))[plugin_id])
+            is aq_base(self.acl_users._getOb(plugin_id)))
+
+    def test_user_getPAS(self):
+        self.createUser()
+        user = self.acl_users.getUserById('created_user')
+        self.assertTrue(user._getPAS() is aq_parent(user))
+        self.assertTrue(aq_base(user.__of__(self.portal)._getPAS())
+                        is aq_base(self.acl_users))
+
+    def test_deferred_propertysheets(self):
+        self.createUser()
+        self.acl_users.getUserById('created_user').setProperties(
+            fullname='Test User')
+
+        user = self.acl_users.getUserById('created_user')
+        self.assertTrue(user._has_deferred_propertysheets)
+        self.assertTrue('Authenticated' in user.getRoles())
+        self.assertTrue(user._has_deferred_propertysheets)
+
+        self.assertEqual(user.getProperty('fullname'), 'Test User')
+        self.assertFalse(user._has_deferred_propertysheets)
+        self.assertTrue('mutable_properties' in user.listPropertysheets())
+        self.assertEqual(
+            user.getPropertysheet('mutable_properties').getProperty(
+                'fullname'),
+            'Test User')
+
+        # item access loads the sheets as well
+        user = self.acl_users.getUserById('created_user')
+        self.assertEqual(user['mutable_properties'].getProperty('fullname'),
+                         'Test User')
+
+    def test_deferred_propertysheets_unwrapped(self):
+        self.createUser()
+        user = aq_base(self.acl_users.getUserById('created_user'))
+        self.assertTrue(user._has_deferred_propertysheets)
+        self.assertFalse('_v_pas' in user.__getstate__())
+        self.assertTrue('mutable_properties' in user.listPropertysheets())
+        self.assertFalse(hasattr(user, '_v_pas'))
+
+    def test_deferred_propertysheets_plugin_error(self):
+        self.createUser()
+        user = self.acl_users.getUserById('created_user')
+        plugin = self.acl_users.mutable_properties
+
+        def getPropertiesForUser(user, request=None):
+            raise ValueError(user)
+        plugin.getPropertiesForUser = getPropertiesForUser
+        try:
+            self.assertRaises(ValueError, user.listPropertysheets)
+        finally:
+            del plugin.getPropertiesForUser
+
+        # the sheets are still deferred and load once the plugin works
+        self.assertTrue(user._has_deferred_propertysheets)
+        self.assertTrue('mutable_properties' in user.listPropertysheets())
+        self.assertFalse(user._has_deferred_propertysheets)
+
     def test_setpw(self):
         # there is more than one place where one can set the password.
         # insane. anyway we have to check the patch in pas.py userSetPassword
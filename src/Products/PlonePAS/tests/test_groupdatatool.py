@@ -2,7 +2,9 @@
 from AccessControl import Permissions
 from AccessControl import Unauthorized
 from Products.CMFCore.tests.base.testcase import WarningInterceptor
+from Products.PlonePAS import pas
 from Products.PlonePAS.tests import base
+from Products.PlonePAS.utils import LRUCache
 from plone.app.testing import TEST_USER_ID
 from plone.app.testing import TEST_USER_NAME
 
@@ -66,6 +68,23 @@ class TestGroupData(base.TestCase, WarningInterceptor):
         self.acl_users.userSetGroups(TEST_USER_ID, groupnames=['foo'])
         self.assertEqual(g.getGroupMembers()[0].getId(), TEST_USER_ID)
 
+    def testGetGroupMembersSkipsUnknownPrincipals(self):
+        g = self.groups.getGroupById('foo')
+        self.acl_users.userSetGroups(TEST_USER_ID, groupnames=['foo'])
+        self.acl_users.source_groups.addPrincipalToGroup('ghost', 'foo')
+        original = pas._principal_misses
+        pas._principal_misses = LRUCache(100, 60)
+        self.addCleanup(setattr, pas, '_principal_misses', original)
+        self.assertEqual([m.getId() for m in g.getGroupMembers()],
+                         [TEST_USER_ID])
+        self.assertTrue(self.acl_users._isUnknownPrincipal('ghost'))
+
+        # adding the principal makes it known again
+        self.acl_users._doAddUser('ghost', 'secret', [], [])
+        self.assertFalse(self.acl_users._isUnknownPrincipal('ghost'))
+        self.assertEqual(sorted([m.getId() for m in g.getGroupMembers()]),
+                         sorted(['ghost', TEST_USER_ID]))
+
     def testGroupMembersAreWrapped(self):
         g = self.groups.getGroupById('foo')
         self.acl_users.userSetGroups(TEST_USER_ID, groupnames=['foo'])
@@ -6,8 +6,10 @@ from Acquisition import aq_parent
 from Products.CMFCore.tests.base.testcase import WarningInterceptor
 from Products.CMFCore.utils import getToolByName
 from Products.PlonePAS.plugins.group import PloneGroup
+from Products.PlonePAS.setuphandlers import rebuildPluginIndexes
 from Products.PlonePAS.tests import base
 from Products.PlonePAS.tools.groupdata import GroupData
+from Products.PluggableAuthService.interfaces.plugins import IGroupsPlugin
 from plone.app.testing import TEST_USER_ID
 
 
@@ -190,6 +192,66 @@ class TestGroupsTool(base.TestCase, WarningInterceptor):
         gs = self.groups.getGroupsByUserId(TEST_USER_ID)
         self.assertEqual(gs[0].getId(), 'foo')
 
+    def testTransitiveGroupMembers(self):
+        self.groups.addGroup('foo', [], [])
+        self.groups.addGroup('bar', [], [])
+        self.groups.addGroup('baz', [], [])
+        self.groups.addPrincipalToGroup('bar', 'foo')
+        self.groups.addPrincipalToGroup('baz', 'bar')
+        self.groups.addPrincipalToGroup(TEST_USER_ID, 'baz')
+        source_groups = self.acl_users.source_groups
+
+        self.assertEqual(
+            sortTuple(source_groups.getTransitiveGroupMembers('foo')),
+            ('bar', 'baz', TEST_USER_ID))
+        self.assertEqual(
+            sortTuple(source_groups._principal_ancestors[TEST_USER_ID]),
+            ('bar', 'baz', 'foo'))
+        foo = self.groups.getGroupById('foo')
+        self.assertEqual(sortTuple(foo.getGroupMemberIds()), ('bar',))
+        self.assertEqual(sortTuple(foo.getAllGroupMemberIds()),
+                         ('bar', 'baz', TEST_USER_ID))
+
+        # nested groups only count with the recursive groups plugin
+        self.acl_users.plugins.deactivatePlugin(IGroupsPlugin,
+                                                'recursive_groups')
+        self.assertEqual(foo.getAllGroupMemberIds(), ['bar'])
+        self.acl_users.plugins.activatePlugin(IGroupsPlugin,
+                                              'recursive_groups')
+
+        self.groups.removePrincipalFromGroup('baz', 'bar')
+        self.assertEqual(source_groups.getTransitiveGroupMembers('foo'),
+                         ('bar',))
+        self.assertEqual(
+            tuple(source_groups._principal_ancestors[TEST_USER_ID]),
+            ('baz',))
+
+        self.groups.addPrincipalToGroup('foo', 'baz')
+        self.groups.removeGroup('foo')
+        self.assertEqual(source_groups.getTransitiveGroupMembers('baz'),
+                         (TEST_USER_ID,))
+        self.assertEqual(
+            tuple(source_groups._principal_ancestors[TEST_USER_ID]),
+            ('baz',))
+
+    def testTransitiveGroupMembersWithoutIndexes(self):
+        self.groups.addGroup('foo', [], [])
+        self.groups.addGroup('bar', [], [])
+        self.groups.addPrincipalToGroup('bar', 'foo')
+        self.groups.addPrincipalToGroup(TEST_USER_ID, 'bar')
+        source_groups = self.acl_users.source_groups
+        source_groups._principal_ancestors = None
+        source_groups._group_descendants = None
+
+        self.assertEqual(
+            sortTuple(source_groups.getTransitiveGroupMembers('foo')),
+            ('bar', TEST_USER_ID))
+        rebuildPluginIndexes(self.portal.portal_setup)
+        self.assertTrue(source_groups._principal_ancestors is not None)
+        self.assertEqual(
+            sortTuple(source_groups._principal_ancestors[TEST_USER_ID]),
+            ('bar', 'foo'))
+
     def testGroupsByUserIdAreWrapped(self):
         self.groups.addGroup('foo', [], [])
         self.acl_users.userSetGroups(TEST_USER_ID, groupnames=['foo'])
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""Tests for Products.PlonePAS.plugins.local_role.LocalRolesManager"""
+
+from OFS.Folder import Folder
+from Products.PlonePAS.plugins import local_role
+from Products.PlonePAS.plugins.local_role import LocalRolesManager
+from Products.PlonePAS.tests import base
+from zope.annotation.interfaces import IAnnotations
+import transaction
+
+DEPTH = 10
+ITEMS = 100
+
+
+class CountingLocalRoles(dict):
+    """Local roles mapping counting how often it is looked up."""
+
+    lookups = 0
+
+    def __call__(self):
+        self.lookups += 1
+        return self
+
+
+class DummyUser(object):
+
+    def __init__(self, id, groups=()):
+        self._id = id
+        self._groups = groups
+
+    def getId(self):
+        return self._id
+
+    def getGroups(self):
+        return self._groups
+
+    def _check_context(self, object):
+        return True
+
+
+class LocalRolesManagerTests(base.TestCase):
+
+    def afterSetUp(self):
+        self.loginAsPortalOwner()
+        self.user = DummyUser('somebody', ('group', ))
+
+        self.folders = []
+        parent = self.portal
+        for level in range(DEPTH):
+            parent = self._addFolder(parent, 'level%d' % level)
+            self.folders.append(parent)
+        self.folders[3].__ac_local_roles__['group'] = ['Reviewer']
+
+        self.items = [self._addFolder(parent, 'item%d' % i)
+                      for i in range(ITEMS)]
+
+    def _addFolder(self, parent, id):
+        parent._setObject(id, Folder(id))
+        folder = parent._getOb(id)
+        folder.__ac_local_roles__ = CountingLocalRoles(other=['Owner'])
+        return folder
+
+    def _countLookups(self):
+        return sum(obj.__ac_local_roles__.lookups
+                   for obj in self.folders + self.items)
+
+    def _checkAllItems(self, plugin):
+        for item in self.items:
+            self.assertEqual(
+                plugin.checkLocalRolesAllowed(self.user, item, ['Editor']),
+                None)
+            self.assertEqual(
+                plugin.checkLocalRolesAllowed(self.user, item, ['Reviewer']),
+                1)
+
+    def test_getRolesInContext(self):
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        self.assertEqual(
+            plugin.getRolesInContext(self.user, self.items[0]), ['Reviewer'])
+        self.assertEqual(
+            plugin.getRolesInContext(self.user, self.folders[2]), [])
+
+    def test_benchmark_deep_tree(self):
+        # without a request there is nothing to share between the checks,
+        # every check walks the whole chain
+        plugin = LocalRolesManager('lrm')
+        self._checkAllItems(plugin)
+        self.assertEqual(self._countLookups(), 2 * ITEMS * (DEPTH + 1))
+
+        for obj in self.folders + self.items:
+            obj.__ac_local_roles__.lookups = 0
+
+        # with a request every container is only looked up once
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        self._checkAllItems(plugin)
+        self.assertEqual(self._countLookups(), DEPTH + ITEMS)
+
+    def test_getAllLocalRolesInContext(self):
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        self.items[0].manage_setLocalRoles('somebody', ['Editor'])
+        roles = plugin.getAllLocalRolesInContext(self.items[0])
+        self.assertEqual(roles['group'], set(['Reviewer']))
+        self.assertEqual(roles['somebody'], set(['Editor']))
+        self.assertEqual(roles['other'], set(['Owner']))
+
+        # the result is a copy
+        roles['group'].add('Manager')
+        roles = plugin.getAllLocalRolesInContext(self.items[1])
+        self.assertEqual(roles['group'], set(['Reviewer']))
+        self.assertFalse('somebody' in roles)
+
+        roles = plugin.getAllLocalRolesInContext(self.folders[2])
+        self.assertFalse('group' in roles)
+
+    def test_benchmark_reindex_security(self):
+        # reindexing the security of a folder computes the local roles of
+        # every object in it
+        for obj in self.folders + self.items:
+            obj.__ac_local_roles__.lookups = 0
+
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        for item in self.items:
+            self.assertEqual(plugin.getAllLocalRolesInContext(item)['group'],
+                             set(['Reviewer']))
+        self.assertEqual(self._countLookups(), DEPTH + ITEMS)
+
+    def test_local_roles_changed_during_request(self):
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        self._checkAllItems(plugin)
+
+        self.folders[5].manage_setLocalRoles('somebody', ['Editor'])
+        self.assertEqual(
+            plugin.checkLocalRolesAllowed(self.user, self.items[0],
+                                          ['Editor']),
+            1)
+        self.folders[5].manage_delLocalRoles(['somebody'])
+        self.assertEqual(
+            plugin.checkLocalRolesAllowed(self.user, self.items[0],
+                                          ['Editor']),
+            None)
+
+    def test_object_replaced_during_request(self):
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        self._checkAllItems(plugin)
+
+        parent = self.folders[-1]
+        parent._delObject('item0')
+        folder = Folder('item0')
+        folder.__ac_local_roles_block__ = True
+        parent._setObject('item0', folder)
+        self.assertEqual(
+            plugin.checkLocalRolesAllowed(self.user, parent.item0,
+                                          ['Reviewer']),
+            None)
+
+    def test_request_cache_bounded(self):
+        self.addCleanup(setattr, local_role, 'LOCAL_ROLES_CACHE_SIZE',
+                        local_role.LOCAL_ROLES_CACHE_SIZE)
+        local_role.LOCAL_ROLES_CACHE_SIZE = 5
+        annotations = IAnnotations(self.portal.REQUEST)
+        annotations.pop(local_role.CACHE_KEY, None)
+
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        self._checkAllItems(plugin)
+        self.assertEqual(len(annotations[local_role.CACHE_KEY]), 5)
+
+    def test_block_local_roles(self):
+        self.folders[5].__ac_local_roles_block__ = True
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        self.assertEqual(
+            plugin.checkLocalRolesAllowed(self.user, self.items[0],
+                                          ['Reviewer']),
+            None)
+        self.assertEqual(
+            plugin.checkLocalRolesAllowed(self.user, self.folders[4],
+                                          ['Reviewer']),
+            1)
+
+    def test_reindexObjectSecurity(self):
+        # code blocking or writing local roles directly reindexes the
+        # security of the object, which updates the cache and the index
+        plugin = LocalRolesManager('lrm').__of__(self.portal.acl_users)
+        self.portal.manage_setLocalRoles('group', ['Reader'])
+        self.assertTrue(
+            'Reader' in plugin.getRolesInContext(self.user, self.folder))
+        self.folder.__ac_local_roles_block__ = True
+        self.folder.reindexObjectSecurity()
+        self.assertFalse(
+            'Reader' in plugin.getRolesInContext(self.user, self.folder))
+
+        plugin = self.portal.acl_users.local_roles
+        plugin.rebuildLocalRolesIndex()
+        self.folder.__ac_local_roles__['somebody'] = ['Editor']
+        self.folder._p_changed = True
+        self.folder.reindexObjectSecurity()
+        self.assertEqual(plugin.getLocalRolesForPrincipal('somebody'),
+                         {'/'.join(self.folder.getPhysicalPath()):
+                          ('Editor', )})
+
+    def test_local_roles_index(self):
+        plugin = self.portal.acl_users.local_roles
+        self.folder.invokeFactory('Folder', 'parent')
+        parent = self.folder.parent
+        parent.invokeFactory('Folder', 'child')
+        child = parent.child
+        parent.manage_setLocalRoles('group', ['Reviewer'])
+        path = '/'.join(parent.getPhysicalPath())
+        child_path = '/'.join(child.getPhysicalPath())
+
+        # without an index the content of the site is walked, the folders
+        # of the fixture are no content
+        self.assertFalse(plugin.hasLocalRolesIndex())
+        self.assertEqual(plugin.getLocalRolesForPrincipal('group'),
+                         {path: ('Reviewer', )})
+
+        plugin.rebuildLocalRolesIndex()
+        self.assertTrue(plugin.hasLocalRolesIndex())
+        self.assertEqual(plugin.getLocalRolesForPrincipal('group'),
+                         {path: ('Reviewer', )})
+        self.assertEqual(plugin.getLocalRolesForPrincipal('group', path),
+                         {path: ('Reviewer', )})
+        self.assertEqual(
+            plugin.getLocalRolesForPrincipal('group', child_path), {})
+        # tools and skins are no content and not indexed
+        skins_path = '/'.join(self.portal.portal_skins.getPhysicalPath())
+        self.assertEqual(
+            list(plugin._path_index.keys(min=skins_path + '/',
+                                         max=skins_path + '0')),
+            [])
+
+        # changes through the RoleManager API update the index
+        child.manage_setLocalRoles('somebody', ['Editor'])
+        self.assertEqual(plugin.getLocalRolesForPrincipal('somebody'),
+                         {child_path: ('Editor', )})
+        child.manage_delLocalRoles(['somebody'])
+        self.assertEqual(plugin.getLocalRolesForPrincipal('somebody'), {})
+
+        # deleted principals are dropped
+        acl_users = self.portal.acl_users
+        acl_users._doAddUser('doomed', 'secret', [], [])
+        child.manage_setLocalRoles('doomed', ['Editor'])
+        acl_users._doDelUser('doomed')
+        self.assertEqual(plugin.getLocalRolesForPrincipal('doomed'), {})
+        self.assertFalse('doomed' in plugin._path_index.get(child_path, ()))
+
+        # moving and removing content moves and drops its entries
+        transaction.savepoint(optimistic=True)
+        self.folder.manage_renameObject('parent', 'moved')
+        moved = '/'.join(self.folder.moved.getPhysicalPath())
+        self.assertEqual(plugin.getLocalRolesForPrincipal('group'),
+                         {moved: ('Reviewer', )})
+
+        self.folder._delObject('moved')
+        self.assertEqual(plugin.getLocalRolesForPrincipal('group'), {})
+
+        plugin.removeLocalRolesIndex()
+        self.assertFalse(plugin.hasLocalRolesIndex())
@@ -453,6 +453,32 @@ class TestMembershipTool(base.TestCase, WarningInterceptor):
         self.assertEqual(member.__class__.__name__, 'MemberData')
         self.assertEqual(member.aq_parent.__class__.__name__, 'PloneUser')
 
+    def testSetLoginTimes(self):
+        member = self.membership.getAuthenticatedMember()
+        self.assertTrue(self.membership.setLoginTimes())
+        login_time = member.getProperty('login_time')
+        self.assertFalse(self.membership.setLoginTimes())
+        self.assertEqual(member.getProperty('last_login_time'), login_time)
+
+    def testSetLoginTimesGranularity(self):
+        self.membership.manage_changeProperties(login_time_granularity=3600)
+        member = self.membership.getAuthenticatedMember()
+        self.assertTrue(self.membership.setLoginTimes())
+        login_time = member.getProperty('login_time')
+        last_login_time = member.getProperty('last_login_time')
+
+        # logging in again within the hour stores nothing
+        self.assertFalse(self.membership.setLoginTimes())
+        self.assertEqual(member.getProperty('login_time'), login_time)
+        self.assertEqual(member.getProperty('last_login_time'),
+                         last_login_time)
+
+        yesterday = DateTime() - 1
+        member.setProperties(login_time=yesterday)
+        self.assertFalse(self.membership.setLoginTimes())
+        self.assertEqual(member.getProperty('last_login_time'), yesterday)
+        self.assertTrue(member.getProperty('login_time') > yesterday)
+
     def testGetAuthenticatedMemberIfAnonymous(self):
         self.logout()
         member = self.membership.getAuthenticatedMember()
@@ -586,6 +612,25 @@ class TestMembershipTool(base.TestCase, WarningInterceptor):
         self.assertTrue('Owner' in roles)
         self.assertEqual(len(roles), 1)
 
+    def testDeleteLocalRolesWithIndex(self):
+        self.setRoles(['Manager'])
+        self.folder.manage_setLocalRoles('user2', ('Reviewer', ))
+        # objects which are not content are left alone, as contentValues
+        # doesn't list them
+        self.folder.manage_addFolder('plain')
+        self.folder.plain.manage_setLocalRoles('user2', ('Reviewer', ))
+        self.portal.acl_users.local_roles.rebuildLocalRolesIndex()
+        self.membership.deleteLocalRoles(self.portal, ['user2'],
+                                         reindex=0, recursive=1)
+        self.assertEqual(self.folder.get_local_roles_for_userid('user2'), ())
+        self.assertEqual(
+            self.folder.plain.get_local_roles_for_userid('user2'),
+            ('Reviewer', ))
+        self.assertEqual(
+            self.portal.acl_users.local_roles.getLocalRolesForPrincipal(
+                'user2').keys(),
+            ['/'.join(self.folder.plain.getPhysicalPath())])
+
     def testGetCandidateLocalRolesForAssigned(self):
         self.folder._addRole('my_test_role')
         self.folder.manage_setLocalRoles(TEST_USER_ID, ('Reviewer', 'Owner'))
@@ -828,6 +873,38 @@ class TestSearchForMembers(base.TestCase, WarningInterceptor):
         self.assertEqual(len(search(roles=['Member'])), 3)
         self.assertEqual(len(search(roles=['Reviewer'])), 1)
 
+    def testSearchByGroupRoles(self):
+        groups = self.portal.portal_groups
+        groups.addGroup('editors', roles=['Editor'])
+        groups.addGroup('rubbles')
+        groups.addPrincipalToGroup('rubbles', 'editors')
+        groups.addPrincipalToGroup('barney', 'rubbles')
+
+        self.assertEqual(
+            self.membership._getRoleMemberIds(['Editor']),
+            set(['editors', 'rubbles', 'barney']))
+        self.assertEqual(
+            self.membership._getRoleMemberIds(['Editor', 'Reviewer']),
+            set(['editors', 'rubbles', 'barney', 'fred']))
+        search = self.membership.searchForMembers
+        self.assertEqual(
+            [member.getId() for member in search(roles=['Editor'])],
+            ['barney'])
+        self.assertEqual(len(search(roles=['Editor', 'Reviewer'])), 2)
+        self.assertEqual(len(search(roles=['Authenticated'])), 3)
+
+    def testSearchWithStalePropertyRecord(self):
+        # removing a user from its source leaves its property record
+        # behind, which is still found by the properties plugin
+        self.portal.acl_users.source_users.removeUser('brubble')
+        results = self.membership.lazySearchForMembers()
+        self.assertEqual(len(results), 2)
+        self.assertFalse(None in list(results))
+        self.assertEqual(
+            sorted(member.getId() for member in self.membership.
+                   searchForMembers(b_start=0, b_size=2)),
+            ['barney', 'fred'])
+
     def testSearchByNameAndEmail(self):
         search = self.membership.searchForMembers
         self.assertEqual(len(search(name='rubble', email='bedrock')), 1)
@@ -843,6 +920,96 @@ class TestSearchForMembers(base.TestCase, WarningInterceptor):
         self.assertEqual(len(search(email='fred', roles=['Reviewer'])), 1)
         self.assertEqual(len(search(email='fred', roles=['Manager'])), 0)
 
+    def testSearchByGroupname(self):
+        groups = self.portal.portal_groups
+        groups.addGroup('flintstones')
+        groups.addGroup('bedrock')
+        groups.addPrincipalToGroup('fred', 'flintstones')
+        groups.addPrincipalToGroup('flintstones', 'bedrock')
+
+        self.assertEqual(self.membership._getGroupMemberIds(['bedrock']),
+                         set(['flintstones', 'fred']))
+        search = self.membership.searchForMembers
+        self.assertEqual(
+            [member.getId() for member in search(groupname='flintstones')],
+            ['fred'])
+        self.assertEqual(
+            [member.getId() for member in search(groupname='bedrock')],
+            ['fred'])
+        self.assertEqual(len(search(groupname='bedrock', name='rubble')), 0)
+
+    def testSearchBatched(self):
+        search = self.membership.searchForMembers
+        everybody = [member.getId() for member in search()]
+        self.assertEqual(len(everybody), 3)
+        self.assertEqual(
+            [member.getId() for member in search(b_start=1, b_size=1)],
+            everybody[1:2])
+        self.assertEqual(
+            [member.getId() for member in search(b_start=2)],
+            everybody[2:])
+
+        results = self.membership.lazySearchForMembers(name='rubble')
+        self.assertEqual(len(results), 2)
+        self.assertEqual(
+            sorted([member.getId() for member in results]),
+            ['barney', 'brubble'])
+
+        # without filters the members are fetched a chunk at a time
+        acl_users = self.portal.acl_users
+        getUsersByIds = acl_users._getUsersByIds
+        calls = []
+
+        def _getUsersByIds(user_ids, request=None):
+            calls.append(list(user_ids))
+            return getUsersByIds(user_ids, request)
+
+        acl_users._getUsersByIds = _getUsersByIds
+        try:
+            results = self.membership.lazySearchForMembers()
+            self.assertEqual(calls, [])
+            self.assertEqual([member.getId() for member in results[1:3]],
+                             everybody[1:3])
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(results[-1].getId(), everybody[-1])
+            self.assertEqual(len(calls), 1)
+        finally:
+            del acl_users._getUsersByIds
+
+    def testSearchByLastLoginTime(self):
+        self.assertEqual(
+            sorted(self.membership._filterByLoginTime(
+                ['fred', 'barney', 'brubble'], DateTime('2003-01-01'),
+                before=True)),
+            ['barney', 'fred'])
+        search = self.membership.searchForMembers
+        self.assertEqual(
+            [member.getId() for member in search(
+                last_login_time=DateTime('2003-01-01'))],
+            ['brubble'])
+        self.assertEqual(
+            len(search(last_login_time=DateTime('2002-01-01'),
+                       before_specified_time=True)), 0)
+        self.assertEqual(
+            len(search(last_login_time=DateTime('2002-01-01'))), 3)
+
+        # members who never logged in count as of 2000/01/01
+        self.addMember('wilma', 'Wilma Flintstone',
+                       'wilma@bedrock.com', ['Member'], '2010-01-01')
+        wilma = self.membership.getMemberById('wilma')
+        self.portal.acl_users.mutable_properties.deleteUser('wilma')
+        self.assertEqual(
+            [member.getId() for member in search(
+                last_login_time=DateTime('2001-01-01'),
+                before_specified_time=True)],
+            ['wilma'])
+
+        # logging in moves a member out of the inactive ones
+        wilma.setMemberProperties({'last_login_time': DateTime()})
+        self.assertEqual(
+            len(search(last_login_time=DateTime('2001-01-01'),
+                       before_specified_time=True)), 0)
+
     def testSearchByRequestObj(self):
         search = self.membership.searchForMembers
         self.addMember(u'jürgen', u'Jürgen Internationalist',
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
+from DateTime import DateTime
 from Products.CMFCore.utils import getToolByName
+from Products.PlonePAS.plugins.property import PersistentProperties
 from Products.PlonePAS.plugins.property import ZODBMutablePropertyProvider
+from Products.PlonePAS.setuphandlers import rebuildPluginIndexes
 from Products.PlonePAS.tests import base
 from Products.PluggableAuthService.interfaces.plugins import \
     IUserEnumerationPlugin
+from ZODB.POSException import ConflictError
 
 
 class PropertiesTest(base.TestCase):
@@ -151,6 +155,136 @@ class PropertiesTest(base.TestCase):
         expected = 'group1@anotherhost.qa'
         self.assertEqual(got, expected)
 
+    def test_schema_cached_until_datatool_changes(self):
+        md = getToolByName(self.portal, 'portal_memberdata')
+        provider = self.portal.acl_users.mutable_properties
+
+        schema = provider._getSchema()
+        defaults = provider._getDefaultValues()
+        self.assertTrue(provider._getSchema() is schema)
+        self.assertTrue(provider._getDefaultValues() is defaults)
+        self.assertFalse(('age', 'int') in schema)
+
+        md.manage_addProperty('age', 20, 'int')
+        self.assertTrue(('age', 'int') in provider._getSchema())
+        self.assertEqual(provider._getDefaultValues()['age'], 20)
+
+        md.manage_changeProperties(age=30)
+        self.assertEqual(provider._getDefaultValues()['age'], 30)
+
+        md.manage_delProperties(ids=('age',))
+        self.assertFalse(('age', 'int') in provider._getSchema())
+
+    def test_mutable_defaults_not_shared(self):
+        md = getToolByName(self.portal, 'portal_memberdata')
+        mt = getToolByName(self.portal, 'portal_membership')
+        mt.addMember('member1', 'pw', ['Member'], [], {})
+        mt.addMember('member2', 'pw', ['Member'], [], {})
+        md.manage_addProperty('flavours', 'propertyIds', 'multiple selection')
+        provider = self.portal.acl_users.mutable_properties
+        users = [self.portal.acl_users.getUserById('member1'),
+                 self.portal.acl_users.getUserById('member2')]
+
+        sheets = provider.getPropertiesForUsers(users)
+        sheets[0].getProperty('flavours').append('vanilla')
+        self.assertEqual(sheets[1].getProperty('flavours'), [])
+        self.assertEqual(provider._getDefaultValues()['flavours'], [])
+        sheet = provider.getPropertiesForUser(users[0])
+        self.assertEqual(sheet.getProperty('flavours'), [])
+
+    def test_properties_for_users(self):
+        mt = getToolByName(self.portal, 'portal_membership')
+        gt = getToolByName(self.portal, 'portal_groups')
+        mt.addMember('member1', 'pw', ['Member'], [],
+                     {'email': 'member1@host.com'})
+        gt.addGroup('group1', title='Group 1')
+        provider = self.portal.acl_users.mutable_properties
+
+        user = self.portal.acl_users.getUserById('member1')
+        group = gt.getGroupById('group1').getGroup()
+        sheets = provider.getPropertiesForUsers([user, group, user])
+        self.assertEqual(len(sheets), 3)
+        self.assertEqual(sheets[0].getProperty('email'), 'member1@host.com')
+        self.assertEqual(sheets[1].getProperty('title'), 'Group 1')
+        self.assertEqual(sheets[2].propertyItems(), sheets[0].propertyItems())
+        self.assertEqual(
+            provider.getPropertiesForUser(user).propertyItems(),
+            sheets[0].propertyItems())
+
+    def test_persistent_records(self):
+        mt = getToolByName(self.portal, 'portal_membership')
+        mt.addMember('member1', 'pw', ['Member'], [],
+                     {'email': 'member1@host.com'})
+        provider = self.portal.acl_users.mutable_properties
+        record = provider._storage['member1']
+        self.assertTrue(isinstance(record, PersistentProperties))
+
+        # records stored as plain dicts are converted on write
+        provider._storage['member1'] = dict(record)
+        member = mt.getMemberById('member1')
+        member.setMemberProperties({'fullname': 'Member #1'})
+        record = provider._storage['member1']
+        self.assertTrue(isinstance(record, PersistentProperties))
+        self.assertEqual(record['fullname'], 'Member #1')
+        self.assertEqual(record['email'], 'member1@host.com')
+
+        provider._storage['member1'] = dict(record)
+        self.assertEqual(provider.migrateRecords(), 1)
+        self.assertEqual(provider.migrateRecords(), 0)
+        self.assertEqual(provider._storage['member1']['fullname'],
+                         'Member #1')
+
+    def test_unchanged_properties_not_written(self):
+        mt = getToolByName(self.portal, 'portal_membership')
+        mt.addMember('member1', 'pw', ['Member'], [],
+                     {'email': 'member1@host.com', 'fullname': 'Member'})
+        provider = self.portal.acl_users.mutable_properties
+        # a plain dict record shows whether it was written, as writing
+        # converts it
+        provider._storage['member1'] = dict(provider._storage['member1'])
+
+        member = mt.getMemberById('member1')
+        member.setMemberProperties(
+            {'email': 'member1@host.com', 'fullname': 'Member'})
+        self.assertTrue(isinstance(provider._storage['member1'], dict))
+        user = self.portal.acl_users.getUserById('member1')
+        sheet = provider.getPropertiesForUser(user)
+        provider.setPropertiesForUser(user, sheet)
+        self.assertTrue(isinstance(provider._storage['member1'], dict))
+
+        member.setMemberProperties(
+            {'email': 'member1@host.com', 'fullname': 'Member #1'})
+        record = provider._storage['member1']
+        self.assertTrue(isinstance(record, PersistentProperties))
+        self.assertEqual(record['fullname'], 'Member #1')
+        self.assertEqual(record['email'], 'member1@host.com')
+
+    def test_resolve_record_conflicts(self):
+        record = PersistentProperties()
+        old = {'data': {'email': 'a@host.com', 'fullname': 'A'}}
+
+        # changes to different properties are merged
+        saved = {'data': {'email': 'b@host.com', 'fullname': 'A'}}
+        new = {'data': {'email': 'a@host.com', 'fullname': 'B',
+                        'location': 'Here'}}
+        self.assertEqual(
+            record._p_resolveConflict(old, saved, new),
+            {'data': {'email': 'b@host.com', 'fullname': 'B',
+                      'location': 'Here'}})
+
+        # so are identical changes and removals
+        saved = {'data': {'email': 'b@host.com', 'fullname': 'A'}}
+        new = {'data': {'email': 'b@host.com'}}
+        self.assertEqual(
+            record._p_resolveConflict(old, saved, new),
+            {'data': {'email': 'b@host.com'}})
+
+        # different changes of the same property conflict
+        saved = {'data': {'email': 'b@host.com', 'fullname': 'A'}}
+        new = {'data': {'email': 'c@host.com', 'fullname': 'A'}}
+        self.assertRaises(ConflictError, record._p_resolveConflict,
+                          old, saved, new)
+
     def test_schema_for_mutable_property_provider(self):
         """Add a schema to a ZODBMutablePropertyProvider.
         """
@@ -287,3 +421,110 @@ class PropertySearchTest(base.TestCase):
         # or login
         results = self.pas.searchUsers(login='member1')
         self.assertEqual(results, ())
+
+    def testShortSubstringSearch(self):
+        results = self.pas.searchUsers(email="2@", exact_match=False)
+        results = [info['userid'] for info in results]
+        self.assertEqual(results, ['member2'])
+
+    def testSearchFollowsPropertyChanges(self):
+        member = self.mt.getMemberById('member1')
+        member.setMemberProperties({'email': 'changed@example.org'})
+
+        results = self.pas.searchUsers(email="@host.com", exact_match=False)
+        self.assertEqual(results, ())
+
+        results = self.pas.searchUsers(email="example.org", exact_match=False)
+        results = [info['userid'] for info in results]
+        self.assertEqual(results, ['member1'])
+
+        self.pas.mutable_properties.deleteUser('member1')
+        results = self.pas.searchUsers(email="example.org", exact_match=False)
+        self.assertEqual(results, ())
+
+    def testSearchWithoutIndexes(self):
+        # Providers created before the indexes existed keep working
+        # until the upgrade step rebuilds their indexes.
+        provider = self.pas.mutable_properties
+        del provider._value_index
+        results = provider.enumerateUsers(email="@host.com")
+        self.assertEqual([info['id'] for info in results], ['member1'])
+
+        rebuildPluginIndexes(self.portal.portal_setup)
+        self.assertEqual(list(provider._findCandidates({'email': 'host'})),
+                         ['member1', 'member2'])
+        results = provider.enumerateUsers(email="@host.com")
+        self.assertEqual([info['id'] for info in results], ['member1'])
+
+    def testFilterByDate(self):
+        provider = self.pas.mutable_properties
+        member = self.mt.getMemberById('member1')
+        member.setMemberProperties(
+            {'last_login_time': DateTime('2010/01/01 12:00:00.5 GMT')})
+        member = self.mt.getMemberById('member2')
+        member.setMemberProperties(
+            {'last_login_time': DateTime('2012/06/01 GMT')})
+        user_ids = ['member1', 'member2', 'group1', 'unknown']
+
+        self.assertEqual(
+            provider.filterUserIdsByDate(
+                'last_login_time', user_ids, min=DateTime('2011/01/01')),
+            ['member2'])
+        self.assertEqual(
+            provider.filterUserIdsByDate(
+                'last_login_time', user_ids, max=DateTime('2011/01/01')),
+            ['member1', 'group1', 'unknown'])
+
+        # values within the same index range as a bound are compared
+        # exactly
+        self.assertEqual(
+            provider.filterUserIdsByDate(
+                'last_login_time', ['member1'],
+                min=DateTime('2010/01/01 12:00:00.25 GMT'),
+                max=DateTime('2010/01/01 12:00:00.75 GMT')),
+            ['member1'])
+        self.assertEqual(
+            provider.filterUserIdsByDate(
+                'last_login_time', ['member1'],
+                max=DateTime('2010/01/01 12:00:00.25 GMT')),
+            [])
+
+        # string values are read as dates
+        member.setMemberProperties({'last_login_time': ''})
+        self.assertEqual(
+            provider.filterUserIdsByDate(
+                'last_login_time', ['member2'], max=DateTime('2001/01/01')),
+            ['member2'])
+
+        self.assertEqual(
+            provider.filterUserIdsByDate('fullname', user_ids), None)
+        del provider._date_index
+        self.assertEqual(
+            provider.filterUserIdsByDate('last_login_time', user_ids), None)
+        rebuildPluginIndexes(self.portal.portal_setup)
+        self.assertEqual(
+            provider.filterUserIdsByDate(
+                'last_login_time', user_ids, min=DateTime('2009/01/01')),
+            ['member1'])
+
+    def testDateIndexRanges(self):
+        # changes within the same index range leave the index alone, so
+        # logins don't conflict on it
+        provider = self.pas.mutable_properties
+        member = self.mt.getMemberById('member1')
+        member.setMemberProperties(
+            {'login_time': DateTime('2010/01/01 12:00:00 GMT')})
+        key = provider._date_keys['login_time']['member1']
+        self.assertEqual(key % 3600, 0)
+
+        indexed = []
+        provider._indexDate = lambda *args: indexed.append(args)
+        try:
+            member.setMemberProperties(
+                {'login_time': DateTime('2010/01/01 12:30:00 GMT')})
+            self.assertEqual(indexed, [])
+            member.setMemberProperties(
+                {'login_time': DateTime('2010/01/01 13:30:00 GMT')})
+            self.assertEqual(len(indexed), 1)
+        finally:
+            del provider._indexDate
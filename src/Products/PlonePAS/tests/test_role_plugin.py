@@ -2,6 +2,8 @@
 # $Id$
 """Tests for Products.PlonePAS.plugins.role.GroupAwareRoleManager"""
 
+from Products.PlonePAS.plugins.group import GroupManager
+from Products.PlonePAS.setuphandlers import rebuildPluginIndexes
 from Products.PlonePAS.tests import base
 from Products.PluggableAuthService.PluggableAuthService import \
     _PLUGIN_TYPE_INFO
@@ -22,6 +24,24 @@ class FauxGroupsPlugin(BasePlugin):
         return principal._groups
 
 
+class CountingGroupsPlugin(FauxGroupsPlugin):
+
+    calls = 0
+
+    def getGroupsForPrincipal(self, principal, request=None):
+        self.calls += 1
+        return principal._groups
+
+
+class CountingGroupManager(GroupManager):
+
+    calls = 0
+
+    def getGroupsForPrincipal(self, principal, request=None):
+        self.calls += 1
+        return principal._groups
+
+
 class GroupAwareRoleManagerTests(base.TestCase):
     """Roles manager that takes care of goup of principal"""
 
@@ -84,3 +104,144 @@ class GroupAwareRoleManagerTests(base.TestCase):
         self.assertEqual(got, ('bar_role',))
 
         return
+
+    def test_roles_cached_during_request(self):
+        root = FauxPAS()
+        root._setObject('plugins', PluginRegistry(_PLUGIN_TYPE_INFO))
+        root._setObject('groups', CountingGroupManager('groups'))
+        root['plugins'].activatePlugin(IGroupsPlugin, 'groups')
+
+        garm = self._makeOne('garm').__of__(root)
+        garm.addRole('foo_role')
+        garm.addRole('bar_role')
+        garm.assignRoleToPrincipal('bar_role', 'somegroup')
+        johndoe = DummyUser('johndoe', ('somegroup',))
+
+        for i in range(10):
+            self.assertEqual(garm.getRolesForPrincipal(johndoe),
+                             ('bar_role',))
+        self.assertEqual(root.groups.calls, 1)
+
+        # the flags are part of the key
+        garm.REQUEST.set('__ignore_group_roles__', True)
+        self.assertEqual(garm.getRolesForPrincipal(johndoe), ())
+        garm.REQUEST.set('__ignore_group_roles__', False)
+        self.assertEqual(garm.getRolesForPrincipal(johndoe), ('bar_role',))
+        self.assertEqual(root.groups.calls, 1)
+
+        # changing role assignments invalidates the cache
+        garm.assignRoleToPrincipal('foo_role', 'johndoe')
+        self.assertEqual(set(garm.getRolesForPrincipal(johndoe)),
+                         set(['foo_role', 'bar_role']))
+        garm.removeRoleFromPrincipal('bar_role', 'somegroup')
+        self.assertEqual(garm.getRolesForPrincipal(johndoe), ('foo_role',))
+        garm.assignRolesToPrincipal(('bar_role',), 'johndoe')
+        self.assertEqual(garm.getRolesForPrincipal(johndoe), ('bar_role',))
+        garm.removeRole('bar_role')
+        self.assertEqual(garm.getRolesForPrincipal(johndoe), ())
+        self.assertEqual(root.groups.calls, 5)
+
+    def test_roles_not_cached_for_other_groups_plugins(self):
+        # other groups plugins don't tell when the groups they return
+        # change, so only users knowing their groups are cached
+        root = FauxPAS()
+        root._setObject('plugins', PluginRegistry(_PLUGIN_TYPE_INFO))
+        root._setObject('groups', CountingGroupsPlugin())
+        root['plugins'].activatePlugin(IGroupsPlugin, 'groups')
+
+        garm = self._makeOne('garm').__of__(root)
+        garm.addRole('bar_role')
+        garm.assignRoleToPrincipal('bar_role', 'somegroup')
+        johndoe = DummyUser('johndoe', ('somegroup',))
+        for i in range(3):
+            self.assertEqual(garm.getRolesForPrincipal(johndoe),
+                             ('bar_role',))
+        self.assertEqual(root.groups.calls, 3)
+
+        johndoe._groups = ()
+        self.assertEqual(garm.getRolesForPrincipal(johndoe), ())
+
+        # users built by PAS are cached by the ids of their groups
+        johndoe._principal_ids = frozenset(['johndoe', 'somegroup'])
+        self.assertEqual(garm.getRolesForPrincipal(johndoe), ('bar_role',))
+        johndoe._principal_ids = frozenset(['johndoe'])
+        self.assertEqual(garm.getRolesForPrincipal(johndoe), ())
+        self.assertEqual(root.groups.calls, 4)
+
+    def test_role_principals_index(self):
+        garm = self._makeOne('garm')
+        garm.addRole('foo_role')
+        garm.addRole('bar_role')
+
+        garm.assignRoleToPrincipal('foo_role', 'johndoe')
+        garm.assignRolesToPrincipal(('foo_role', 'bar_role'), 'janedoe')
+        self.assertEqual(sorted(garm.getPrincipalIdsWithRoles(['foo_role'])),
+                         ['janedoe', 'johndoe'])
+        self.assertEqual(garm.getPrincipalIdsWithRoles(['bar_role']),
+                         ['janedoe'])
+
+        garm.removeRoleFromPrincipal('foo_role', 'janedoe')
+        self.assertEqual(garm.getPrincipalIdsWithRoles(['foo_role']),
+                         ['johndoe'])
+        garm.assignRolesToPrincipal((), 'janedoe')
+        self.assertEqual(garm.getPrincipalIdsWithRoles(['bar_role']), [])
+        self.assertEqual(list(garm._role_principals.keys()), ['foo_role'])
+
+        # without the index the principals are scanned
+        garm._role_principals = None
+        self.assertEqual(garm.getPrincipalIdsWithRoles(['foo_role']),
+                         ['johndoe'])
+        garm.rebuildIndexes()
+        self.assertEqual(list(garm._role_principals['foo_role']),
+                         ['johndoe'])
+
+    def test_remove_methods_protected(self):
+        from Products.PlonePAS.plugins.role import GroupAwareRoleManager
+        for name in ('removeRole', 'removeRoleFromPrincipal'):
+            self.assertEqual(
+                getattr(GroupAwareRoleManager, name + '__roles__').__name__,
+                '_Manage_users_Permission')
+
+    def test_getEffectiveUserIdsWithRoles(self):
+        acl_users = self.portal.acl_users
+        garm = acl_users.portal_role_manager
+        garm._role_principals = None
+        rebuildPluginIndexes(self.portal.portal_setup)
+        self.assertTrue(garm._role_principals is not None)
+        before = garm.getEffectiveUserIdsWithRoles(['Editor'])
+
+        groups = acl_users.source_groups
+        groups.addGroup('editors')
+        groups.addGroup('chiefs')
+        groups.addPrincipalToGroup('chiefs', 'editors')
+        groups.addPrincipalToGroup('fred', 'chiefs')
+        groups.addPrincipalToGroup('barney', 'editors')
+        garm.assignRoleToPrincipal('Editor', 'editors')
+        garm.assignRoleToPrincipal('Editor', 'wilma')
+
+        principal_ids = garm.getEffectiveUserIdsWithRoles(['Editor'])
+        self.assertEqual(principal_ids - before,
+                         set(['editors', 'chiefs', 'fred', 'barney',
+                              'wilma']))
+        self.assertEqual(
+            sorted(info[0] for info in garm.listAssignedPrincipals('Editor')),
+            sorted(garm.getPrincipalIdsWithRoles(['Editor'])))
+        self.assertEqual(garm.listAssignedPrincipals('Unassigned'), [])
+
+        # everybody is in the group of the automatic group plugin
+        garm.assignRoleToPrincipal('Reviewer', 'AuthenticatedUsers')
+        self.assertEqual(garm.getEffectiveUserIdsWithRoles(['Reviewer']),
+                         None)
+
+        # without the recursive groups plugin nested groups don't count
+        acl_users.plugins.deactivatePlugin(IGroupsPlugin, 'recursive_groups')
+        principal_ids = garm.getEffectiveUserIdsWithRoles(['Editor'])
+        self.assertEqual(principal_ids - before,
+                         set(['editors', 'chiefs', 'barney', 'wilma']))
+
+        # groups plugins which can't list their members prevent an answer
+        faux_groups = FauxGroupsPlugin()
+        faux_groups._setId('faux_groups')
+        acl_users._setObject('faux_groups', faux_groups)
+        acl_users.plugins.activatePlugin(IGroupsPlugin, 'faux_groups')
+        self.assertEqual(garm.getEffectiveUserIdsWithRoles(['Editor']), None)
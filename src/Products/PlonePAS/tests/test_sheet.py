@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from DateTime import DateTime
+from Products.PlonePAS.sheet import MutablePropertySheet
+from Products.PlonePAS.sheet import PropertySchema
+from Products.PlonePAS.sheet import PropertySchemaTypeMap
+from Products.PlonePAS.sheet import PropertyValueError
+import unittest
+
+SCHEMA = (
+    ('fullname', 'string'),
+    ('email', 'string'),
+    ('home_page', 'string'),
+    ('location', 'string'),
+    ('description', 'text'),
+    ('language', 'string'),
+    ('visible_ids', 'boolean'),
+    ('wysiwyg_editor', 'string'),
+    ('login_time', 'date'),
+    ('last_login_time', 'date'),
+)
+
+PROFILES = 100
+
+
+class CountingTypeMap(PropertySchemaTypeMap):
+
+    def __init__(self):
+        PropertySchemaTypeMap.__init__(self)
+        self.checks = 0
+        for ptype, inspector in PropertySchema._ptypes:
+            self.addType(ptype, self._counting(inspector))
+
+    def _counting(self, inspector):
+        def inspect(value):
+            self.checks += 1
+            return inspector(value)
+        return inspect
+
+
+class PropertySchemaTest(unittest.TestCase):
+
+    def test_getTypeFor(self):
+        self.assertEqual(PropertySchema.getTypeFor('foo'), 'string')
+
+        types = PropertySchemaTypeMap()
+        types.addType('string', lambda x: isinstance(x, basestring))
+        types.addType('int', lambda x: isinstance(x, int), order=0)
+        self.assertEqual(types.getTypeFor(1), 'int')
+        self.assertEqual(types.getTypeFor('1'), 'string')
+        self.assertRaises(TypeError, types.getTypeFor, 1.0)
+
+    def test_compileSchema(self):
+        compiled = PropertySchema.compileSchema(SCHEMA)
+        self.assertTrue(PropertySchema.compileSchema(list(SCHEMA))
+                        is compiled)
+        self.assertEqual(sorted(compiled), sorted(dict(SCHEMA)))
+        self.assertEqual(compiled['email'][0], 'string')
+
+        # registering a type forgets the compiled schemas
+        types = PropertySchemaTypeMap()
+        types.addType('string', lambda x: isinstance(x, basestring))
+        compiled = types.compileSchema(SCHEMA[:1])
+        types.addType('int', lambda x: isinstance(x, int))
+        self.assertFalse(types.compileSchema(SCHEMA[:1]) is compiled)
+
+    def test_validateProperties(self):
+        validate = PropertySchema.validateProperties
+        self.assertEqual(
+            validate(SCHEMA, {'fullname': u'Fred', 'visible_ids': True,
+                              'unknown': 1}),
+            None)
+        self.assertEqual(
+            validate(SCHEMA, {'fullname': u'Fred', 'email': 1}),
+            ('email', 'string'))
+        self.assertRaises(KeyError, validate,
+                          (('foo', 'unknown type'),), {'foo': 1})
+
+    def test_sheet_validateProperties(self):
+        sheet = MutablePropertySheet(
+            'mutable_properties', schema=SCHEMA[:2],
+            fullname='Fred', email='fred@bedrock.com')
+        sheet.validateProperties({'fullname': 'Barney'})
+        self.assertRaises(PropertyValueError, sheet.validateProperties,
+                          {'fullname': 1})
+        self.assertRaises(PropertyValueError, sheet.validateProperties,
+                          {'location': 'Bedrock'})
+        self.assertRaises(PropertyValueError, sheet.validateProperty,
+                          'email', 2)
+
+
+class BulkValidationTests(unittest.TestCase):
+    """Validates the profiles of a bulk import of PROFILES members.
+
+    Each value is checked by exactly one inspector and the schema is
+    compiled once for all profiles, so the cost grows linearly with the
+    number of profiles; counting the checks of a few suffices.
+    """
+
+    def profiles(self):
+        now = DateTime()
+        for i in xrange(PROFILES):
+            yield {
+                'fullname': u'Member %d' % i,
+                'email': 'member%d@example.org' % i,
+                'home_page': '',
+                'location': u'Bedrock',
+                'description': u'',
+                'language': 'en',
+                'visible_ids': False,
+                'wysiwyg_editor': 'TinyMCE',
+                'login_time': now,
+                'last_login_time': now,
+            }
+
+    def test_bulk_validation(self):
+        types = CountingTypeMap()
+        compiled = types.compileSchema(SCHEMA)
+        invalid = set([types.validateProperties(SCHEMA, profile)
+                       for profile in self.profiles()])
+        self.assertEqual(invalid, set([None]))
+        self.assertEqual(types.checks, PROFILES * len(SCHEMA))
+        self.assertTrue(types.compileSchema(SCHEMA) is compiled)
+        self.assertEqual(len(types._compiled), 1)
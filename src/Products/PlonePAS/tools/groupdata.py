@@ -22,6 +22,8 @@ from Products.PlonePAS.interfaces.group import IGroupManagement
 from Products.PlonePAS.interfaces.propertysheets import IMutablePropertySheet
 from Products.PlonePAS.tools.memberdata import MemberData
 from Products.PlonePAS.utils import CleanupTemp
+from Products.PlonePAS.utils import PropertyMapVersioned
+from Products.PlonePAS.utils import getChangedProperties
 from Products.PluggableAuthService.PluggableAuthService import \
     _SWALLOWABLE_PLUGIN_EXCEPTIONS
 from Products.PluggableAuthService.interfaces.authservice import \
@@ -36,7 +38,8 @@ _marker = object()
 
 
 @implementer(IGroupDataTool)
-class GroupDataTool(UniqueObject, SimpleItem, PropertyManager):
+class GroupDataTool(PropertyMapVersioned, UniqueObject, SimpleItem,
+                    PropertyManager):
     """This tool wraps group objects, allowing transparent access to
     properties.
     """
@@ -159,27 +162,8 @@ class GroupData(SimpleItem):
         Returns a list of the portal_memberdata-ish members of the group.
         This doesn't include TRANSITIVE groups/users.
         """
-        md = self.portal_memberdata
         gtool = self.portal_groups
-        ret = []
-        for u_name in gtool.getGroupMembers(self.getId()):
-            usr = self._getGRUF().getUserById(u_name)
-            # getUserById from
-            #   Products.PluggableAuthService.PluggableAuthService
-            # The returned object is not wrapped, we wrapped it below
-            if not usr:
-                usr = self._getGRUF().getGroupById(u_name)
-                # getGroupById from Products.PlonePAS.pas
-                # The returned object is already wrapped
-                if not usr:
-                    logger.debug(
-                        "Group has a non-existing principal {0}".format(u_name)
-                    )
-                    continue
-                ret.append(usr)
-            else:
-                ret.append(md.wrapUser(usr))
-        return ret
+        return self._getMembers(gtool.getGroupMembers(self.getId()))
 
     @security.public
     def getAllGroupMembers(self):
@@ -187,16 +171,33 @@ class GroupData(SimpleItem):
         Returns a list of the portal_memberdata-ish members of the group.
         This will include transitive groups / users
         """
+        return self._getMembers(self.getGroup().getMemberIds())
+
+    def _getMembers(self, member_ids):
+        """Returns the portal_memberdata-ish members for member_ids.
+
+        The users are looked up in one go, so their property sheets are
+        filled with one call per properties plugin.
+        """
         md = self.portal_memberdata
+        acl_users = self._getGRUF()
+        # don't look up principals again which were not found recently
+        member_ids = [u_name for u_name in member_ids
+                      if not acl_users._isUnknownPrincipal(u_name)]
         ret = []
-        for u_name in self.getGroup().getMemberIds():
-            usr = self._getGRUF().getUserById(u_name)
+        for u_name, usr in zip(member_ids,
+                               acl_users._getUsersByIds(member_ids)):
+            # _getUsersByIds from Products.PlonePAS.pas
+            # The returned objects are not wrapped, we wrap them below
             if not usr:
-                usr = self._getGRUF().getGroupById(u_name)
+                usr = acl_users.getGroupById(u_name)
+                # getGroupById from Products.PlonePAS.pas
+                # The returned object is already wrapped
                 if not usr:
                     logger.debug(
                         "Group has a non-existing principal {0}".format(u_name)
                     )
+                    acl_users._setUnknownPrincipal(u_name)
                     continue
                 ret.append(usr)
             else:
@@ -309,17 +310,24 @@ class GroupData(SimpleItem):
         # If we got this far, we have a PAS and some property sheets.
         # XXX track values set to defer to default impl
         # property routing?
-        modified = False
+        # Collect the values per sheet first, so each sheet is written
+        # once and only with the values which actually change.
+        updates = [{} for sheet in sheets]
         for k, v in mapping.items():
-            for sheet in sheets:
+            for sheet, update in zip(sheets, updates):
                 if not sheet.hasProperty(k):
                     continue
                 if IMutablePropertySheet.providedBy(sheet):
-                    sheet.setProperty(group, k, v)
-                    modified = True
+                    update[k] = v
                 else:
                     raise RuntimeError("Mutable property provider "
                                        "shadowed by read only provider")
+        modified = False
+        for sheet, update in zip(sheets, updates):
+            update = getChangedProperties(sheet, update)
+            if update:
+                sheet.setProperties(group, update)
+                modified = True
         if modified:
             self.notifyModified()
 
@@ -14,6 +14,7 @@ from Products.PlonePAS.permissions import DeleteGroups
 from Products.PlonePAS.permissions import ManageGroups
 from Products.PlonePAS.permissions import SetGroupOwnership
 from Products.PlonePAS.permissions import ViewGroups
+from Products.PlonePAS.plugins.local_role import unindexPrincipal
 from Products.PlonePAS.utils import getGroupsForPrincipal
 from Products.PluggableAuthService.PluggableAuthService import \
     _SWALLOWABLE_PLUGIN_EXCEPTIONS
@@ -162,6 +163,8 @@ class GroupsTool(UniqueObject, SimpleItem):
             if manager.removeGroup(group_id):
                 retval = True
 
+        if retval:
+            unindexPrincipal(self, group_id)
         return retval
 
     @security.protected(DeleteGroups)
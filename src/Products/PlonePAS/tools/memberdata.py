@@ -16,6 +16,8 @@ from Products.PlonePAS.interfaces.capabilities import IPasswordSetCapability
 from Products.PlonePAS.interfaces.group import IGroupManagement
 from Products.PlonePAS.interfaces.plugins import IUserManagement
 from Products.PlonePAS.interfaces.propertysheets import IMutablePropertySheet
+from Products.PlonePAS.utils import PropertyMapVersioned
+from Products.PlonePAS.utils import getChangedProperties
 from Products.PluggableAuthService.interfaces.authservice import \
     IPluggableAuthService
 from Products.PluggableAuthService.interfaces.plugins import IPropertiesPlugin
@@ -26,7 +28,7 @@ from zope.interface import implementer
 _marker = object()
 
 
-class MemberDataTool(BaseTool):
+class MemberDataTool(PropertyMapVersioned, BaseTool):
     """PAS-specific implementation of memberdata tool.
     """
 
@@ -271,18 +273,25 @@ class MemberData(BaseMemberData):
         # If we got this far, we have a PAS and some property sheets.
         # XXX track values set to defer to default impl
         # property routing?
-        modified = False
+        # Collect the values per sheet first, so each sheet is written
+        # once and only with the values which actually change.
+        updates = [{} for sheet in sheets]
         for k, v in mapping.items():
             if v is None and not force_empty:
                 continue
-            for sheet in sheets:
+            for sheet, update in zip(sheets, updates):
                 if not sheet.hasProperty(k):
                     continue
                 if IMutablePropertySheet.providedBy(sheet):
-                    sheet.setProperty(user, k, v)
-                    modified = True
+                    update[k] = v
                 else:
                     break
+        modified = False
+        for sheet, update in zip(sheets, updates):
+            update = getChangedProperties(sheet, update)
+            if update:
+                sheet.setProperties(user, update)
+                modified = True
         if modified:
             self.notifyModified()
 
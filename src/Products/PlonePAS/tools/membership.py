@@ -4,6 +4,7 @@ from AccessControl import Unauthorized
 from AccessControl import getSecurityManager
 from AccessControl.SecurityManagement import noSecurityManager
 from AccessControl.requestmethod import postonly
+from Acquisition import aq_base
 from Acquisition import aq_get
 from Acquisition import aq_inner
 from Acquisition import aq_parent
@@ -13,6 +14,7 @@ from DateTime import DateTime
 from OFS.Image import Image
 from Products.CMFCore.MembershipTool import MembershipTool as BaseTool
 from Products.CMFCore.interfaces import IPropertiesTool
+from Products.CMFCore.permissions import ChangeLocalRoles
 from Products.CMFCore.permissions import ListPortalMembers
 from Products.CMFCore.permissions import ManagePortal
 from Products.CMFCore.permissions import ManageUsers
@@ -26,8 +28,14 @@ from Products.PlonePAS.events import UserInitialLoginInEvent
 from Products.PlonePAS.events import UserLoggedInEvent
 from Products.PlonePAS.events import UserLoggedOutEvent
 from Products.PlonePAS.interfaces import membership
+from Products.PlonePAS.interfaces.plugins import ILocalRolesPlugin
 from Products.PlonePAS.utils import cleanId
+from Products.PlonePAS.utils import getGroupMemberIds
 from Products.PlonePAS.utils import scale_image
+from Products.PluggableAuthService.interfaces.plugins \
+    import IPropertiesPlugin
+from Products.PluggableAuthService.interfaces.plugins import IRolesPlugin
+from Products.ZCatalog.Lazy import Lazy
 from ZODB.POSException import ConflictError
 from cStringIO import StringIO
 from plone.protect.interfaces import IDisableCSRFProtection
@@ -65,6 +73,33 @@ def _unicodify_structure(value, charset=_marker):
     return value
 
 
+class _LazyUsers(Lazy):
+    """Lazy sequence of the users with user_ids, fetched from the user
+    folder a chunk at a time, so the property sheets of a chunk are
+    filled with one call per properties plugin. user_ids must be known
+    to exist; users removed meanwhile show up as None.
+    """
+
+    def __init__(self, acl_users, user_ids, chunk_size=20):
+        self._acl_users = acl_users
+        self._user_ids = user_ids
+        self._chunk_size = chunk_size
+        self._users = {}
+        self._len = len(user_ids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError(index)
+        if index not in self._users:
+            start = index - index % self._chunk_size
+            user_ids = self._user_ids[start:start + self._chunk_size]
+            users = self._acl_users._getUsersByIds(user_ids)
+            self._users.update(enumerate(users, start))
+        return self._users[index]
+
+
 @implementer(membership.IMembershipTool)
 class MembershipTool(BaseTool):
     """PAS-based customization of MembershipTool.
@@ -83,10 +118,19 @@ class MembershipTool(BaseTool):
     user_search_keywords = ('login', 'fullname', 'email', 'exact_match',
                             'sort_by', 'max_results')
 
+    # Seconds within which a login does not store new login times.
+    # Raising it avoids a write (and conflicts on the property storage)
+    # for every login of the same member.
+    login_time_granularity = 0
+
     _properties = (getattr(BaseTool, '_properties', ()) +
                    ({'id': 'user_search_keywords',
                      'type': 'lines',
                      'mode': 'rw',
+                     },
+                    {'id': 'login_time_granularity',
+                     'type': 'int',
+                     'mode': 'w',
                      },))
 
     manage_options = (BaseTool.manage_options +
@@ -166,7 +210,7 @@ class MembershipTool(BaseTool):
             member.setMemberProperties(properties)
 
     @security.protected(ListPortalMembers)
-    def searchForMembers(self, REQUEST=None, **kw):
+    def searchForMembers(self, REQUEST=None, b_start=0, b_size=None, **kw):
         """Hacked up version of Plone searchForMembers.
 
         The following properties can be provided:
@@ -180,6 +224,29 @@ class MembershipTool(BaseTool):
         This is an 'AND' request.
 
         Simple name searches are "fast".
+
+        If b_size is given, only the b_size members starting at b_start are
+        returned. b_start and b_size are never looked up in REQUEST.
+        """
+        results = self.lazySearchForMembers(REQUEST, **kw)
+        if b_size is not None:
+            b_start = int(b_start or 0)
+            results = results[b_start:b_start + int(b_size)]
+        elif b_start:
+            results = results[int(b_start):]
+        return [member for member in results if member is not None]
+
+    @security.protected(ListPortalMembers)
+    def lazySearchForMembers(self, REQUEST=None, **kw):
+        """Same as searchForMembers, but returns a lazy sequence.
+
+        Searching for groupname is done by the group plugins where they
+        can tell the members of a group exactly, roles by the role plugin
+        and last_login_time by the property index where possible. Members
+        are then only fetched from the user folder when they are
+        accessed, a chunk at a time, so batching the result only fetches
+        the members around the batch. Members removed meanwhile show up
+        as None.
         """
         logger.debug('searchForMembers: started.')
 
@@ -222,18 +289,22 @@ class MembershipTool(BaseTool):
             email = None
 
         uf_users = []
+        # ids reported by user sources, rather than by property plugins
+        # whose records may outlive the user
+        sourced_users = set()
 
         logger.debug(
             'searchForMembers: searching PAS '
             'with arguments %r.' % user_search)
         for user in acl_users.searchUsers(**user_search):
             uf_users.append(user['userid'])
+            plugin = acl_users._getOb(user['pluginid'], None)
+            if not IPropertiesPlugin.providedBy(plugin):
+                sourced_users.add(user['userid'])
 
         if not uf_users:
             return []
 
-        getUserById = acl_users.getUserById
-
         def dedupe(seq):
             # Thanks http://www.peterbe.com/plog/uniqifiers-benchmark
             seen = set()
@@ -242,14 +313,55 @@ class MembershipTool(BaseTool):
             return [x for x in seq if x not in seen and not seen_add(x)]
 
         uf_users = dedupe(uf_users)
-        members = [getUserById(userid) for userid in uf_users]
-        members = [member for member in members if member is not None]
 
-        if not (email or fullname or roles or groupname or last_login_time):
+        if groupname:
+            group_member_ids = self._getGroupMemberIds([groupname])
+            if group_member_ids is not None:
+                logger.debug(
+                    'searchForMembers: group members of %r found by the '
+                    'group plugins.' % groupname)
+                uf_users = [userid for userid in uf_users
+                            if userid in group_member_ids]
+                groupname = None
+
+        if roles and 'Authenticated' in roles:
+            # every user has it
+            roles = None
+        if roles:
+            role_member_ids = self._getRoleMemberIds(roles)
+            if role_member_ids is not None:
+                logger.debug(
+                    'searchForMembers: principals with roles %r found by '
+                    'the role plugin.' % (roles, ))
+                uf_users = [userid for userid in uf_users
+                            if userid in role_member_ids]
+                roles = None
+
+        if last_login_time:
+            login_member_ids = self._filterByLoginTime(
+                uf_users, last_login_time, before_specified_time)
+            if login_member_ids is not None:
+                logger.debug(
+                    'searchForMembers: last_login_time searched in the '
+                    'property index.')
+                uf_users = login_member_ids
+                last_login_time = None
+
+        if not (roles or groupname or last_login_time):
             logger.debug(
                 'searchForMembers: searching users '
                 'with no extra filter, immediate return.')
-            return members
+            plugins = acl_users.plugins
+            uf_users = [userid for userid in uf_users
+                        if userid in sourced_users or
+                        acl_users._verifyUser(plugins, user_id=userid)
+                        is not None]
+            return _LazyUsers(acl_users, uf_users)
+
+        # fetch all users at once, so property sheets are filled with one
+        # call per properties plugin instead of one per user
+        members = acl_users._getUsersByIds(uf_users)
+        members = [member for member in members if member is not None]
 
         # Now perform individual checks on each user
         res = []
@@ -286,6 +398,57 @@ class MembershipTool(BaseTool):
         logger.debug('searchForMembers: finished.')
         return res
 
+    def _getGroupMemberIds(self, group_ids):
+        """Return the ids of all principals in any of group_ids, or None if
+        the group plugins can not tell without being asked about every
+        principal. See utils.getGroupMemberIds.
+        """
+        plugins = getToolByName(self, 'acl_users').plugins
+        return getGroupMemberIds(plugins, group_ids)
+
+    def _getRoleMemberIds(self, roles):
+        """Return the ids of all principals having any of roles, directly or
+        through their groups, or None if the role plugins can not tell
+        without being asked about every principal.
+
+        That is the case unless the only role plugin is a role manager
+        able to answer getEffectiveUserIdsWithRoles.
+        """
+        plugins = getToolByName(self, 'acl_users').plugins
+        rolemakers = plugins.listPlugins(IRolesPlugin)
+        if len(rolemakers) != 1:
+            return None
+        rolemaker = rolemakers[0][1]
+        if getattr(aq_base(rolemaker), 'getEffectiveUserIdsWithRoles',
+                   None) is None:
+            return None
+        return rolemaker.getEffectiveUserIdsWithRoles(roles)
+
+    def _filterByLoginTime(self, user_ids, last_login_time, before=False):
+        """Return those of user_ids who last logged in before (or else
+        at or after) last_login_time, or None if the properties plugins
+        can not tell without loading every member.
+
+        That is the case unless the first properties plugin keeps a date
+        index of last_login_time, as ZODBMutablePropertyProvider does.
+        """
+        plugins = getToolByName(self, 'acl_users').plugins
+        propfinders = plugins.listPlugins(IPropertiesPlugin)
+        if not propfinders:
+            return None
+        propfinder = propfinders[0][1]
+        if getattr(aq_base(propfinder), 'filterUserIdsByDate',
+                   None) is None:
+            return None
+
+        if not isinstance(last_login_time, DateTime):
+            last_login_time = DateTime(last_login_time)
+        if before:
+            return propfinder.filterUserIdsByDate(
+                'last_login_time', user_ids, max=last_login_time)
+        return propfinder.filterUserIdsByDate(
+            'last_login_time', user_ids, min=last_login_time)
+
     ############
     # sanitize home folders (we may get URL-illegal ids)
 
@@ -618,6 +781,75 @@ class MembershipTool(BaseTool):
         local_roles.sort()
         return tuple(local_roles)
 
+    @security.protected(View)
+    def deleteLocalRoles(self, obj, member_ids, reindex=1, recursive=0,
+                         REQUEST=None):
+        """ Delete local roles of specified members.
+
+        Recursive deletions look up the objects below obj on which the
+        members have local roles in the local roles index, where there is
+        one, instead of walking all contents of obj. As when walking
+        them, only objects reached through contentValues are changed.
+        """
+        paths = None
+        if recursive:
+            paths = self._findLocalRoles(obj, member_ids)
+        if paths is None:
+            return BaseTool.deleteLocalRoles(self, obj, member_ids,
+                                             reindex=reindex,
+                                             recursive=recursive,
+                                             REQUEST=REQUEST)
+
+        types_tool = getToolByName(self, 'portal_types')
+        content_types = set(types_tool.listContentTypes())
+        base_path = '/'.join(obj.getPhysicalPath())
+        for path in sorted(paths):
+            subobj = self._getContentBelow(obj, path[len(base_path):],
+                                           content_types)
+            if subobj is not None and _checkPermission(ChangeLocalRoles,
+                                                       subobj):
+                subobj.manage_delLocalRoles(userids=member_ids)
+
+        if reindex and hasattr(aq_base(obj), 'reindexObjectSecurity'):
+            # reindexObjectSecurity is always recursive
+            obj.reindexObjectSecurity()
+    deleteLocalRoles = postonly(deleteLocalRoles)
+
+    def _getContentBelow(self, obj, path, content_types):
+        """Return the object at path relative to obj, or None unless it
+        and all objects between it and obj are content of their parents,
+        as listed by contentValues.
+        """
+        for name in path.split('/'):
+            if not name:
+                continue
+            if getattr(aq_base(obj), 'contentValues', None) is None:
+                return None
+            obj = obj._getOb(name, None)
+            if obj is None or getattr(aq_base(obj), 'portal_type',
+                                      None) not in content_types:
+                return None
+        return obj
+
+    def _findLocalRoles(self, obj, member_ids):
+        """Return the paths of the objects at or below obj on which any of
+        member_ids has local roles, or None without a local roles index.
+        """
+        acl_users = getToolByName(self, 'acl_users')
+        plugins = [plugin for plugin_id, plugin
+                   in acl_users.plugins.listPlugins(ILocalRolesPlugin)
+                   if getattr(plugin, 'hasLocalRolesIndex', None) is not None
+                   and plugin.hasLocalRolesIndex()]
+        if not plugins:
+            return None
+
+        path = '/'.join(obj.getPhysicalPath())
+        paths = set()
+        for plugin in plugins:
+            for member_id in member_ids:
+                paths.update(plugin.getLocalRolesForPrincipal(member_id, path))
+        return paths
+
     @security.protected(View)
     def loginUser(self, REQUEST=None):
         """ Handle a login for the current user.
@@ -718,16 +950,24 @@ class MembershipTool(BaseTool):
 
             The return value indicates if this is the first logged
             login time.
+
+            Logins within login_time_granularity seconds of the stored
+            login time leave the properties untouched.
         """
         res = False
         if not self.isAnonymousUser():
             member = self.getAuthenticatedMember()
             default = DateTime('2000/01/01')
             login_time = member.getProperty('login_time', default)
+            now = self.ZopeTime()
             if login_time == default:
                 res = True
                 login_time = DateTime()
-            member.setProperties(login_time=self.ZopeTime(),
+            elif self.login_time_granularity and \
+                    isinstance(login_time, DateTime) and \
+                    (now - login_time) * 86400 < self.login_time_granularity:
+                return res
+            member.setProperties(login_time=now,
                                  last_login_time=login_time)
         return res
 
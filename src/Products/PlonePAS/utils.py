@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
+from Acquisition import aq_base
 from Products.PlonePAS.config import IMAGE_SCALE_PARAMS
+from Products.PlonePAS.interfaces.group import IGroupIntrospection
+from Products.PlonePAS.plugins.autogroup import AutoGroup
+from Products.PluggableAuthService.PluggableAuthService \
+    import _SWALLOWABLE_PLUGIN_EXCEPTIONS
 from Products.PluggableAuthService.interfaces.plugins import IGroupsPlugin
+from Products.PluggableAuthService.plugins.RecursiveGroupsPlugin import \
+    IRecursiveGroupsPlugin
+from collections import OrderedDict
 from cStringIO import StringIO
 from urllib import quote as url_quote
 from urllib import unquote as url_unquote
+import threading
+import time
 
 
 def unique(iterable):
@@ -170,6 +180,81 @@ def getGroupsForPrincipal(principal, plugins, request=None):
     return list(groups)
 
 
+def getGroupMemberIds(plugins, group_ids):
+    """Return the ids of all principals in any of group_ids, or None if
+    the group plugins can not tell without being asked about every
+    principal.
+
+    Without the recursive groups plugin, a principal only is in the
+    groups the groups plugins list it in, so the members reported by
+    the group introspection plugins are all of them. With it, a single
+    group manager knowing the transitive members of its groups must be
+    the only groups plugin listing members, as nesting across plugins
+    can't be followed from the groups down. Automatic groups have every
+    principal as member, so they must not be involved.
+    """
+    recursive = False
+    introspectors = []
+    automatic_ids = set()
+    for plugin_id, plugin in plugins.listPlugins(IGroupsPlugin):
+        if IRecursiveGroupsPlugin.providedBy(plugin):
+            recursive = True
+        elif isinstance(aq_base(plugin), AutoGroup):
+            automatic_ids.update(plugin.getGroupIds())
+        elif IGroupIntrospection.providedBy(plugin):
+            introspectors.append(plugin)
+        else:
+            return None
+
+    if not recursive:
+        getters = [plugin.getGroupMembers for plugin in introspectors]
+    elif len(introspectors) == 1 and getattr(
+            aq_base(introspectors[0]), 'getTransitiveGroupMembers',
+            None) is not None:
+        getters = [introspectors[0].getTransitiveGroupMembers]
+    else:
+        return None
+
+    member_ids = set()
+    for getGroupMembers in getters:
+        for group_id in group_ids:
+            try:
+                member_ids.update(getGroupMembers(group_id))
+            except _SWALLOWABLE_PLUGIN_EXCEPTIONS:
+                return None
+
+    if automatic_ids.intersection(group_ids) or \
+            recursive and automatic_ids.intersection(member_ids):
+        return None
+    return member_ids
+
+
+def getPrincipalIds(user):
+    """Return the ids of user and all its groups as frozenset.
+
+    Uses the set precomputed by PloneUser, if available.
+    """
+    getPrincipalIds = getattr(aq_base(user), 'getPrincipalIds', None)
+    if getPrincipalIds is not None:
+        return getPrincipalIds()
+    return frozenset([user.getId()] + list(user.getGroups()))
+
+
+def getChangedProperties(sheet, mapping):
+    """Return the items of mapping whose values differ from those of the
+    property sheet.
+    """
+    changed = {}
+    for name, value in mapping.items():
+        current = sheet.getProperty(name, _marker)
+        if type(current) is not type(value) or current != value:
+            changed[name] = value
+    return changed
+
+
+_marker = object()
+
+
 def safe_unicode(value, encoding='utf-8'):
     """Converts a value to unicode, even it is already a unicode string.
     """
@@ -183,6 +268,83 @@ def safe_unicode(value, encoding='utf-8'):
     return value
 
 
+class PropertyMapVersioned(object):
+    """Mixin for property managers which counts changes to their
+    properties.
+
+    Consumers can use the counter to cache what they derive from the
+    property map, e.g. the schema of the mutable property provider.
+    """
+
+    _property_map_version = 0
+
+    def _setProperty(self, id, value, type='string'):
+        super(PropertyMapVersioned, self)._setProperty(id, value, type)
+        self._property_map_version += 1
+
+    def _updateProperty(self, id, value):
+        super(PropertyMapVersioned, self)._updateProperty(id, value)
+        self._property_map_version += 1
+
+    def _delProperty(self, id):
+        super(PropertyMapVersioned, self)._delProperty(id)
+        self._property_map_version += 1
+
+
+class LRUCache(object):
+    """A thread safe cache of at most maxsize items, which expire ttl
+    seconds after they have been set, or never if ttl is None.
+
+    When full, the least recently used item is dropped.
+    """
+
+    def __init__(self, maxsize, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _marker)
+            if item is _marker or \
+                    item[1] is not None and item[1] < self._timer():
+                return default
+            # mark as most recently used
+            self._data[key] = item
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            expires = None
+            if self.ttl is not None:
+                expires = self._timer() + self.ttl
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidateValues(self, predicate):
+        """Drop the items for whose value predicate is true.
+        """
+        with self._lock:
+            for key, (value, expires) in self._data.items():
+                if predicate(value):
+                    del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
 # Imported from Products.CMFCore.MemberdataTool as it has now been removed.
 class CleanupTemp:
     """Used to cleanup _v_temps at the end of the request."""